@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""End-to-end boot latency benchmark against the simulated WMT driver.
+
+Runs loader.do_loader followed by the full launcher flow (power-on, patch
+requests, WiFi enable) against mockdriver.MockDriver, and reports the
+time-to-WiFi distribution.
+
+    python3 bench/bench_boot.py --iterations 50 --delay WMT_IOCTL_LPBK_POWER_CTRL=0.05
+"""
+import argparse
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import ioctl  # noqa: E402
+import launcher  # noqa: E402
+import logformat  # noqa: E402
+import launcher_async  # noqa: E402
+import loader  # noqa: E402
+from mockdriver import MockDriver, MockDriverConfig  # noqa: E402
+
+
+def parse_kv(values: list[str], convert) -> dict:
+    result = {}
+    for value in values:
+        key, sep, v = value.partition("=")
+        if not sep:
+            raise SystemExit(f"Expected NAME=VALUE, got {value!r}")
+        result[key] = convert(v)
+    return result
+
+
+def run_once(
+    config: MockDriverConfig, use_asyncio: bool, timeout: float, state_dir: str | None
+) -> float:
+    """Run a single boot, returns time-to-WiFi in seconds."""
+    with MockDriver(config, state_dir) as driver:
+        start_ns = time.monotonic_ns()
+        if loader.do_loader() != 0:
+            raise Exception("Loader step failed")
+
+        if use_asyncio:
+            t = threading.Thread(target=launcher_async.do_launcher, daemon=True)
+            t.start()
+        elif launcher.do_launcher() != 0:
+            raise Exception("Launcher step failed")
+
+        if not driver.wifi_enabled.wait(timeout):
+            raise Exception(f"WiFi was not enabled within {timeout}s")
+        elapsed = (driver.wifi_enabled_ns - start_ns) / 1e9
+
+        if use_asyncio:
+            launcher_async.request_stop()
+            t.join(timeout)
+    return elapsed
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--asyncio", action="store_true", help="use the asyncio launcher")
+    parser.add_argument(
+        "--delay",
+        action="append",
+        default=[],
+        metavar="IOCTL=SECONDS",
+        help="simulated duration of an ioctl, by name",
+    )
+    parser.add_argument(
+        "--fail",
+        action="append",
+        default=[],
+        metavar="IOCTL=COUNT",
+        help="fail the first COUNT calls of an ioctl, by name",
+    )
+    parser.add_argument("--download-delay", type=float, default=0.0)
+    parser.add_argument("--wifi-node-delay", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument(
+        "--warm",
+        action="store_true",
+        help="keep the firmware, patch index and boot plan across iterations",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument(
+        "--ioctl-stats", action="store_true", help="print per-ioctl latency stats over all iterations"
+    )
+    args = parser.parse_args()
+    logformat.configure_logger()
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.ERROR)
+
+    def config() -> MockDriverConfig:
+        return MockDriverConfig(
+            delays=parse_kv(args.delay, float),
+            failures=parse_kv(args.fail, int),
+            download_delay=args.download_delay,
+            wifi_node_delay=args.wifi_node_delay,
+        )
+
+    state_dir = tempfile.mkdtemp(prefix="wmt-bench-boot-") if args.warm else None
+    results = []
+    try:
+        for i in range(args.iterations):
+            results.append(run_once(config(), args.asyncio, args.timeout, state_dir))
+    finally:
+        if state_dir is not None:
+            shutil.rmtree(state_dir, ignore_errors=True)
+
+    if args.ioctl_stats:
+        print(ioctl.format_stats())
+
+    ms = [r * 1000 for r in results]
+    print(f"iterations: {len(ms)}")
+    print(f"time-to-WiFi p50: {percentile(ms, 50):.1f}ms")
+    print(f"time-to-WiFi p95: {percentile(ms, 95):.1f}ms")
+    print(f"time-to-WiFi min/mean/max: {min(ms):.1f}/{statistics.mean(ms):.1f}/{max(ms):.1f}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
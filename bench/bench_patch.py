@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Firmware parsing benchmarks over synthetic patch corpora.
+
+Times patch.patchglob, the patch index (cold and warm) and each header
+parser, for every requested corpus size.
+
+    python3 bench/bench_patch.py --counts 10,100,1000,10000 --scale 0.1
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import patch  # noqa: E402
+import patchindex  # noqa: E402
+import logformat  # noqa: E402
+import synthpatch  # noqa: E402
+
+
+def best_of(func, repeat: int, number: int = 1) -> float:
+    """Best time of a single call, in seconds."""
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def report(name: str, count: int, seconds: float, per_file: bool = True):
+    line = f"{name:<36} {count:>6} files  {seconds * 1000:>10.3f}ms"
+    if per_file and count:
+        line += f"  {seconds / count * 1e6:>10.2f}us/file"
+    print(line, flush=True)
+
+
+def bench_corpus(directory: str, index_path: str, count: int, repeat: int):
+    patch.PATCH_LOOKUP_DIRECTORY = directory
+    pattern = "*.bin"
+
+    def glob_and_read():
+        # Touch what the launcher used to: the header fields of every file,
+        # and the BT version of ram_bt files.
+        for p in patch.patchglob(pattern):
+            header = p.header()
+            patch.get_patch_build_id(header)
+            patch.get_patch_info(header)
+            patch.get_patch_fwver(header)
+            if "ram_bt" in p.filename:
+                patch.find_bluetooth_fw_ver(p.contents)
+            p.close()
+
+    report("patchglob", count, best_of(lambda: patch.patchglob(pattern), repeat))
+    report("patchglob + parse", count, best_of(glob_and_read, repeat))
+
+    def index_cold():
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        index = patchindex.PatchIndex(directory, index_path)
+        index.load()
+        index.glob(pattern)
+
+    def index_warm():
+        index = patchindex.PatchIndex(directory, index_path)
+        index.load()
+        index.glob(pattern)
+
+    report("patch index cold (parse + save)", count, best_of(index_cold, repeat))
+    index_cold()
+    report("patch index warm (load + glob)", count, best_of(index_warm, repeat))
+
+
+def bench_parsers(directory: str, repeat: int):
+    files = sorted(os.listdir(directory))
+    header_file = os.path.join(directory, next(f for f in files if "ram_wifi" in f))
+    bt_file = os.path.join(directory, next(f for f in files if "ram_bt" in f))
+    with open(header_file, "rb") as f:
+        wifi_bytes = f.read()
+    with open(bt_file, "rb") as f:
+        bt_bytes = f.read()
+    header = wifi_bytes[: patch.PATCH_HEADER_SIZE]
+    number = 10000
+
+    print(f"\nparsers (header of {len(wifi_bytes)} byte file, {number} calls)")
+    for name, func in [
+        ("get_patch_build_id", lambda: patch.get_patch_build_id(header)),
+        ("get_patch_info", lambda: patch.get_patch_info(header)),
+        ("get_patch_fwver", lambda: patch.get_patch_fwver(header)),
+        ("get_patch_info (full bytes)", lambda: patch.get_patch_info(wifi_bytes)),
+    ]:
+        seconds = best_of(func, repeat, number)
+        print(f"{name:<36} {seconds * 1e6:>10.3f}us/call", flush=True)
+
+    print(f"\nfind_bluetooth_fw_ver ({len(bt_bytes)} byte file)")
+    bt_patch = patch.Patch(bt_file, os.path.basename(bt_file))
+    for name, func in [
+        ("bytes", lambda: patch.find_bluetooth_fw_ver(bt_bytes)),
+        ("mmap", lambda: patch.find_bluetooth_fw_ver(bt_patch.contents)),
+    ]:
+        seconds = best_of(func, repeat, 10)
+        print(f"{name:<36} {seconds * 1e6:>10.3f}us/call", flush=True)
+    bt_patch.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--counts",
+        default="10,100,1000",
+        help="comma separated corpus sizes, e.g. 10,100,1000,10000",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="file size multiplier, lower it for the large corpora",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--keep", metavar="DIR", help="generate corpora under DIR and keep them")
+    args = parser.parse_args()
+    logformat.configure_logger()
+
+    logging.getLogger().setLevel(logging.ERROR)
+
+    root = args.keep or tempfile.mkdtemp(prefix="wmt-bench-patch-")
+    try:
+        directory = None
+        for count in [int(c) for c in args.counts.split(",")]:
+            directory = os.path.join(root, f"corpus-{count}") + "/"
+            if not os.path.isdir(directory):
+                synthpatch.generate(directory, count, args.scale)
+            # Keep the index out of the corpus, writing it would change the
+            # directory mtime and invalidate the cached listing.
+            index_path = os.path.join(root, f"patchindex-{count}.json")
+            bench_corpus(directory, index_path, count, args.repeat)
+        if directory is not None:
+            bench_parsers(directory, args.repeat)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Import-time budget check for the wmt-pyloader startup path.
+
+Imports wmt-pyloader and loads the default boot target in a fresh interpreter with
+`-X importtime`, and fails when the imports take longer than the budget.
+Runs against src/, or a bundle built by tools/bundle.py.
+
+    python3 bench/bench_startup.py --budget-ms 60
+    python3 bench/bench_startup.py --bundle wmt-pyloader.pyz
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+MARKER = "-- wmt-pyloader startup --"
+
+# Imports done by `wmt-pyloader.py` before booting the default target.
+IMPORT_SRC = f"""
+import pkgutil, runpy, sys  # used by run_path, not part of the startup path
+sys.path.insert(0, {SRC!r})
+sys.stderr.write({MARKER!r} + "\\n")
+runpy.run_path({os.path.join(SRC, "wmt-pyloader.py")!r}, run_name="wmt_pyloader")
+import targets
+targets.load(targets.DEFAULT_TARGET)
+"""
+IMPORT_BUNDLE = """
+import sys
+sys.path.insert(0, {bundle!r})
+sys.stderr.write({marker!r} + "\\n")
+import wmt_pyloader
+import targets
+targets.load(targets.DEFAULT_TARGET)
+"""
+
+
+def measure(code: str) -> tuple[float, float, list[tuple[float, str]]]:
+    """Returns (import ms, process wall ms, top-level imports by cumulative ms)."""
+    start = time.monotonic()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall_ms = (time.monotonic() - start) * 1000
+
+    lines = result.stderr.splitlines()
+    lines = lines[lines.index(MARKER) + 1 :]
+    imports = []
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # Nested imports are indented, their time is included in the parent.
+        if not name.startswith("  "):
+            imports.append((int(cumulative) / 1000, name.strip()))
+    return sum(ms for ms, _ in imports), wall_ms, imports
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=60.0,
+        help="maximum import time, measure a known good build on the board to pick one",
+    )
+    parser.add_argument("--bundle", metavar="PYZ", help="measure a bundle instead of src/")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to list")
+    args = parser.parse_args()
+
+    if args.bundle:
+        code = IMPORT_BUNDLE.format(bundle=os.path.abspath(args.bundle), marker=MARKER)
+    else:
+        code = IMPORT_SRC
+
+    # Best of several runs, the first one also pays for writing __pycache__.
+    runs = [measure(code) for _ in range(args.repeat)]
+    import_ms, wall_ms, imports = min(runs, key=lambda r: r[0])
+
+    print(f"slowest imports (of {len(imports)}):")
+    for ms, name in sorted(imports, reverse=True)[: args.top]:
+        print(f"  {name:<32} {ms:>8.2f}ms")
+    print(f"import time: {import_ms:.1f}ms (budget {args.budget_ms:.1f}ms)")
+    print(f"process wall time: {wall_ms:.1f}ms")
+    if import_ms > args.budget_ms:
+        print("FAIL: startup imports are over budget")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
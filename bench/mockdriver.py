@@ -0,0 +1,258 @@
+import collections
+import dataclasses
+import os
+import select
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tty
+from typing import Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import bootplan  # noqa: E402
+import ioctl  # noqa: E402
+import launcher  # noqa: E402
+import loader  # noqa: E402
+import patchindex  # noqa: E402
+import prefetch  # noqa: E402
+import logformat  # noqa: E402
+from synthpatch import make_patch  # noqa: E402
+
+logger = logformat.get_logger()
+
+# Seconds the simulated driver waits for the launcher to answer a command.
+COMMAND_TIMEOUT = 10.0
+
+
+def write_firmware(directory: str, chip_id: int, fwver: int, size: int = 0x100):
+    """Write the set of patch files the launcher looks up for `chip_id`."""
+    rom_prefix = launcher.get_rom_patch_prefix(chip_id)
+    prefix = launcher.get_patch_prefix(chip_id)
+    suffix = launcher.get_patch_suffix(chip_id)
+    files = {
+        # ROM patches, patchinfo[7] is the patch type.
+        f"{rom_prefix}_ram_mcu_{suffix}_hdr.bin": (bytes.fromhex("110010f000000000"), None),
+        f"{rom_prefix}_ram_wifi_{suffix}_hdr.bin": (bytes.fromhex("110020f000000001"), None),
+        f"{rom_prefix}_ram_bt_{suffix}_hdr.bin": (
+            bytes.fromhex("110030f000000002"),
+            "t-neptune-mock",
+        ),
+        # Patch count 1, download sequence 1.
+        f"{prefix}_patch_mcu_{suffix}_hdr.bin": (bytes.fromhex("1100400000000000"), None),
+    }
+    os.makedirs(directory, exist_ok=True)
+    for filename, (patchinfo, bt_version) in files.items():
+        with open(os.path.join(directory, filename), "wb") as f:
+            f.write(make_patch(fwver, patchinfo, size, bt_version=bt_version))
+    with open(os.path.join(directory, "WMT_SOC.cfg"), "wt") as f:
+        f.write("# mock config\n")
+
+
+@dataclasses.dataclass
+class MockDriverConfig:
+    soc_chip_id: int = 0x6765
+    adie_chip_id: int = 0x6631
+    hwver: int = 0x8A00
+    fwver: int = 0x8A00
+    # Seconds each ioctl takes, keyed by ioctl name (e.g. WMT_IOCTL_SET_PATCH_INFO).
+    delays: dict[str, float] = dataclasses.field(default_factory=dict)
+    # Number of initial calls failing with -1, keyed by ioctl name.
+    failures: dict[str, int] = dataclasses.field(default_factory=dict)
+    # Commands sent to the launcher while powering on, in order.
+    commands: list[bytes] = dataclasses.field(
+        default_factory=lambda: [
+            launcher.WMT_COMMAND_SRH_ROM_PATCH,
+            launcher.WMT_COMAMND_SRH_PATCH,
+        ]
+    )
+    # Seconds the simulated patch download takes after every command.
+    download_delay: float = 0.0
+    # Seconds between power-on completing and WMT_WIFI appearing.
+    wifi_node_delay: float = 0.0
+
+
+class MockDriver:
+    """Simulated WMT driver, for running the loader and launcher without
+    MT6765 hardware.
+
+    `install` routes ioctl.do_ioctl to the simulated driver and points the
+    device node paths at stand-ins in a temporary directory:
+    - /dev/wmtdetect is a plain file, only used for ioctl's
+    - /dev/stpwmt is a raw pty, the driver side sends commands on the master
+    - /dev/wmtWifi is a FIFO created after power-on, read by the driver side
+    A synthetic firmware directory matching the chip ID is generated, and
+    the patch index and boot plan are kept next to it. With `state_dir`,
+    these are reused across drivers, to simulate warm boots.
+    """
+
+    def __init__(self, config: Optional[MockDriverConfig] = None, state_dir: Optional[str] = None):
+        self.config = config or MockDriverConfig()
+        self.tmpdir = tempfile.mkdtemp(prefix="wmt-mockdriver-")
+        self.state_dir = state_dir or self.tmpdir
+        self.firmware_dir = os.path.join(self.state_dir, "firmware") + "/"
+        self.detect_node = os.path.join(self.tmpdir, "wmtdetect")
+        self.wifi_node = os.path.join(self.tmpdir, "wmtWifi")
+        self.master = -1
+        self.stpwmt_node = ""
+        # Number of calls per ioctl name.
+        self.calls: collections.Counter[str] = collections.Counter()
+        # Patch request buffers received, in order.
+        self.patch_requests: list[tuple[str, bytes]] = []
+        self.responses: list[tuple[bytes, bytes]] = []
+        self.wifi_enabled = threading.Event()
+        self.wifi_enabled_ns = 0
+        self._saved: dict[str, object] = {}
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(self.firmware_dir):
+            write_firmware(self.firmware_dir, self.config.soc_chip_id, self.config.fwver)
+        with open(self.detect_node, "wb"):
+            pass
+
+    def install(self):
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.stpwmt_node = os.ttyname(slave)
+        # Keep the slave open, so the pty stays alive between launcher opens.
+        self._slave = slave
+
+        self._saved = {
+            "DETECT_NODE": loader.DETECT_NODE,
+            "WMT_DEV": launcher.WMT_DEV,
+            "WMT_WIFI": launcher.WMT_WIFI,
+            "index": patchindex.get_index(),
+            "planner": bootplan.get_planner(),
+        }
+        loader.DETECT_NODE = self.detect_node
+        launcher.WMT_DEV = self.stpwmt_node
+        launcher.WMT_WIFI = self.wifi_node
+        patchindex.set_index(
+            patchindex.PatchIndex(
+                self.firmware_dir, os.path.join(self.state_dir, "patchindex.json")
+            )
+        )
+        bootplan.set_planner(bootplan.BootPlanner(os.path.join(self.state_dir, "bootplan.json")))
+        prefetch.reset()
+        ioctl.set_backend(self.ioctl)
+
+    def uninstall(self):
+        ioctl.set_backend(None)
+        if self._saved:
+            loader.DETECT_NODE = self._saved["DETECT_NODE"]
+            launcher.WMT_DEV = self._saved["WMT_DEV"]
+            launcher.WMT_WIFI = self._saved["WMT_WIFI"]
+            patchindex.set_index(self._saved["index"])
+            bootplan.set_planner(self._saved["planner"])
+            self._saved = {}
+        if self.master >= 0:
+            # Closing the master makes the launcher stop serving commands.
+            os.close(self.master)
+            os.close(self._slave)
+            self.master = -1
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *_):
+        self.uninstall()
+
+    def ioctl(self, fd, request: int, arg: int | bytearray) -> int:
+        name = ioctl.ioctl_name(request)
+        with self._lock:
+            self.calls[name] += 1
+            calls = self.calls[name]
+        delay = self.config.delays.get(name, 0.0)
+        if delay:
+            time.sleep(delay)
+        if calls <= self.config.failures.get(name, 0):
+            return -1
+
+        handler = getattr(self, f"_{name}", None)
+        if handler is None:
+            return 0
+        return handler(arg)
+
+    # /dev/wmtdetect
+
+    def _COMBO_IOCTL_CONNSYS_SOC_HW_INIT(self, arg) -> int:
+        return -1
+
+    def _COMBO_IOCTL_EXT_CHIP_PWR_ON(self, arg) -> int:
+        # SOC chips don't need the external combo chip power on.
+        return -1
+
+    def _COMBO_IOCTL_GET_SOC_CHIP_ID(self, arg) -> int:
+        return self.config.soc_chip_id
+
+    def _COMBO_IOCTL_SET_CHIP_ID(self, arg) -> int:
+        return arg
+
+    def _COMBO_IOCTL_GET_ADIE_CHIP_ID(self, arg) -> int:
+        return self.config.adie_chip_id
+
+    # /dev/stpwmt
+
+    def _WMT_IOCTL_WMT_QUERY_CHIPID(self, arg) -> int:
+        return self.config.soc_chip_id
+
+    def _WMT_IOCTL_GET_CHIP_INFO(self, arg) -> int:
+        # Note that WMTCHIN.MAPPINGHWVER used by the launcher has the same
+        # value as WMT_CHIPINFO_GET_FWVER.
+        return {
+            launcher.WMT_CHIPINFO_GET_CHIPID: self.config.soc_chip_id,
+            launcher.WMT_CHIPINFO_GET_HWVER: self.config.hwver,
+            launcher.WMT_CHIPINFO_GET_FWVER: self.config.fwver,
+        }.get(arg, 0)
+
+    def _WMT_IOCTL_SET_ROM_PATCH_INFO(self, arg) -> int:
+        self.patch_requests.append(("rom", bytes(arg)))
+        return 0
+
+    def _WMT_IOCTL_SET_PATCH_INFO(self, arg) -> int:
+        self.patch_requests.append(("patch", bytes(arg)))
+        return 0
+
+    def _WMT_IOCTL_LPBK_POWER_CTRL(self, arg) -> int:
+        if arg == 0:
+            return 0
+        # The real driver requests patches from the launcher while this
+        # ioctl is in flight.
+        if not self.send_commands():
+            return -1
+
+        threading.Timer(self.config.wifi_node_delay, self._create_wifi_node).start()
+        return 0
+
+    def send_commands(self) -> bool:
+        """Send the configured commands to the launcher, like the driver does
+        on power-on and again after chip resets. Returns False on failure."""
+        for command in self.config.commands:
+            os.write(self.master, command)
+            r, _, _ = select.select([self.master], [], [], COMMAND_TIMEOUT)
+            if not r:
+                logger.error(f"Mock driver: no response to {command}")
+                return False
+            response = os.read(self.master, 16)
+            self.responses.append((command, response))
+            if response != b"ok":
+                return False
+            if self.config.download_delay:
+                time.sleep(self.config.download_delay)
+        return True
+
+    def _create_wifi_node(self):
+        if not os.path.exists(self.wifi_node):
+            os.mkfifo(self.wifi_node)
+        threading.Thread(target=self._wifi_reader, daemon=True).start()
+
+    def _wifi_reader(self):
+        with open(self.wifi_node, "rb") as f:
+            data = f.read()
+        if data.strip() == b"1":
+            self.wifi_enabled_ns = time.monotonic_ns()
+            self.wifi_enabled.set()
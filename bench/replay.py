@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""Offline replay of I/O traces recorded with wmt-pyloader --record-io.
+
+Runs the loader and launcher against a simulated driver answering from the
+trace, with patch files reconstructed from the recorded requests.
+
+    python3 bench/replay.py boot.trace --time-scale 0
+"""
+import argparse
+import os
+import select
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import ioctl  # noqa: E402
+import iotrace  # noqa: E402
+import launcher  # noqa: E402
+import loader  # noqa: E402
+import logformat  # noqa: E402
+from mockdriver import COMMAND_TIMEOUT, MockDriver  # noqa: E402
+from synthpatch import make_patch  # noqa: E402
+
+
+def write_trace_firmware(directory: str, events: list[iotrace.Event]):
+    """Write patch files matching the patch requests of a trace.
+
+    Only the header fields the launcher looks at are reconstructed: the
+    firmware version, the patch info taken from the request buffers, and a
+    BT version block for ram_bt patches.
+    """
+    fwver = 0
+    patch_num = 0
+    requests: list[tuple[str, bytes]] = []
+    for e in events:
+        if not isinstance(e, iotrace.IoctlEvent):
+            continue
+        if e.name == "WMT_IOCTL_GET_CHIP_INFO" and e.arg == launcher.WMT_CHIPINFO_GET_FWVER:
+            fwver = e.ret & 0xFFFF
+        elif e.name == "WMT_IOCTL_SET_PATCH_NUM" and isinstance(e.arg, int):
+            patch_num = e.arg
+        elif e.name in ("WMT_IOCTL_SET_ROM_PATCH_INFO", "WMT_IOCTL_SET_PATCH_INFO"):
+            if not isinstance(e.arg, bytes) or len(e.arg) != launcher.PATCH_REQUEST.size:
+                continue
+            first, address, name = launcher.PATCH_REQUEST.unpack(e.arg)
+            filename = os.path.basename(name.rstrip(b"\0").decode(errors="replace"))
+            addr = address.to_bytes(4, "little")
+            if e.name == "WMT_IOCTL_SET_ROM_PATCH_INFO":
+                # `first` is the patch type, stored in patchinfo[7].
+                patchinfo = bytes([0x11]) + addr[1:4] + bytes([0, 0, 0, first & 0xFF])
+            else:
+                # `first` is the download sequence, stored next to the patch
+                # count in patchinfo[0].
+                patchinfo = bytes([(patch_num << 4 | first) & 0xFF]) + addr[1:4] + bytes(4)
+            requests.append((filename, patchinfo))
+
+    os.makedirs(directory, exist_ok=True)
+    for filename, patchinfo in requests:
+        bt_version = "t-neptune-replay" if "_ram_bt_" in filename else None
+        with open(os.path.join(directory, filename), "wb") as f:
+            f.write(make_patch(fwver, patchinfo, bt_version=bt_version))
+    with open(os.path.join(directory, "WMT_SOC.cfg"), "wt") as f:
+        f.write("# replayed config\n")
+
+
+class ReplayDriver(MockDriver):
+    """Simulated WMT driver answering from a recorded trace.
+
+    Every ioctl returns the recorded result of the matching call, after its
+    recorded duration times `time_scale` (1.0 for the original timing, 0.0
+    to run as fast as possible). Commands the launcher read while an ioctl
+    was in flight (e.g. LPBK_POWER_CTRL) are sent again during that ioctl,
+    at their recorded offsets, and WMT_WIFI appears when the last ioctl
+    before the recorded WiFi enable returns.
+
+    Calls are matched to the first unused recorded call with the same
+    number and argument. Calls repeating an already used one (e.g. chip
+    info queries the boot plan skipped when recording) get the same result
+    again. Anything else is a divergence, collected in `divergences`.
+    """
+
+    def __init__(self, events: list[iotrace.Event], time_scale: float = 1.0):
+        self.events = events
+        self.time_scale = time_scale
+        self.ioctls = [e for e in events if isinstance(e, iotrace.IoctlEvent)]
+        self.used = [False] * len(self.ioctls)
+        self.divergences: list[str] = []
+        self.mismatched_responses: list[tuple[bytes, bytes, bytes]] = []
+        self.commands_sent = 0
+        self.trace_state = tempfile.mkdtemp(prefix="wmt-replay-")
+        write_trace_firmware(os.path.join(self.trace_state, "firmware"), events)
+        super().__init__(state_dir=self.trace_state)
+
+        # Commands and the responses the launcher gave, keyed by the ioctl
+        # they were sent during.
+        self.commands: dict[int, list[tuple[int, bytes, Optional[bytes]]]] = {}
+        data = [e for e in events if isinstance(e, iotrace.DataEvent)]
+        for i, e in enumerate(data):
+            if e.kind != "read":
+                continue
+            response = None
+            if i + 1 < len(data) and data[i + 1].kind == "write":
+                response = data[i + 1].data
+            during = self._in_flight(e.timestamp_ns)
+            if during is None:
+                self.divergences.append(f"command {e.data!r} wasn't sent during an ioctl")
+                continue
+            self.commands.setdefault(during, []).append((e.timestamp_ns, e.data, response))
+
+        self.wifi_after: Optional[int] = None
+        self.wifi_delay_ns = 0
+        wifi = next((e for e in data if e.kind == "wifi"), None)
+        if wifi is not None:
+            before = [i for i, e in enumerate(self.ioctls) if e.end_ns <= wifi.timestamp_ns]
+            if before:
+                self.wifi_after = max(before, key=lambda i: self.ioctls[i].end_ns)
+                self.wifi_delay_ns = wifi.timestamp_ns - self.ioctls[self.wifi_after].end_ns
+
+    def _in_flight(self, timestamp_ns: int) -> Optional[int]:
+        # The innermost, i.e. latest started, ioctl spanning the timestamp.
+        found = None
+        for i, e in enumerate(self.ioctls):
+            if e.start_ns <= timestamp_ns <= e.end_ns:
+                found = i
+        return found
+
+    def recorded_time_to_wifi(self) -> Optional[float]:
+        """Seconds from the first recorded ioctl to the WiFi enable."""
+        wifi = next(
+            (e for e in self.events if isinstance(e, iotrace.DataEvent) and e.kind == "wifi"),
+            None,
+        )
+        if wifi is None or not self.ioctls:
+            return None
+        return (wifi.timestamp_ns - self.ioctls[0].start_ns) / 1e9
+
+    def uninstall(self):
+        super().uninstall()
+        shutil.rmtree(self.trace_state, ignore_errors=True)
+
+    def _match(self, request: int, arg: int | bytes) -> Optional[int]:
+        request &= 0xFFFFFFFF
+        name = ioctl.ioctl_name(request)
+        with self._lock:
+            self.calls[name] += 1
+            for i, e in enumerate(self.ioctls):
+                if not self.used[i] and e.ioctl == request and e.arg == arg:
+                    self.used[i] = True
+                    return i
+            for i, e in enumerate(self.ioctls):
+                if self.used[i] and e.ioctl == request and e.arg == arg:
+                    return i
+            for i, e in enumerate(self.ioctls):
+                if not self.used[i] and e.ioctl == request:
+                    self.used[i] = True
+                    self.divergences.append(f"{name}: argument differs from the trace")
+                    return i
+            self.divergences.append(f"{name}: not in the trace")
+        return None
+
+    def _sleep_until(self, deadline_ns: int):
+        delay = (deadline_ns - time.monotonic_ns()) / 1e9
+        if delay > 0:
+            time.sleep(delay)
+
+    def ioctl(self, fd, request: int, arg: int | bytearray) -> int:
+        value = bytes(arg) if isinstance(arg, bytearray) else arg
+        start_ns = time.monotonic_ns()
+        i = self._match(request, value)
+        if i is None:
+            return 0
+        e = self.ioctls[i]
+
+        for timestamp_ns, command, response in self.commands.pop(i, []):
+            self._sleep_until(start_ns + int((timestamp_ns - e.start_ns) * self.time_scale))
+            self._send_command(command, response)
+        self._sleep_until(start_ns + int((e.end_ns - e.start_ns) * self.time_scale))
+
+        if e.after is not None and isinstance(arg, bytearray):
+            arg[:] = e.after
+        if i == self.wifi_after:
+            delay = self.wifi_delay_ns * self.time_scale / 1e9
+            threading.Timer(delay, self._create_wifi_node).start()
+        if e.raised:
+            raise OSError(-e.ret, os.strerror(-e.ret))
+        return e.ret
+
+    def _send_command(self, command: bytes, expected: Optional[bytes]):
+        os.write(self.master, command)
+        self.commands_sent += 1
+        r, _, _ = select.select([self.master], [], [], COMMAND_TIMEOUT)
+        if not r:
+            self.divergences.append(f"no response to {command!r}")
+            return
+        response = os.read(self.master, 16)
+        self.responses.append((command, response))
+        if expected is not None and response != expected:
+            self.mismatched_responses.append((command, expected, response))
+            self.divergences.append(f"{command!r}: responded {response!r}, trace has {expected!r}")
+
+
+def replay(path: str, time_scale: float, use_asyncio: bool, timeout: float) -> int:
+    events = iotrace.read_trace(path)
+    driver = ReplayDriver(events, time_scale)
+    recorded = driver.recorded_time_to_wifi()
+    if use_asyncio:
+        import launcher_async
+    with driver:
+        start_ns = time.monotonic_ns()
+        t: Optional[threading.Thread] = None
+        if loader.do_loader() != 0:
+            print("Loader step failed")
+        elif use_asyncio:
+            t = threading.Thread(target=launcher_async.do_launcher, daemon=True)
+            t.start()
+        else:
+            launcher_ = launcher.Launcher()
+            if launcher_.run() != 0:
+                print("Launcher step failed")
+            t = launcher_.wifi_thread
+
+        enabled = driver.wifi_enabled.wait(timeout)
+        if use_asyncio:
+            launcher_async.request_stop()
+        # The launcher commits the boot plan into the trace state after the
+        # WiFi enable, let it finish before the state is removed.
+        if t is not None and (enabled or use_asyncio):
+            t.join(timeout)
+
+    print(f"Replayed {len(driver.ioctls)} ioctls, {driver.commands_sent} commands")
+    if recorded is not None:
+        print(f"Recorded time-to-WiFi: {recorded * 1000:.1f}ms")
+    if enabled:
+        elapsed = (driver.wifi_enabled_ns - start_ns) / 1e9
+        print(f"Replayed time-to-WiFi: {elapsed * 1000:.1f}ms (time scale {time_scale})")
+    else:
+        print(f"WiFi was not enabled within {timeout}s")
+    unused = [e.name for e, used in zip(driver.ioctls, driver.used) if not used]
+    if unused:
+        print(f"{len(unused)} recorded ioctls were not replayed: {', '.join(unused)}")
+    for divergence in driver.divergences:
+        print(f"Divergence: {divergence}")
+    return 0 if enabled and not driver.divergences else 1
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("trace")
+    parser.add_argument(
+        "--time-scale",
+        type=float,
+        default=1.0,
+        help="Multiplier for recorded durations, 0 replays as fast as possible",
+    )
+    parser.add_argument("--asyncio", action="store_true", help="Replay with launcher_async")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+    logformat.configure_logger()
+    return replay(args.trace, args.time_scale, args.asyncio, args.timeout)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Generator of synthetic MTK patch file corpora.
+
+Files get realistic headers (build ID, fwver, patch info) and sizes, and
+ram_bt patches carry a BABEFACE/DEADBEEF build info block with a t-neptune
+version string, placed the way find_bluetooth_fw_ver expects it.
+
+    python3 bench/synthpatch.py /tmp/corpus --count 1000
+"""
+import argparse
+import os
+import random
+import struct
+import sys
+from typing import Optional
+
+# (name template, patch info, approximate size in bytes) of typical files in a
+# vendor firmware directory.
+TEMPLATES = [
+    ("soc1_0_ram_mcu_1_1_hdr{n}.bin", "110010f000000000", 180 * 1024),
+    ("soc1_0_ram_wifi_1_1_hdr{n}.bin", "110020f000000001", 1400 * 1024),
+    ("soc1_0_ram_bt_1_1_hdr{n}.bin", "110030f000000002", 350 * 1024),
+    ("soc1_0_patch_mcu_1_1_hdr{n}.bin", "1100400000000000", 96 * 1024),
+    ("WIFI_RAM_CODE_soc1_0_{n}.bin", "110050f000000003", 900 * 1024),
+]
+
+
+def make_patch(
+    fwver: int,
+    patchinfo: bytes,
+    size: int = 0x100,
+    build_id: str = "20200101000000a\n",
+    bt_version: Optional[str] = None,
+) -> bytes:
+    """Build a synthetic MTK patch file.
+
+    The header layout matches what patch.get_patch_build_id, get_patch_fwver
+    and get_patch_info expect. With `bt_version`, a BABEFACE/DEADBEEF build
+    info block holding the version string is placed at the end of the file.
+    """
+    if len(build_id) != 0x10:
+        raise Exception(f"Build ID must be 16 characters, got {len(build_id)}")
+    if len(patchinfo) != 8:
+        raise Exception(f"Patch info must be 8 bytes, got {len(patchinfo)}")
+    header = build_id.encode() + b"\x00" * 6 + struct.pack(">H", fwver) + patchinfo
+    trailer = b""
+    if bt_version is not None:
+        trailer = b"BABEFACE" + b"\x00" * 8 + f"{bt_version}\n".encode() + b"DEADBEEF"
+    padding = max(size - len(header) - len(trailer), 0)
+    return header + bytes(padding) + trailer
+
+
+def make_corpus_file(template: str, patchinfo: str, size: int, rng: random.Random) -> bytes:
+    bt_version = None
+    if "ram_bt" in template:
+        bt_version = f"t-neptune-{rng.randrange(10**6):06d}-SOC_CONSYS_MT6765"
+    data = bytearray(
+        make_patch(
+            fwver=0x8A00,
+            patchinfo=bytes.fromhex(patchinfo),
+            size=size,
+            build_id=f"2020{rng.randrange(10**10):010d}a\n",
+            bt_version=bt_version,
+        )
+    )
+    # Fill the body with incompressible data, the parsers shouldn't be able
+    # to take shortcuts on zero pages.
+    body_end = data.rfind(b"BABEFACE") if bt_version else len(data)
+    data[0x20:body_end] = rng.randbytes(body_end - 0x20)
+    return bytes(data)
+
+
+def generate(directory: str, count: int, scale: float = 1.0, seed: int = 0) -> list[str]:
+    """Write `count` synthetic patch files into `directory`.
+
+    File sizes follow TEMPLATES multiplied by `scale`, with +/- 20% variance.
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    filenames = []
+    for i in range(count):
+        template, patchinfo, size = TEMPLATES[i % len(TEMPLATES)]
+        filename = template.format(n=f"_{i:05d}")
+        size = max(int(size * scale * rng.uniform(0.8, 1.2)), 0x100)
+        with open(os.path.join(directory, filename), "wb") as f:
+            f.write(make_corpus_file(template, patchinfo, size, rng))
+        filenames.append(filename)
+    return filenames
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--scale", type=float, default=1.0, help="file size multiplier")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    filenames = generate(args.directory, args.count, args.scale, args.seed)
+    print(f"Wrote {len(filenames)} files to {args.directory}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,308 @@
+import argparse
+import dataclasses
+import json
+import os
+import sys
+import threading
+from typing import Optional
+import logformat
+
+logger = logformat.get_logger()
+
+BOOT_PLAN_PATH = "/var/cache/wmt-pyloader/bootplan.json"
+BOOT_PLAN_VERSION = 1
+
+
+@dataclasses.dataclass
+class PlannedFile:
+    # Patch file name, relative to the lookup directory.
+    filename: str
+    # File metadata the planned request was built for.
+    inode: int
+    size: int
+    mtime_ns: int
+
+    def matches(self, st: os.stat_result) -> bool:
+        return (
+            self.inode == st.st_ino
+            and self.size == st.st_size
+            and self.mtime_ns == st.st_mtime_ns
+        )
+
+
+@dataclasses.dataclass
+class PlannedRequest:
+    # ioctl to issue, with the pre-built request buffer as its argument.
+    ioctl: int
+    request: bytes
+    # Patch file the request refers to.
+    file: PlannedFile
+
+
+@dataclasses.dataclass
+class CommandPlan:
+    # GET_CHIP_INFO results the requests were chosen for.
+    chip_id: int
+    fwver: int
+    # Argument of SET_PATCH_NUM, None for commands that don't set it.
+    patch_num: Optional[int]
+    requests: list[PlannedRequest]
+
+
+@dataclasses.dataclass
+class BootPlan:
+    """Facts discovered during a successful boot, and the exact patch
+    requests sent to the driver."""
+
+    # Loader: SOC chip ID, identify_chip_type_magic result and ADIE chip ID.
+    soc_chip_id: Optional[int] = None
+    chip_type: Optional[int] = None
+    adie_chip_id: Optional[int] = None
+    # Launcher: QUERY_CHIPID result, HW version and SET_STP_MODE config.
+    chip_id: Optional[int] = None
+    hwver: Optional[int] = None
+    stp_config: Optional[int] = None
+    # Firmware directory and its mtime, changes whenever files are added,
+    # removed or renamed and the globs could match differently.
+    directory: Optional[str] = None
+    directory_mtime_ns: Optional[int] = None
+    # Planned requests per launcher command (e.g. srh_rom_patch).
+    commands: dict[str, CommandPlan] = dataclasses.field(default_factory=dict)
+
+    def complete(self) -> bool:
+        return (
+            None not in (self.soc_chip_id, self.adie_chip_id, self.chip_id, self.stp_config)
+            and self.directory_mtime_ns is not None
+            and len(self.commands) > 0
+        )
+
+    def files_valid(self) -> bool:
+        """Check that the firmware directory and every planned patch file
+        are unchanged since the plan was recorded."""
+        try:
+            if os.stat(self.directory).st_mtime_ns != self.directory_mtime_ns:
+                return False
+            for command in self.commands.values():
+                for r in command.requests:
+                    st = os.stat(os.path.join(self.directory, r.file.filename))
+                    if not r.file.matches(st):
+                        return False
+        except (OSError, TypeError):
+            return False
+        return True
+
+    def to_json(self) -> dict:
+        d = dataclasses.asdict(self)
+        for command in d["commands"].values():
+            for r in command["requests"]:
+                r["request"] = r["request"].hex()
+        return d
+
+    @staticmethod
+    def from_json(d: dict) -> "BootPlan":
+        d = dict(d)
+        d["commands"] = {
+            name: CommandPlan(
+                chip_id=c["chip_id"],
+                fwver=c["fwver"],
+                patch_num=c["patch_num"],
+                requests=[
+                    PlannedRequest(
+                        ioctl=r["ioctl"],
+                        request=bytes.fromhex(r["request"]),
+                        file=PlannedFile(**r["file"]),
+                    )
+                    for r in c["requests"]
+                ],
+            )
+            for name, c in d["commands"].items()
+        }
+        return BootPlan(**d)
+
+
+def load(path: str) -> Optional[BootPlan]:
+    """Load a boot plan from disk. A missing or invalid plan is discarded."""
+    try:
+        with open(path, "rt") as f:
+            data = json.load(f)
+        if data["version"] != BOOT_PLAN_VERSION:
+            raise Exception(f"unsupported plan version {data['version']}")
+        plan = BootPlan.from_json(data["plan"])
+        if not plan.complete():
+            raise Exception("plan is incomplete")
+        return plan
+    except FileNotFoundError:
+        logger.debug(f"No boot plan at {path}")
+    except Exception as e:
+        logger.warning(f"Discarding boot plan {path}: {e}")
+    return None
+
+
+def save(plan: BootPlan, path: str):
+    """Atomically write a boot plan to disk."""
+    data = {"version": BOOT_PLAN_VERSION, "plan": plan.to_json()}
+    tmppath = f"{path}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmppath, "wt") as f:
+            json.dump(data, f)
+        os.replace(tmppath, path)
+    except OSError as e:
+        logger.warning(f"Failed to write boot plan {path}: {e}")
+
+
+class BootPlanner:
+    """Replays the boot plan of a previous boot, and records the plan of the
+    current one.
+
+    The loader and launcher ask for the planned values of each phase with
+    `planned`, passing what they already had to query from the driver. A
+    mismatch drops the plan, and the caller falls back to full discovery.
+    Every phase reports what it ended up using with `record`, and `commit`
+    writes the new plan once the boot succeeded.
+    """
+
+    def __init__(self, path: str = BOOT_PLAN_PATH, enabled: bool = True):
+        self.path = path
+        self.enabled = enabled
+        self.plan: Optional[BootPlan] = None
+        self.recording = BootPlan()
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if not self.loaded:
+                self.plan = load(self.path) if self.enabled else None
+                self.loaded = True
+
+    def get_plan(self) -> Optional[BootPlan]:
+        """Get the plan of the previous boot, if it's still usable."""
+        self.load()
+        return self.plan
+
+    def invalidate(self, reason: str):
+        """Drop the plan for the rest of this boot, falling back to discovery."""
+        with self.lock:
+            if self.plan is not None:
+                logger.info(f"Boot plan invalidated: {reason}")
+                self.plan = None
+
+    def planned(self, **expected) -> Optional[BootPlan]:
+        """Get the plan if its fields match `expected`, else invalidate it."""
+        plan = self.get_plan()
+        if plan is None:
+            return None
+        for field, value in expected.items():
+            if getattr(plan, field) != value:
+                self.invalidate(f"{field} is {value}, planned {getattr(plan, field)}")
+                return None
+        return plan
+
+    def planned_command(
+        self, command: str, directory: str, chip_id: int, fwver: int
+    ) -> Optional[CommandPlan]:
+        """Get the planned requests for a launcher command, if the chip info
+        and the firmware files in `directory` still match."""
+        plan = self.planned(directory=directory)
+        if plan is None:
+            return None
+        c = plan.commands.get(command)
+        if c is None:
+            self.invalidate(f"no requests planned for {command}")
+            return None
+        if (c.chip_id, c.fwver) != (chip_id, fwver):
+            self.invalidate(
+                f"{command}: chip_id={hex(chip_id)} fwver={hex(fwver)}, planned "
+                f"chip_id={hex(c.chip_id)} fwver={hex(c.fwver)}"
+            )
+            return None
+        if not plan.files_valid():
+            self.invalidate("firmware files changed")
+            return None
+        return c
+
+    def record(self, **fields):
+        with self.lock:
+            for field, value in fields.items():
+                setattr(self.recording, field, value)
+
+    def record_command(self, command: str, directory: str, plan: CommandPlan):
+        with self.lock:
+            self.recording.commands[command] = plan
+            self.recording.directory = directory
+            self.recording.directory_mtime_ns = os.stat(directory).st_mtime_ns
+
+    def commit(self):
+        """Persist the plan of this boot, if it's complete and changed."""
+        if not self.enabled:
+            return
+        with self.lock:
+            if not self.recording.complete():
+                logger.debug("Boot plan incomplete, not saving")
+                return
+            if self.recording == self.plan:
+                return
+            save(self.recording, self.path)
+            logger.info(f"Saved boot plan to {self.path}")
+
+
+def planned_file(directory: str, filename: str) -> PlannedFile:
+    st = os.stat(os.path.join(directory, filename))
+    return PlannedFile(filename, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+_planner: Optional[BootPlanner] = None
+_planner_lock = threading.Lock()
+
+
+def get_planner() -> BootPlanner:
+    """Get the process-wide boot planner."""
+    global _planner
+    with _planner_lock:
+        if _planner is None:
+            _planner = BootPlanner()
+        return _planner
+
+
+def set_planner(planner: BootPlanner):
+    """Replace the process-wide boot planner, e.g. to use another path."""
+    global _planner
+    with _planner_lock:
+        _planner = planner
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="bootplan", description="Manage the cached boot plan")
+    parser.add_argument("command", choices=["show", "clear"])
+    parser.add_argument("--plan", default=BOOT_PLAN_PATH)
+    args = parser.parse_args()
+    logformat.configure_logger()
+
+    if args.command == "clear":
+        try:
+            os.remove(args.plan)
+        except FileNotFoundError:
+            pass
+        print(f"Removed {args.plan}")
+        return 0
+
+    plan = load(args.plan)
+    if plan is None:
+        print(f"No usable boot plan at {args.plan}")
+        return 1
+    print(
+        f"SOC chip ID={hex(plan.soc_chip_id)} ADIE chip ID={hex(plan.adie_chip_id)} "
+        f"chip ID={hex(plan.chip_id)} stp config={hex(plan.stp_config)}"
+    )
+    state = "valid" if plan.files_valid() else "stale"
+    print(f"Firmware directory {plan.directory}: {state}")
+    for name, c in plan.commands.items():
+        print(f"{name}: fwver={hex(c.fwver)} patch_num={c.patch_num}")
+        for r in c.requests:
+            print(f"    {r.file.filename}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
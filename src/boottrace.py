@@ -0,0 +1,200 @@
+import contextlib
+import dataclasses
+import json
+import os
+import threading
+import time
+from typing import Callable, Optional
+import logformat
+
+logger = logformat.get_logger()
+
+
+@dataclasses.dataclass
+class Span:
+    name: str
+    category: str
+    # CLOCK_MONOTONIC timestamps, in nanoseconds.
+    start_ns: int
+    end_ns: int
+    tid: int
+    args: dict
+
+
+class Tracer:
+    """Collects timed spans of the boot process.
+
+    Spans are recorded with CLOCK_MONOTONIC timestamps and can be exported as
+    Chrome trace-event JSON (viewable in Perfetto / chrome://tracing), or as a
+    plain summary table.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans: list[Span] = []
+        self.thread_names: dict[int, str] = {}
+        self.start_ns = 0
+        self.trace_path: Optional[str] = None
+        self.print_summary = False
+        # Called on every dump, after the trace outputs were written.
+        self.dump_hooks: list[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def enable(self, trace_path: Optional[str] = None, print_summary: bool = False):
+        self.enabled = True
+        self.start_ns = time.monotonic_ns()
+        self.trace_path = trace_path
+        self.print_summary = print_summary
+
+    def record(self, name: str, category: str, start_ns: int, end_ns: int, args: dict):
+        thread = threading.current_thread()
+        self.record_on(
+            name, category, start_ns, end_ns, thread.native_id or 0, thread.name, args
+        )
+
+    def record_on(
+        self,
+        name: str,
+        category: str,
+        start_ns: int,
+        end_ns: int,
+        tid: int,
+        thread_name: str,
+        args: dict,
+    ):
+        """Record a span on an explicit track, e.g. for events from the kernel."""
+        span = Span(name, category, start_ns, end_ns, tid, args)
+        with self._lock:
+            self.spans.append(span)
+            self.thread_names[tid] = thread_name
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, args: dict):
+        start_ns = time.monotonic_ns()
+        try:
+            yield args
+        finally:
+            self.record(name, category, start_ns, time.monotonic_ns(), args)
+
+    def instant(self, name: str, category: str, args: dict):
+        now = time.monotonic_ns()
+        self.record(name, category, now, now, args)
+
+    def snapshot(self) -> list[Span]:
+        """Get a copy of all spans recorded so far."""
+        with self._lock:
+            return list(self.spans)
+
+    def to_chrome(self) -> dict:
+        """Convert the recorded spans to the Chrome trace-event format."""
+        pid = os.getpid()
+        events = []
+        with self._lock:
+            spans = list(self.spans)
+            thread_names = dict(self.thread_names)
+        for tid, thread_name in thread_names.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": thread_name},
+                }
+            )
+        for span in spans:
+            event = {
+                "name": span.name,
+                "cat": span.category,
+                "ts": span.start_ns / 1000,
+                "pid": pid,
+                "tid": span.tid,
+                "args": span.args,
+            }
+            if span.start_ns == span.end_ns:
+                event["ph"] = "i"
+                # Kernel log lines are too dense to be drawn across all tracks.
+                event["s"] = "t" if span.category == "kmsg" else "g"
+            else:
+                event["ph"] = "X"
+                event["dur"] = (span.end_ns - span.start_ns) / 1000
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def summary(self) -> str:
+        """Format a table of span counts and durations, grouped by name."""
+        spans = self.snapshot()
+
+        groups: dict[tuple[str, str], list[Span]] = {}
+        for span in spans:
+            groups.setdefault((span.category, span.name), []).append(span)
+
+        rows = []
+        for (category, name), group in groups.items():
+            durations = [(s.end_ns - s.start_ns) / 1e6 for s in group]
+            first = (min(s.start_ns for s in group) - self.start_ns) / 1e6
+            rows.append((category, name, len(group), sum(durations), max(durations), first))
+        rows.sort(key=lambda r: r[3], reverse=True)
+
+        lines = [
+            f"{'category':<10} {'name':<40} {'count':>5} {'total ms':>10} {'max ms':>10} {'first @ms':>10}"
+        ]
+        for category, name, count, total, longest, first in rows:
+            lines.append(
+                f"{category:<10} {name:<40} {count:>5} {total:>10.1f} {longest:>10.1f} {first:>10.1f}"
+            )
+        return "\n".join(lines)
+
+    def dump(self):
+        """Write out the configured trace outputs.
+
+        This may be called multiple times, every call overwrites the previous
+        output with all spans recorded so far.
+        """
+        if not self.enabled:
+            return
+        if self.trace_path is not None:
+            try:
+                with open(self.trace_path, "wt") as f:
+                    json.dump(self.to_chrome(), f)
+                logger.info(f"Boot trace written to {self.trace_path}")
+            except OSError:
+                logger.exception(f"Failed to write boot trace to {self.trace_path}")
+        if self.print_summary:
+            print(self.summary(), flush=True)
+        for hook in self.dump_hooks:
+            hook()
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+def enable(trace_path: Optional[str] = None, print_summary: bool = False):
+    """Start recording spans. Outputs are written out by `dump`."""
+    _tracer.enable(trace_path, print_summary)
+
+
+def span(name: str, category: str = "boot", **args):
+    """Time the enclosed block. This is a no-op when tracing is disabled.
+
+    Extra keyword arguments are attached to the span, and the yielded dict
+    can be used to attach results that are only known inside the block.
+    """
+    if not _tracer.enabled:
+        # A fresh args dict per call, callers may fill it from any thread.
+        return contextlib.nullcontext({})
+    return _tracer.span(name, category, args)
+
+
+def instant(name: str, category: str = "boot", **args):
+    """Record a point-in-time event."""
+    if _tracer.enabled:
+        _tracer.instant(name, category, args)
+
+
+def dump():
+    _tracer.dump()
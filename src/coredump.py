@@ -0,0 +1,323 @@
+import argparse
+import dataclasses
+import os
+import select
+import sys
+import threading
+import time
+import zlib
+from typing import Optional
+import devnode
+import kmsg
+import launcher
+import logformat
+from ioctl import do_ioctl
+
+logger = logformat.get_logger()
+
+DUMP_DIR = "/var/lib/wmt-pyloader/coredumps"
+# Character device the driver streams the firmware coredump through. The
+# name depends on the driver build, it can be changed with --coredump-node.
+DUMP_NODE = "/dev/wmt_coredump"
+DUMP_PREFIX = "wmt-coredump-"
+PARTIAL_SUFFIX = ".partial"
+# Passed to WMT_IOCTL_WMT_COREDUMP_CTRL, 0 disables coredumps.
+COREDUMP_MODE = 1
+# Register ranges for WMT_IOCTL_DYNAMIC_DUMP_CTRL, in the driver's format.
+# Only sent when set.
+DYNAMIC_DUMP_CONFIG: Optional[bytes] = None
+# "zlib" writes .gz files, "lzma" smaller .xz files at a higher CPU cost.
+COMPRESSION = "zlib"
+ZLIB_LEVEL = 6
+# Preset 1 keeps the compressor under 10MB.
+LZMA_PRESET = 1
+# Room left below MAX_DUMP_SIZE for the output of input the xz compressor
+# still holds.
+LZMA_BUFFER = 1024 * 1024
+# Bytes read from the dump node at a time, this (plus the compressor state)
+# is all of the dump that's ever held in memory.
+CHUNK_SIZE = 64 * 1024
+# Compressed bytes written per dump, data past this is read and dropped.
+MAX_DUMP_SIZE = 32 * 1024 * 1024
+# Older dumps are removed to stay within these limits.
+MAX_DUMPS = 4
+MAX_TOTAL_SIZE = 64 * 1024 * 1024
+# Seconds to wait for the dump node to appear after an assert.
+NODE_TIMEOUT = 5.0
+# Seconds without data after which a dump is considered complete.
+IDLE_TIMEOUT = 5.0
+
+
+@dataclasses.dataclass
+class Coredump:
+    path: str
+    # Kernel message the capture was started for.
+    reason: str
+    # Bytes read from the dump node.
+    size: int = 0
+    compressed_size: int = 0
+    # Bytes read after MAX_DUMP_SIZE was reached, which were not written.
+    dropped: int = 0
+    elapsed: float = 0.0
+
+
+class _Compressor:
+    """Streaming compressor for one dump."""
+
+    def __init__(self, compression: str):
+        if compression == "zlib":
+            # wbits=31 writes a gzip stream, readable with zcat. Flushing
+            # after every chunk keeps nothing buffered, so the size cap is
+            # exact, and a dump cut short by a reboot still decompresses up
+            # to its last chunk.
+            self.obj = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, 31)
+            self.ext = ".gz"
+            self.flush_mode: Optional[int] = zlib.Z_SYNC_FLUSH
+            # Incompressible data grows by a few bytes per block.
+            self.reserve = CHUNK_SIZE + 1024
+        elif compression == "lzma":
+            import lzma
+
+            self.obj = lzma.LZMACompressor(lzma.FORMAT_XZ, preset=LZMA_PRESET)
+            self.ext = ".xz"
+            # xz can't flush mid-stream, it holds back some input.
+            self.flush_mode = None
+            self.reserve = CHUNK_SIZE + LZMA_BUFFER
+        else:
+            raise Exception(f"Unknown coredump compression {compression}")
+
+    def compress(self, data) -> bytes:
+        out = self.obj.compress(data)
+        if self.flush_mode is not None:
+            out += self.obj.flush(self.flush_mode)
+        return out
+
+    def finish(self) -> bytes:
+        return self.obj.flush()
+
+
+def list_dumps(directory: str) -> list[os.DirEntry]:
+    """Dumps in `directory`, oldest first. Includes partial dumps left by
+    captures interrupted by a reboot."""
+    try:
+        entries = [
+            e
+            for e in os.scandir(directory)
+            if e.name.startswith(DUMP_PREFIX) and e.is_file(follow_symlinks=False)
+        ]
+    except FileNotFoundError:
+        return []
+    return sorted(entries, key=lambda e: (e.stat().st_mtime, e.name))
+
+
+def rotate(directory: str, exclude: Optional[str] = None):
+    """Remove the oldest dumps, to make room for a new one of up to
+    MAX_DUMP_SIZE bytes within MAX_DUMPS and MAX_TOTAL_SIZE. The dump named
+    `exclude`, the one being added, is kept."""
+    dumps = [e for e in list_dumps(directory) if e.name != exclude]
+    total = sum(e.stat().st_size for e in dumps)
+    while dumps and (len(dumps) >= MAX_DUMPS or total + MAX_DUMP_SIZE > MAX_TOTAL_SIZE):
+        oldest = dumps.pop(0)
+        size = oldest.stat().st_size
+        try:
+            os.remove(oldest.path)
+        except OSError as e:
+            logger.warning(f"Failed to remove old coredump {oldest.path}: {e}")
+        else:
+            logger.info(f"Removed old coredump {oldest.name}")
+        total -= size
+
+
+def capture(
+    node: str, directory: str, reason: str = "", compression: Optional[str] = None
+) -> Coredump:
+    """Stream a coredump from `node` into a compressed file in `directory`.
+
+    The dump is read and compressed CHUNK_SIZE bytes at a time, and written
+    to a .partial file which is renamed once the node reaches EOF or stays
+    idle for IDLE_TIMEOUT.
+    """
+    os.makedirs(directory, exist_ok=True)
+    compressor = _Compressor(compression or COMPRESSION)
+    # Nanoseconds keep dumps taken within the same second from replacing
+    # each other.
+    now_ns = time.time_ns()
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now_ns // 1_000_000_000))
+    name = f"{DUMP_PREFIX}{stamp}-{now_ns % 1_000_000_000:09d}{compressor.ext}"
+    dump = Coredump(os.path.join(directory, name), reason)
+    tmppath = dump.path + PARTIAL_SUFFIX
+    start = time.monotonic()
+
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    fd = os.open(node, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+    try:
+        with open(tmppath, "wb") as f:
+            while True:
+                r, _, _ = select.select([fd], [], [], IDLE_TIMEOUT)
+                if not r:
+                    break
+                try:
+                    n = os.readv(fd, [buf])
+                except BlockingIOError:
+                    continue
+                if n == 0:
+                    break
+                dump.size += n
+                # Stop writing while the file is sure to stay below
+                # MAX_DUMP_SIZE. The rest of the dump is still read, so the
+                # driver isn't left waiting.
+                if dump.compressed_size + compressor.reserve > MAX_DUMP_SIZE:
+                    dump.dropped += n
+                    continue
+                data = compressor.compress(view[:n])
+                f.write(data)
+                dump.compressed_size += len(data)
+            data = compressor.finish()
+            f.write(data)
+            dump.compressed_size += len(data)
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        os.close(fd)
+    dump.elapsed = time.monotonic() - start
+
+    if dump.size == 0:
+        os.remove(tmppath)
+    else:
+        # Older dumps are only removed once there is a new one to keep.
+        rotate(directory, exclude=os.path.basename(tmppath))
+        os.replace(tmppath, dump.path)
+    return dump
+
+
+class CoredumpCapture:
+    """Enables firmware coredumps in the driver, and captures them to disk
+    when kmsg reports a firmware assert."""
+
+    def __init__(self, directory: str, node: str):
+        self.directory = directory
+        self.node = node
+        self.lock = threading.Lock()
+        self.capturing = False
+        # Captured dumps, in order.
+        self.dumps: list[Coredump] = []
+
+    def configure_driver(self, fd: int):
+        """Launcher setup hook, enables coredumps on WMT_DEV."""
+        err = do_ioctl(fd, launcher.WMT_IOCTL_WMT_COREDUMP_CTRL, COREDUMP_MODE)
+        if err < 0:
+            logger.warning(f"Failed to enable firmware coredumps: {err}")
+            return
+        if DYNAMIC_DUMP_CONFIG is not None:
+            err = do_ioctl(fd, launcher.WMT_IOCTL_DYNAMIC_DUMP_CTRL, DYNAMIC_DUMP_CONFIG)
+            if err < 0:
+                logger.warning(f"Failed to configure the dynamic dump: {err}")
+        logger.info(f"Firmware coredumps enabled, saving to {self.directory}")
+
+    def _on_assert(self, event: kmsg.KmsgEvent):
+        # The driver logs several lines per assert, they all go to the same
+        # capture.
+        with self.lock:
+            if self.capturing:
+                return
+            self.capturing = True
+        reason = event.record.message.strip()
+        t = threading.Thread(target=self._capture, args=(reason,), daemon=True)
+        t.start()
+
+    def _capture(self, reason: str):
+        try:
+            logger.warning(f"Firmware assert: {reason}")
+            if not devnode.wait_for_node(self.node, NODE_TIMEOUT):
+                logger.error(f"{self.node} did not appear, no coredump captured")
+                return
+            dump = capture(self.node, self.directory, reason)
+            if dump.size == 0:
+                logger.warning(f"No coredump data on {self.node}")
+                return
+            self.dumps.append(dump)
+            logger.warning(
+                f"Saved firmware coredump to {dump.path}: {dump.size} bytes, "
+                f"{dump.compressed_size} compressed, in {dump.elapsed:.1f}s"
+            )
+            if dump.dropped:
+                logger.warning(
+                    f"Coredump truncated, {dump.dropped} bytes past {MAX_DUMP_SIZE} were dropped"
+                )
+        except Exception:
+            logger.exception("Coredump capture failed")
+        finally:
+            with self.lock:
+                self.capturing = False
+
+
+_capture: Optional[CoredumpCapture] = None
+
+
+def enable(directory: str = DUMP_DIR, node: str = DUMP_NODE):
+    """Enable coredumps once the launcher opens WMT_DEV, and capture them
+    on firmware asserts."""
+    global _capture
+    _capture = CoredumpCapture(directory, node)
+    launcher.add_setup_hook(_capture.configure_driver)
+    kmsg.subscribe(_capture._on_assert, ["firmware_assert"])
+
+
+def get_capture() -> Optional[CoredumpCapture]:
+    return _capture
+
+
+def trigger_assert() -> int:
+    """Ask the driver to assert the firmware, to test coredump capture."""
+    fd = os.open(launcher.WMT_DEV, os.O_RDWR | os.O_CLOEXEC)
+    try:
+        return do_ioctl(fd, launcher.WMT_IOCTL_WMT_STP_ASSERT_CTRL, 1)
+    finally:
+        os.close(fd)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="coredump", description="Firmware coredumps")
+    parser.add_argument("--dir", default=DUMP_DIR, help=f"dump directory (default {DUMP_DIR})")
+    parser.add_argument("--node", default=DUMP_NODE, help=f"dump node (default {DUMP_NODE})")
+    parser.add_argument(
+        "--compression", choices=["zlib", "lzma"], help=f"default {COMPRESSION}"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="list saved coredumps")
+    subparsers.add_parser("capture", help="capture a coredump from the dump node now")
+    subparsers.add_parser(
+        "assert",
+        help="make the firmware assert with WMT_IOCTL_WMT_STP_ASSERT_CTRL, to test capturing",
+    )
+    args = parser.parse_args()
+    logformat.configure_logger()
+
+    if args.command == "list":
+        for e in list_dumps(args.dir):
+            mtime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(e.stat().st_mtime))
+            print(f"{mtime}  {e.stat().st_size:>10}  {e.name}")
+        return 0
+
+    if args.command == "capture":
+        dump = capture(args.node, args.dir, "manual capture", args.compression)
+        if dump.size == 0:
+            logger.error(f"No coredump data on {args.node}")
+            return 1
+        logger.info(
+            f"Saved {dump.path}: {dump.size} bytes, {dump.compressed_size} compressed, "
+            f"{dump.dropped} dropped"
+        )
+        return 0
+
+    err = trigger_assert()
+    if err < 0:
+        logger.error(f"WMT_IOCTL_WMT_STP_ASSERT_CTRL failed: {err}")
+        return 1
+    logger.info("Firmware assert requested")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+import ctypes
+import os
+import select
+import time
+from typing import Optional
+import boottrace
+import logformat
+
+logger = logformat.get_logger()
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# Poll interval used when inotify is unavailable.
+FALLBACK_POLL_INTERVAL = 0.05
+
+
+def inotify_watch(directory: str, mask: int) -> int:
+    """Create a non-blocking inotify fd watching `directory` for `mask` events.
+
+    Raises OSError if inotify is unavailable.
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError) as e:
+        raise OSError(f"inotify unavailable: {e}")
+    fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    wd = inotify_add_watch(fd, os.fsencode(directory), mask)
+    if wd < 0:
+        os.close(fd)
+        raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+    return fd
+
+
+def drain(fd: int):
+    """Discard all pending events of an inotify fd."""
+    while True:
+        try:
+            os.read(fd, 4096)
+        except BlockingIOError:
+            return
+
+
+class DeviceNodeWatcher:
+    """Watches the parent directory of a device node with inotify.
+
+    The watch is set up before checking for the node, so a node created in
+    between can't be missed. `fileno` can be passed to select() or an event
+    loop; call `poll` once it's readable.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = -1
+        try:
+            self.fd = inotify_watch(os.path.dirname(path), IN_CREATE | IN_MOVED_TO | IN_ATTRIB)
+        except OSError as e:
+            logger.debug(f"inotify unavailable for {path} ({e}), falling back to polling")
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def poll(self) -> bool:
+        """Drain pending events and check whether the node exists."""
+        # Event contents don't matter, any change in the directory is a
+        # reason to check for the node again.
+        if self.fd >= 0:
+            drain(self.fd)
+        return self.exists()
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        """Wait for the node to appear, returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.poll():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            if self.fd >= 0:
+                select.select([self.fd], [], [], remaining)
+            else:
+                interval = FALLBACK_POLL_INTERVAL
+                time.sleep(interval if remaining is None else min(interval, remaining))
+        return True
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def wait_for_node(path: str, timeout: Optional[float]) -> bool:
+    """Block until the device node at `path` exists, or the timeout expires.
+
+    Returns True as soon as the node appears, False on timeout. A timeout of
+    None waits forever.
+    """
+    if os.path.exists(path):
+        return True
+    with boottrace.span(f"wait {path}", "devnode"):
+        with DeviceNodeWatcher(path) as watcher:
+            return watcher.wait(timeout)
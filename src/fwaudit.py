@@ -0,0 +1,279 @@
+import argparse
+import concurrent.futures
+import csv
+import dataclasses
+import fnmatch
+import json
+import os
+import posixpath
+import sys
+from typing import Optional
+import fwverify
+import launcher
+import patchindex
+import patchsource
+import logformat
+
+logger = logformat.get_logger()
+
+# Chip IDs audited by default: every ID the prefix tables know about.
+DEFAULT_CHIP_IDS = sorted(
+    {
+        chip_id
+        for table in (launcher.ROM_PREFIXES, launcher.ROM_PATCH_PREFIXES)
+        for ids in table.values()
+        for chip_id in ids
+    }
+)
+
+VERDICT_BOOTS = "would boot"
+VERDICT_MISSING = "missing file"
+VERDICT_MISMATCH = "version mismatch"
+VERDICT_INVALID = "invalid patch"
+VERDICT_UNSUPPORTED = "unsupported chip"
+
+
+@dataclasses.dataclass
+class ChipAudit:
+    tree: str
+    chip_id: str
+    rom_prefix: str = ""
+    patch_prefix: str = ""
+    suffix: str = ""
+    # Patch fwver values found, hex strings.
+    fwvers: list[str] = dataclasses.field(default_factory=list)
+    rom_patches: list[str] = dataclasses.field(default_factory=list)
+    patches: list[str] = dataclasses.field(default_factory=list)
+    verdict: str = VERDICT_BOOTS
+    detail: str = ""
+
+
+def _glob(listing: list[str], pattern: str) -> list[str]:
+    # Same matching as PatchIndex.glob.
+    return sorted(
+        f
+        for f in fnmatch.filter(listing, pattern)
+        if not f.startswith(".") or pattern.startswith(".")
+    )
+
+
+def _check_entries(
+    audit: ChipAudit, entries: list[patchindex.PatchIndexEntry], rom: bool
+) -> Optional[str]:
+    """Run the checks the launcher runs before sending each request, returns
+    the first problem found."""
+    for e in entries:
+        if e.error is not None:
+            return e.error
+        if rom and "ram_bt" in e.filename and e.bt_version is None:
+            return e.bt_error
+        if rom and "ram_bt" not in e.filename and e.build_id is None:
+            return e.build_id_error
+        try:
+            if rom:
+                launcher.rom_patch_request_fields(e.patchinfo, e.filename)
+            else:
+                launcher.patch_request_fields(e.patchinfo[:4], e.filename)
+        except Exception as ex:
+            return f"{e.filename}: {ex}"
+    return None
+
+
+def audit_chip(
+    tree: str,
+    listing: list[str],
+    entries: dict[str, patchindex.PatchIndexEntry],
+    chip_id: int,
+    fwver: Optional[int],
+) -> ChipAudit:
+    audit = ChipAudit(tree, hex(chip_id))
+    try:
+        audit.rom_prefix = launcher.get_rom_patch_prefix(chip_id)
+        audit.patch_prefix = launcher.get_patch_prefix(chip_id)
+        audit.suffix = launcher.get_patch_suffix(chip_id)
+    except Exception as e:
+        audit.verdict = VERDICT_UNSUPPORTED
+        audit.detail = str(e)
+        return audit
+
+    # The globs used by the srh_rom_patch and srh_patch handlers.
+    audit.rom_patches = _glob(listing, f"{audit.rom_prefix}_ram_*_{audit.suffix}*")
+    audit.patches = _glob(listing, f"{audit.patch_prefix}_patch*{audit.suffix}*")
+    for name, files in (("ROM patch", audit.rom_patches), ("patch", audit.patches)):
+        if not files:
+            audit.verdict = VERDICT_MISSING
+            audit.detail = f"no {name} matches"
+            return audit
+
+    rom_entries = [entries[f] for f in audit.rom_patches]
+    patch_entries = [entries[f] for f in audit.patches]
+    problem = _check_entries(audit, rom_entries, True) or _check_entries(
+        audit, patch_entries, False
+    )
+    if problem is not None:
+        audit.verdict = VERDICT_INVALID
+        audit.detail = problem
+        return audit
+
+    fwvers = sorted({e.fwver for e in rom_entries + patch_entries})
+    audit.fwvers = [hex(v) for v in fwvers]
+    if len(fwvers) > 1:
+        audit.verdict = VERDICT_MISMATCH
+        audit.detail = "patches disagree on fwver"
+    elif fwver is not None and fwvers[0] != fwver:
+        audit.verdict = VERDICT_MISMATCH
+        audit.detail = f"patches are for fwver {hex(fwvers[0])}, chip has {hex(fwver)}"
+    return audit
+
+
+def audit_source(
+    spec: str, walk: bool, chip_ids: list[int], fwver: Optional[int]
+) -> list[ChipAudit]:
+    """Audit the firmware tree at `spec` (SOURCE[:DIR], see patchsource), or
+    with `walk` every tree below it, for every chip ID. Runs in a worker.
+
+    All patch headers of a source are read in one go, so compressed
+    archives are only streamed through once.
+    """
+    path, directory = patchsource.split_spec(spec)
+    with patchsource.open_source(path, recursive=walk) as source:
+        files = source.files()
+        trees = [directory]
+        if walk:
+            trees = [
+                t
+                for t in patchsource.find_trees(files)
+                if not directory or t == directory or t.startswith(f"{directory}/")
+            ]
+        names = [
+            name
+            for name in files
+            if posixpath.dirname(name) in trees and patchsource.is_patch(posixpath.basename(name))
+        ]
+        entries = patchsource.parse_entries(source, names)
+
+        results = []
+        for tree in trees:
+            listing = patchsource.listing(files, tree)
+            tree_entries = {
+                posixpath.basename(name): e
+                for name, e in entries.items()
+                if posixpath.dirname(name) == tree
+            }
+            label = source.label(tree) if tree else path
+            for chip_id in chip_ids:
+                results.append(audit_chip(label, listing, tree_entries, chip_id, fwver))
+        return results
+
+
+def find_trees(roots: list[str]) -> list[str]:
+    """Find every directory below `roots` holding firmware files."""
+    trees = []
+    for root in roots:
+        for dirpath, _, filenames in os.walk(root):
+            if any(fwverify.is_candidate(f) for f in filenames):
+                trees.append(dirpath)
+    return sorted(trees)
+
+
+def audit(
+    specs: list[str],
+    walk: bool,
+    chip_ids: list[int],
+    fwver: Optional[int],
+    max_workers: Optional[int],
+) -> list[ChipAudit]:
+    # Plain directories are split into one job per tree. Archives and
+    # images are audited by a single worker each, walking them as needed.
+    jobs = []
+    for spec in specs:
+        if walk and os.path.isdir(spec):
+            jobs.extend((tree, False) for tree in find_trees([spec]))
+        else:
+            jobs.append((spec, walk))
+
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(audit_source, spec, walk, chip_ids, fwver): spec for spec, walk in jobs
+        }
+        for future in concurrent.futures.as_completed(futures):
+            tree = futures[future]
+            try:
+                results.extend(future.result())
+            except Exception as e:
+                logger.warning(f"Failed to audit {tree}: {e}")
+    results.sort(key=lambda a: (a.tree, int(a.chip_id, 16)))
+    return results
+
+
+def to_json(results: list[ChipAudit]) -> dict:
+    """Per-chip verdicts, and a chip ID x tree matrix of verdicts."""
+    matrix: dict[str, dict[str, str]] = {}
+    for a in results:
+        matrix.setdefault(a.chip_id, {})[a.tree] = a.verdict
+    return {"matrix": matrix, "results": [dataclasses.asdict(a) for a in results]}
+
+
+def write_csv(results: list[ChipAudit], f):
+    fields = [field.name for field in dataclasses.fields(ChipAudit)]
+    writer = csv.DictWriter(f, fieldnames=fields)
+    writer.writeheader()
+    for a in results:
+        row = dataclasses.asdict(a)
+        for key in ("fwvers", "rom_patches", "patches"):
+            row[key] = " ".join(row[key])
+        writer.writerow(row)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="fwaudit", description="Audit firmware trees for chip compatibility"
+    )
+    parser.add_argument(
+        "sources",
+        nargs="+",
+        metavar="SOURCE",
+        help="firmware directory, tar/zip archive or ext4 image, optionally followed by :DIR",
+    )
+    parser.add_argument(
+        "--walk",
+        action="store_true",
+        help="audit every directory with firmware files below SOURCE",
+    )
+    parser.add_argument(
+        "--chip",
+        action="append",
+        type=lambda v: int(v, 0),
+        help="chip ID to audit, may be repeated (default: all known chip IDs)",
+    )
+    parser.add_argument(
+        "--fwver", type=lambda v: int(v, 0), help="firmware version the chips report"
+    )
+    parser.add_argument("--format", choices=["json", "csv"], default="json")
+    parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    parser.add_argument("--jobs", type=int, help="worker processes (default: CPU count)")
+    args = parser.parse_args()
+    logformat.configure_logger()
+
+    results = audit(args.sources, args.walk, args.chip or DEFAULT_CHIP_IDS, args.fwver, args.jobs)
+
+    f = open(args.output, "wt", newline="") if args.output else sys.stdout
+    try:
+        if args.format == "csv":
+            write_csv(results, f)
+        else:
+            json.dump(to_json(results), f, indent=2)
+            f.write("\n")
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    booting = sum(a.verdict == VERDICT_BOOTS for a in results)
+    trees = len({a.tree for a in results})
+    logger.info(f"Audited {trees} trees: {booting}/{len(results)} chip/tree pairs would boot")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,304 @@
+import argparse
+import concurrent.futures
+import dataclasses
+import fnmatch
+import hashlib
+import json
+import os
+import sys
+import threading
+from typing import Optional
+import patch
+import logformat
+
+logger = logformat.get_logger()
+
+MANIFEST_PATH = "/etc/wmt-pyloader/firmware-manifest.json"
+MANIFEST_VERSION = 1
+DIGEST_CACHE_PATH = "/var/cache/wmt-pyloader/digests.json"
+DIGEST_CACHE_VERSION = 1
+DIGEST_ALGORITHM = "sha256"
+# Files the WMT and WiFi drivers load: patches, RAM code and configs.
+CANDIDATE_PATTERNS = ["*_patch_*", "*_ram_*", "WIFI_RAM_CODE*", "WMT*.cfg", "*.cfg"]
+# hashlib releases the GIL while hashing chunks of at least 2047 bytes, so
+# large chunks let the pool hash files truly in parallel.
+CHUNK_SIZE = 1 << 20
+MAX_WORKERS = 4
+
+
+@dataclasses.dataclass
+class ManifestEntry:
+    size: int
+    digest: str
+
+
+@dataclasses.dataclass
+class CachedDigest:
+    # File metadata the digest was computed for.
+    inode: int
+    size: int
+    mtime_ns: int
+    digest: str
+
+    def matches(self, st: os.stat_result) -> bool:
+        return (
+            self.inode == st.st_ino
+            and self.size == st.st_size
+            and self.mtime_ns == st.st_mtime_ns
+        )
+
+
+@dataclasses.dataclass
+class Verdict:
+    filename: str
+    # "ok", "missing", "size", "digest" or "error".
+    status: str
+    detail: str = ""
+    # Whether the file had to be hashed, False for cached digests.
+    hashed: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.status == "ok"
+
+
+def is_candidate(filename: str) -> bool:
+    return any(fnmatch.fnmatch(filename, p) for p in CANDIDATE_PATTERNS)
+
+
+def hash_file(path: str) -> str:
+    h = hashlib.new(DIGEST_ALGORITHM)
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def load_manifest(path: str) -> dict[str, ManifestEntry]:
+    with open(path, "rt") as f:
+        data = json.load(f)
+    if data["version"] != MANIFEST_VERSION:
+        raise Exception(f"unsupported manifest version {data['version']}")
+    if data["algorithm"] != DIGEST_ALGORITHM:
+        raise Exception(f"unsupported digest algorithm {data['algorithm']}")
+    return {name: ManifestEntry(**e) for name, e in data["files"].items()}
+
+
+def save_json(data: dict, path: str):
+    """Atomically write `data` as JSON."""
+    tmppath = f"{path}.tmp"
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(tmppath, "wt") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmppath, path)
+
+
+class DigestCache:
+    """Digests of previously hashed files, reused as long as the inode, size
+    and mtime of a file are unchanged."""
+
+    def __init__(self, path: str = DIGEST_CACHE_PATH):
+        self.path = path
+        self.entries: dict[str, CachedDigest] = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Load the cache from disk. A missing or invalid cache is discarded."""
+        try:
+            with open(self.path, "rt") as f:
+                data = json.load(f)
+            if data["version"] != DIGEST_CACHE_VERSION:
+                raise Exception(f"unsupported cache version {data['version']}")
+            if data["algorithm"] != DIGEST_ALGORITHM:
+                raise Exception(f"cache was built with {data['algorithm']}")
+            self.entries = {p: CachedDigest(**e) for p, e in data["entries"].items()}
+        except FileNotFoundError:
+            logger.debug(f"No digest cache at {self.path}")
+        except Exception as e:
+            logger.warning(f"Discarding digest cache {self.path}: {e}")
+            self.entries = {}
+        self.dirty = False
+
+    def save(self):
+        """Atomically write the cache to disk, if it changed."""
+        if not self.dirty:
+            return
+        data = {
+            "version": DIGEST_CACHE_VERSION,
+            "algorithm": DIGEST_ALGORITHM,
+            "entries": {p: dataclasses.asdict(e) for p, e in self.entries.items()},
+        }
+        try:
+            save_json(data, self.path)
+            self.dirty = False
+        except OSError as e:
+            logger.warning(f"Failed to write digest cache {self.path}: {e}")
+
+    def get(self, path: str, st: os.stat_result) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is not None and entry.matches(st):
+            return entry.digest
+        return None
+
+    def put(self, path: str, st: os.stat_result, digest: str):
+        with self.lock:
+            self.entries[path] = CachedDigest(st.st_ino, st.st_size, st.st_mtime_ns, digest)
+            self.dirty = True
+
+
+def digest(path: str, cache: Optional[DigestCache]) -> tuple[str, bool]:
+    """Get the digest of a file, and whether it had to be hashed."""
+    st = os.stat(path)
+    if cache is not None:
+        cached = cache.get(path, st)
+        if cached is not None:
+            return cached, False
+    value = hash_file(path)
+    if cache is not None:
+        after = os.stat(path)
+        # Don't cache the digest of a file that changed while it was hashed.
+        if (after.st_ino, after.st_size, after.st_mtime_ns) == (
+            st.st_ino,
+            st.st_size,
+            st.st_mtime_ns,
+        ):
+            cache.put(path, st, value)
+    return value, True
+
+
+def _verify_file(
+    directory: str, filename: str, expected: ManifestEntry, cache: Optional[DigestCache]
+) -> Verdict:
+    path = os.path.join(directory, filename)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return Verdict(filename, "missing", "file does not exist")
+    except OSError as e:
+        return Verdict(filename, "error", str(e))
+    # Truncated files are caught without hashing them.
+    if st.st_size != expected.size:
+        return Verdict(filename, "size", f"{st.st_size} bytes, expected {expected.size}")
+    try:
+        value, hashed = digest(path, cache)
+    except OSError as e:
+        return Verdict(filename, "error", str(e))
+    if value != expected.digest:
+        detail = f"{DIGEST_ALGORITHM} {value}, expected {expected.digest}"
+        return Verdict(filename, "digest", detail, hashed)
+    return Verdict(filename, "ok", hashed=hashed)
+
+
+def verify(
+    directory: str,
+    manifest: dict[str, ManifestEntry],
+    cache: Optional[DigestCache] = None,
+    max_workers: int = MAX_WORKERS,
+) -> list[Verdict]:
+    """Check every file of the manifest against `directory`, hashing files
+    whose digest isn't cached on a thread pool."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(_verify_file, directory, filename, expected, cache)
+            for filename, expected in sorted(manifest.items())
+        ]
+        verdicts = [f.result() for f in futures]
+    if cache is not None:
+        cache.save()
+    return verdicts
+
+
+def generate(directory: str, max_workers: int = MAX_WORKERS) -> dict:
+    """Build a manifest of the candidate files in a known-good firmware dump."""
+    filenames = sorted(
+        f
+        for f in os.listdir(directory)
+        if is_candidate(f) and os.path.isfile(os.path.join(directory, f))
+    )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        digests = pool.map(lambda f: hash_file(os.path.join(directory, f)), filenames)
+        files = {
+            f: {"size": os.stat(os.path.join(directory, f)).st_size, "digest": d}
+            for f, d in zip(filenames, digests)
+        }
+    return {"version": MANIFEST_VERSION, "algorithm": DIGEST_ALGORITHM, "files": files}
+
+
+def verify_firmware(
+    directory: str = patch.PATCH_LOOKUP_DIRECTORY,
+    manifest_path: Optional[str] = None,
+    cache_path: str = DIGEST_CACHE_PATH,
+) -> bool:
+    """Boot step: warn about firmware files that don't match the manifest.
+    Returns False if any file is missing or corrupted."""
+    manifest_path = manifest_path or MANIFEST_PATH
+    try:
+        manifest = load_manifest(manifest_path)
+    except FileNotFoundError:
+        logger.debug(f"No firmware manifest at {manifest_path}, not verifying firmware")
+        return True
+    except Exception as e:
+        logger.warning(f"Invalid firmware manifest {manifest_path}: {e}")
+        return True
+
+    cache = DigestCache(cache_path)
+    cache.load()
+    verdicts = verify(directory, manifest, cache)
+    bad = [v for v in verdicts if not v.ok]
+    for v in bad:
+        logger.warning(f"Firmware file {v.filename} failed verification ({v.status}): {v.detail}")
+    hashed = sum(v.hashed for v in verdicts)
+    logger.info(
+        f"Verified {len(verdicts)} firmware files against {manifest_path}, "
+        f"{hashed} hashed, {len(bad)} failed"
+    )
+    return not bad
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="fwverify", description="Verify firmware files against a known-good manifest"
+    )
+    parser.add_argument("command", choices=["generate", "verify"])
+    parser.add_argument("--directory", default=patch.PATCH_LOOKUP_DIRECTORY)
+    parser.add_argument("--manifest", default=MANIFEST_PATH)
+    parser.add_argument("--cache", default=DIGEST_CACHE_PATH)
+    parser.add_argument("--no-cache", action="store_true", help="hash every file")
+    parser.add_argument("--jobs", type=int, default=MAX_WORKERS)
+    args = parser.parse_args()
+    logformat.configure_logger()
+
+    if args.command == "generate":
+        data = generate(args.directory, args.jobs)
+        save_json(data, args.manifest)
+        print(f"Wrote {len(data['files'])} files from {args.directory} to {args.manifest}")
+        return 0
+
+    try:
+        manifest = load_manifest(args.manifest)
+    except Exception as e:
+        print(f"Failed to load manifest {args.manifest}: {e}")
+        return 1
+    cache = None
+    if not args.no_cache:
+        cache = DigestCache(args.cache)
+        cache.load()
+    verdicts = verify(args.directory, manifest, cache, args.jobs)
+    for v in verdicts:
+        print(f"{v.filename}: {v.status}" + (f" ({v.detail})" if v.detail else ""))
+    bad = sum(not v.ok for v in verdicts)
+    print(f"{len(verdicts) - bad}/{len(verdicts)} files OK, {sum(v.hashed for v in verdicts)} hashed")
+    return 1 if bad else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
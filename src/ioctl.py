@@ -1,7 +1,16 @@
+import dataclasses
+import struct
+import threading
+import time
+from typing import Callable, Optional
+import boottrace
 import logformat
 
 logger = logformat.get_logger()
 
+# Human-readable ioctl names, used for tracing.
+IOCTL_NAMES: dict[int, str] = {}
+
 _IOC_NRSHIFT = 0
 _IOC_TYPESHIFT = 8
 _IOC_SIZESHIFT = 16
@@ -37,21 +46,172 @@ def iowr(type: int, nr: int, size: str):
     return ioc(_IOC_READ | _IOC_WRITE, type, nr, size)
 
 
-def do_ioctl(fd, ioctl: int, arg: int | bytes = 0) -> int:
+def register_names(names: dict):
+    """Register names of ioctl constants, e.g. from a module's globals()."""
+    for name, value in names.items():
+        if isinstance(value, int) and "IOCTL" in name:
+            IOCTL_NAMES[value] = name
+
+
+def ioctl_name(ioctl: int) -> str:
+    return IOCTL_NAMES.get(ioctl, hex(ioctl))
+
+
+def _fcntl_ioctl(fd, ioctl: int, arg: int | bytearray) -> int:
     import fcntl
 
+    # With a mutable buffer, the kernel's changes are written back to it and
+    # the return value is an int.
+    return fcntl.ioctl(fd, ioctl, arg)
+
+
+# Performs the actual ioctl call. Replaced by a simulated driver when running
+# without the hardware, see bench/mockdriver.py.
+_backend: Callable[[object, int, int | bytearray], int] = _fcntl_ioctl
+
+
+def set_backend(backend: Optional[Callable[[object, int, int | bytearray], int]]):
+    """Route all ioctl's through `backend`, or back to the kernel if None.
+
+    The backend is called with (fd, ioctl, arg), where arg is an int or a
+    mutable bytearray, and may raise OSError like fcntl.ioctl does.
+    """
+    global _backend
+    _backend = _fcntl_ioctl if backend is None else backend
+
+
+def get_backend() -> Callable[[object, int, int | bytearray], int]:
+    return _backend
+
+
+# Upper bounds of the latency histogram buckets, in microseconds. Calls
+# slower than the last bound are counted in an extra overflow bucket.
+LATENCY_BUCKETS_US = [2**i for i in range(24)]
+
+
+@dataclasses.dataclass
+class IoctlStats:
+    name: str
+    count: int = 0
+    # Calls returning a negative value.
+    errors: int = 0
+    total_ns: int = 0
+    max_ns: int = 0
+    # Call counts per LATENCY_BUCKETS_US bucket, plus the overflow bucket.
+    histogram: list[int] = dataclasses.field(
+        default_factory=lambda: [0] * (len(LATENCY_BUCKETS_US) + 1)
+    )
+
+    def observe(self, elapsed_ns: int, ret: int):
+        self.count += 1
+        if ret < 0:
+            self.errors += 1
+        self.total_ns += elapsed_ns
+        self.max_ns = max(self.max_ns, elapsed_ns)
+        # Bucket i holds calls taking less than 2**i us.
+        bucket = min((elapsed_ns // 1000).bit_length(), len(LATENCY_BUCKETS_US))
+        self.histogram[bucket] += 1
+
+    def percentile_us(self, p: float) -> Optional[int]:
+        """Upper bound of the bucket holding the `p`th percentile, None if
+        it's in the overflow bucket or nothing was recorded."""
+        target = self.count * p / 100
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= target:
+                return LATENCY_BUCKETS_US[bucket] if bucket < len(LATENCY_BUCKETS_US) else None
+        return None
+
+
+_stats: dict[int, IoctlStats] = {}
+_stats_lock = threading.Lock()
+
+
+def get_stats() -> dict[int, IoctlStats]:
+    """Per ioctl number call counts and latency histograms, since start or
+    the last `reset_stats`."""
+    with _stats_lock:
+        return {ioctl: dataclasses.replace(s, histogram=list(s.histogram)) for ioctl, s in _stats.items()}
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def format_stats() -> str:
+    lines = [f"{'ioctl':<40} {'calls':>6} {'errors':>6} {'mean us':>9} {'p50 us':>7} {'p99 us':>7} {'max us':>9}"]
+    for s in sorted(get_stats().values(), key=lambda s: s.total_ns, reverse=True):
+        p50, p99 = s.percentile_us(50), s.percentile_us(99)
+        lines.append(
+            f"{s.name:<40} {s.count:>6} {s.errors:>6} {s.total_ns / s.count / 1000:>9.1f} "
+            f"{'<' + str(p50) if p50 else '-':>7} {'<' + str(p99) if p99 else '-':>7} "
+            f"{s.max_ns / 1000:>9.1f}"
+        )
+    return "\n".join(lines)
+
+
+# Request buffers, reused per thread, fd and size so building a request
+# doesn't allocate.
+_buffers = threading.local()
+
+
+def request_buffer(fd, size: int) -> bytearray:
+    """Get the reusable request buffer for `fd` of `size` bytes.
+
+    The buffer stays valid until the next request of the same size on the
+    same fd from the same thread.
+    """
+    fileno = fd if isinstance(fd, int) else fd.fileno()
+    try:
+        cache = _buffers.cache
+    except AttributeError:
+        cache = _buffers.cache = {}
+    buf = cache.get((fileno, size))
+    if buf is None:
+        buf = cache[(fileno, size)] = bytearray(size)
+    return buf
+
+
+def _call(fd, ioctl: int, arg: int | bytearray) -> int:
     # Python is being a bit too clever and throws an exception based on the status code
     # The driver of course re-uses some values for it's own custom statuses.
-    try:
-        if isinstance(arg, bytes):
-            buf = bytearray(arg)
-            err = fcntl.ioctl(fd, ioctl, buf)
-        else:
-            err = fcntl.ioctl(fd, ioctl, arg)
-    except OSError as e:
-        err = -e.errno
-    if isinstance(err, bytes):
-        logger.debug(f"ioctl({hex(ioctl)}) bytes: {err}")
-        return err
-    logger.debug(f"ioctl({hex(ioctl)}) returned err({hex(err)})")
+    name = ioctl_name(ioctl)
+    with boottrace.span(name, "ioctl") as span:
+        start_ns = time.monotonic_ns()
+        try:
+            err = _backend(fd, ioctl, arg)
+        except OSError as e:
+            err = -e.errno
+        elapsed_ns = time.monotonic_ns() - start_ns
+        span["ret"] = err
+    with _stats_lock:
+        stats = _stats.get(ioctl)
+        if stats is None:
+            stats = _stats[ioctl] = IoctlStats(name)
+        stats.observe(elapsed_ns, err)
+    # Called a lot, leave formatting to the handlers that actually output it.
+    logger.debug("ioctl(%#x) returned err(%#x)", ioctl, err)
     return err
+
+
+def ioctl_struct(fd, ioctl: int, layout: struct.Struct, *values) -> int:
+    """Pack `values` into the fd's reusable request buffer and issue the
+    ioctl with it."""
+    buf = request_buffer(fd, layout.size)
+    layout.pack_into(buf, 0, *values)
+    return _call(fd, ioctl, buf)
+
+
+def do_ioctl(fd, ioctl: int, arg: int | bytes | bytearray = 0) -> int:
+    """Issue an ioctl with an int, bytes or bytearray argument.
+
+    bytes are copied into the fd's reusable request buffer, a bytearray is
+    used in place.
+    """
+    if isinstance(arg, bytes):
+        buf = request_buffer(fd, len(arg))
+        buf[:] = arg
+        return _call(fd, ioctl, buf)
+    return _call(fd, ioctl, arg)
@@ -0,0 +1,238 @@
+import argparse
+import dataclasses
+import struct
+import sys
+import threading
+import time
+from typing import BinaryIO, Optional
+import ioctl
+import launcher
+# Registers the COMBO_IOCTL names.
+import loader  # noqa: F401
+import logformat
+
+logger = logformat.get_logger()
+
+TRACE_MAGIC = b"WMTIOTR1"
+# Record type, flags, start and end (ns since the trace started), ioctl
+# number, int argument or buffer length, return value. Buffer arguments
+# follow the record, and with FLAG_CHANGED their contents after the call.
+IOCTL_RECORD = struct.Struct("<BBQQIqq")
+# Record type, timestamp (ns since the trace started), data length.
+DATA_RECORD = struct.Struct("<BQI")
+
+RECORD_IOCTL = 1
+# Command read from WMT_DEV by the launcher.
+RECORD_READ = 2
+# Response written to WMT_DEV by the launcher.
+RECORD_WRITE = 3
+# Write to WMT_WIFI.
+RECORD_WIFI = 4
+
+DATA_RECORDS = {"read": RECORD_READ, "write": RECORD_WRITE, "wifi": RECORD_WIFI}
+DATA_KINDS = {v: k for k, v in DATA_RECORDS.items()}
+
+FLAG_BUFFER = 1
+# The driver wrote to the argument buffer.
+FLAG_CHANGED = 2
+# The call raised OSError, `ret` is the negated errno.
+FLAG_RAISED = 4
+
+
+@dataclasses.dataclass
+class IoctlEvent:
+    start_ns: int
+    end_ns: int
+    ioctl: int
+    # Int argument, or the buffer contents passed in.
+    arg: int | bytes
+    ret: int
+    raised: bool = False
+    # Buffer contents after the call, if the driver changed them.
+    after: Optional[bytes] = None
+
+    @property
+    def name(self) -> str:
+        return ioctl.ioctl_name(self.ioctl)
+
+
+@dataclasses.dataclass
+class DataEvent:
+    # "read", "write" or "wifi", see DATA_RECORDS.
+    kind: str
+    timestamp_ns: int
+    data: bytes
+
+
+Event = IoctlEvent | DataEvent
+
+
+def _read_exact(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise Exception(f"Trace is truncated, expected {size} bytes, got {len(data)}")
+    return data
+
+
+def read_trace(path: str) -> list[Event]:
+    """Read all events of a trace file, in the order they were recorded.
+
+    A trace cut short by a crash is read up to its last complete record.
+    """
+    events: list[Event] = []
+    with open(path, "rb") as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise Exception(f"{path} is not an I/O trace")
+        try:
+            while True:
+                kind = f.read(1)
+                if not kind:
+                    break
+                if kind[0] == RECORD_IOCTL:
+                    data = kind + _read_exact(f, IOCTL_RECORD.size - 1)
+                    _, flags, start_ns, end_ns, request, arg, ret = IOCTL_RECORD.unpack(data)
+                    after = None
+                    if flags & FLAG_BUFFER:
+                        size = arg
+                        arg = _read_exact(f, size)
+                        if flags & FLAG_CHANGED:
+                            after = _read_exact(f, size)
+                    events.append(
+                        IoctlEvent(
+                            start_ns, end_ns, request, arg, ret, bool(flags & FLAG_RAISED), after
+                        )
+                    )
+                elif kind[0] in DATA_KINDS:
+                    data = kind + _read_exact(f, DATA_RECORD.size - 1)
+                    _, timestamp_ns, size = DATA_RECORD.unpack(data)
+                    events.append(
+                        DataEvent(DATA_KINDS[kind[0]], timestamp_ns, _read_exact(f, size))
+                    )
+                else:
+                    raise Exception(f"Unknown record type {kind[0]}")
+        except Exception as e:
+            logger.warning(f"Stopped reading {path} after {len(events)} events: {e}")
+    return events
+
+
+class TraceRecorder:
+    """Records ioctl calls and WMT_DEV/WMT_WIFI traffic to a trace file.
+
+    Installed as the ioctl backend, wrapping the previous one, and as the
+    launcher I/O observer. Records are appended as they happen, so a trace
+    of a boot that hangs or crashes is still usable.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.f = open(path, "wb")
+        self.f.write(TRACE_MAGIC)
+        self.start_ns = time.monotonic_ns()
+        self.backend = ioctl.get_backend()
+        self.lock = threading.Lock()
+        self.events = 0
+
+    def ioctl(self, fd, request: int, arg: int | bytearray) -> int:
+        before = bytes(arg) if isinstance(arg, bytearray) else arg
+        start_ns = time.monotonic_ns() - self.start_ns
+        try:
+            ret = self.backend(fd, request, arg)
+        except OSError as e:
+            self._write_ioctl(start_ns, request, before, arg, -(e.errno or 0), True)
+            raise
+        self._write_ioctl(start_ns, request, before, arg, ret, False)
+        return ret
+
+    def _write_ioctl(self, start_ns, request, before, arg, ret, raised):
+        end_ns = time.monotonic_ns() - self.start_ns
+        flags = FLAG_RAISED if raised else 0
+        payload = b""
+        if isinstance(before, bytes):
+            flags |= FLAG_BUFFER
+            payload = before
+            if arg != before:
+                flags |= FLAG_CHANGED
+                payload += bytes(arg)
+            value = len(before)
+        else:
+            value = before
+        record = IOCTL_RECORD.pack(
+            RECORD_IOCTL, flags, start_ns, end_ns, request & 0xFFFFFFFF, value, ret
+        )
+        self._write(record + payload)
+
+    def observe(self, kind: str, data: bytes):
+        timestamp_ns = time.monotonic_ns() - self.start_ns
+        self._write(DATA_RECORD.pack(DATA_RECORDS[kind], timestamp_ns, len(data)) + data)
+        if kind == "wifi":
+            # The boot is done, make sure the trace is on disk.
+            self.flush()
+
+    def _write(self, data: bytes):
+        with self.lock:
+            if not self.f.closed:
+                self.f.write(data)
+                self.events += 1
+
+    def flush(self):
+        with self.lock:
+            if not self.f.closed:
+                self.f.flush()
+
+    def close(self):
+        with self.lock:
+            if not self.f.closed:
+                self.f.close()
+                logger.info(f"Wrote {self.events} events to {self.path}")
+
+
+_recorder: Optional[TraceRecorder] = None
+
+
+def start_recording(path: str) -> TraceRecorder:
+    """Record all ioctls and launcher device I/O of this process to `path`."""
+    global _recorder
+    _recorder = TraceRecorder(path)
+    ioctl.set_backend(_recorder.ioctl)
+    launcher.set_io_observer(_recorder.observe)
+    logger.info(f"Recording I/O trace to {path}")
+    return _recorder
+
+
+def stop_recording():
+    global _recorder
+    if _recorder is None:
+        return
+    launcher.set_io_observer(None)
+    ioctl.set_backend(_recorder.backend)
+    _recorder.close()
+    _recorder = None
+
+
+def show(path: str) -> int:
+    for e in read_trace(path):
+        if isinstance(e, IoctlEvent):
+            if isinstance(e.arg, bytes):
+                arg = e.arg[:32].hex() + (f"...[{len(e.arg)} bytes]" if len(e.arg) > 32 else "")
+            else:
+                arg = hex(e.arg)
+            ret = f"errno {-e.ret}" if e.raised else hex(e.ret)
+            duration_us = (e.end_ns - e.start_ns) / 1000
+            print(f"{e.start_ns / 1e6:10.3f}ms {e.name}({arg}) = {ret} [{duration_us:.1f}us]")
+            if e.after is not None:
+                print(f"{'':12} buffer changed to {e.after.hex()}")
+        else:
+            print(f"{e.timestamp_ns / 1e6:10.3f}ms {e.kind} {e.data!r}")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="iotrace", description="Show an I/O trace")
+    parser.add_argument("command", choices=["show"])
+    parser.add_argument("trace")
+    args = parser.parse_args()
+    logformat.configure_logger()
+    return show(args.trace)
+
+if __name__ == "__main__":
+    sys.exit(main())
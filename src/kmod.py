@@ -0,0 +1,236 @@
+import ctypes
+import errno
+import fnmatch
+import glob
+import os
+from typing import Optional
+import logformat
+
+logger = logformat.get_logger()
+
+MODULES_ROOT = "/lib/modules"
+PROC_MODULES = "/proc/modules"
+PROC_CMDLINE = "/proc/cmdline"
+MODPROBE_CONF_GLOBS = [
+    "/etc/modprobe.d/*.conf",
+    "/run/modprobe.d/*.conf",
+    "/lib/modprobe.d/*.conf",
+]
+
+# finit_module syscall numbers, per kernel architecture and pointer size of
+# the userland ABI. 32-bit ARM userlands often run on arm64 kernels, and
+# use the ARM EABI numbers there.
+NR_FINIT_MODULE = {
+    ("x86_64", 8): 313,
+    ("i386", 4): 350,
+    ("i686", 4): 350,
+    ("aarch64", 8): 273,
+    ("aarch64", 4): 379,
+    ("armv7l", 4): 379,
+    ("armv8l", 4): 379,
+    ("riscv64", 8): 273,
+}
+MODULE_INIT_COMPRESSED_FILE = 4
+COMPRESSED_SUFFIXES = (".ko.xz", ".ko.gz", ".ko.zst")
+
+
+def split_cmdline(cmdline: str) -> list[str]:
+    """Split a kernel command line the way the kernel does: on whitespace
+    outside double quotes. Quotes are removed."""
+    args = []
+    arg = []
+    quoted = False
+    for c in cmdline:
+        if c == '"':
+            quoted = not quoted
+        elif c.isspace() and not quoted:
+            if arg:
+                args.append("".join(arg))
+                arg = []
+        else:
+            arg.append(c)
+    if arg:
+        args.append("".join(arg))
+    return args
+
+
+def module_name(path: str) -> str:
+    """Get the canonical module name from a module path or name."""
+    name = os.path.basename(path)
+    for suffix in COMPRESSED_SUFFIXES + (".ko",):
+        if name.endswith(suffix):
+            name = name[: -len(suffix)]
+            break
+    return name.replace("-", "_")
+
+
+class ModuleDatabase:
+    """Parsed modules.dep/modules.alias and modprobe.d configuration for the
+    running kernel.
+    """
+
+    def __init__(self, moddir: str):
+        self.moddir = moddir
+        # Module name -> (module path, [dependency paths])
+        self.deps: dict[str, tuple[str, list[str]]] = {}
+        self.aliases: list[tuple[str, str]] = []
+        self.options: dict[str, str] = {}
+        # Modules with install/remove commands, which only modprobe can handle.
+        self.custom_commands: set[str] = set()
+
+        with open(os.path.join(moddir, "modules.dep"), "rt") as f:
+            for line in f:
+                path, _, deps = line.partition(":")
+                if not path:
+                    continue
+                self.deps[module_name(path)] = (path, deps.split())
+
+        try:
+            with open(os.path.join(moddir, "modules.alias"), "rt") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 3 and parts[0] == "alias":
+                        self.aliases.append((parts[1], module_name(parts[2])))
+        except FileNotFoundError:
+            pass
+
+        for pattern in MODPROBE_CONF_GLOBS:
+            for conf in sorted(glob.glob(pattern)):
+                self._parse_conf(conf)
+        # Like modprobe, options from the kernel command line go after the
+        # modprobe.d ones.
+        self._parse_cmdline(PROC_CMDLINE)
+
+    def _parse_conf(self, path: str):
+        try:
+            with open(path, "rt") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return
+        for line in lines:
+            parts = line.split("#", 1)[0].split()
+            if len(parts) < 2:
+                continue
+            if parts[0] == "options":
+                name = module_name(parts[1])
+                opts = " ".join(parts[2:])
+                self.options[name] = f"{self.options.get(name, '')} {opts}".strip()
+            elif parts[0] in ("install", "remove", "softdep"):
+                self.custom_commands.add(module_name(parts[1]))
+
+    def _parse_cmdline(self, path: str):
+        """Add `modname.param=value` options from the kernel command line."""
+        try:
+            with open(path, "rt") as f:
+                cmdline = f.read()
+        except OSError:
+            return
+        for arg in split_cmdline(cmdline):
+            if arg == "--":
+                # Everything after is passed to init.
+                break
+            module, dot, param = arg.partition(".")
+            if not dot or not param or "=" in module:
+                continue
+            key, eq, value = param.partition("=")
+            if " " in value:
+                param = f'{key}="{value}"'
+            name = module_name(module)
+            self.options[name] = f"{self.options.get(name, '')} {param}".strip()
+
+    def resolve(self, name: str) -> str:
+        """Resolve a module name or alias to a module name from modules.dep."""
+        name = module_name(name)
+        if name in self.deps:
+            return name
+        for pattern, target in self.aliases:
+            if fnmatch.fnmatchcase(name, pattern):
+                return target
+        raise Exception(f"Module {name} not found in {self.moddir}/modules.dep")
+
+    def load_order(self, name: str) -> list[str]:
+        """Get the module paths to load for a module, dependencies first."""
+        path, deps = self.deps[name]
+        # modprobe loads the dependencies listed in modules.dep back to front.
+        return list(reversed(deps)) + [path]
+
+
+_database: Optional[ModuleDatabase] = None
+
+
+def get_database() -> ModuleDatabase:
+    """Get the module database for the running kernel, parsing it on first use."""
+    global _database
+    if _database is None:
+        _database = ModuleDatabase(os.path.join(MODULES_ROOT, os.uname().release))
+    return _database
+
+
+def loaded_modules() -> set[str]:
+    with open(PROC_MODULES, "rt") as f:
+        return set(line.split(" ", 1)[0] for line in f)
+
+
+def finit_module(path: str, params: str = ""):
+    """Load a module file with the finit_module syscall."""
+    machine = os.uname().machine
+    # The kernel architecture alone doesn't tell the syscall ABI, e.g. for
+    # a 32-bit userland on a 64-bit kernel.
+    pointer_size = ctypes.sizeof(ctypes.c_void_p)
+    nr = NR_FINIT_MODULE.get((machine, pointer_size))
+    if nr is None:
+        raise Exception(f"finit_module syscall number unknown for {pointer_size * 8}-bit {machine}")
+    flags = MODULE_INIT_COMPRESSED_FILE if path.endswith(COMPRESSED_SUFFIXES) else 0
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        ret = libc.syscall(
+            ctypes.c_long(nr),
+            ctypes.c_int(fd),
+            ctypes.c_char_p(params.encode()),
+            ctypes.c_int(flags),
+        )
+    finally:
+        os.close(fd)
+    if ret != 0:
+        err = ctypes.get_errno()
+        if err == errno.EEXIST:
+            return
+        raise OSError(err, f"finit_module({path}) failed: {os.strerror(err)}")
+
+
+def modprobe(name: str):
+    # Only needed as a fallback, don't pay for the import on every boot.
+    import subprocess
+
+    subprocess.check_call(["modprobe", name])
+
+
+def load_module(name: str):
+    """Load a kernel module and its dependencies in-process.
+
+    Modules already present in /proc/modules are skipped. Falls back to
+    spawning modprobe if the module can't be loaded directly.
+    """
+    try:
+        db = get_database()
+        resolved = db.resolve(name)
+        if resolved in db.custom_commands:
+            logger.debug(f"{resolved} has custom modprobe.d commands, using modprobe")
+            modprobe(name)
+            return
+
+        loaded = loaded_modules()
+        for path in db.load_order(resolved):
+            dep = module_name(path)
+            if dep in loaded:
+                continue
+            if not os.path.isabs(path):
+                path = os.path.join(db.moddir, path)
+            logger.debug(f"finit_module: {path}")
+            finit_module(path, db.options.get(dep, ""))
+            loaded.add(dep)
+    except Exception as e:
+        logger.warning(f"In-process load of {name} failed ({e}), falling back to modprobe")
+        modprobe(name)
@@ -1,21 +1,218 @@
+import dataclasses
+import errno
 import logformat
 import threading
-import io
 import re
 import patch
 import os
+from typing import Callable, Iterable, Optional
 
 logger = logformat.get_logger()
 
 KMSG_PATH = "/dev/kmsg"
 
+# Tags used by the WMT-related drivers, see docs/wmt_detect.md.
+# fmt: off
+WMT_DRIVER_TAGS = [
+    "BT-MOD-INIT", "BWG", "FM-MOD-INIT", "GPS", "GPS2", "GPS-MOD-INIT",
+    "hif_sdio", "HIF-SDIO", "ICS-FW", "LNA_CTL", "MTK-BT", "MTK-WIFI",
+    "SDIO-DETECT", "STP", "STP SDIO", "STP-BTIF", "STP-BTM", "STPDbg",
+    "STP-PSM", "UART", "user-trx", "WCN-MOD-INIT", "WIFI-FW", "wlan",
+    "WLAN-MOD-INIT", "WMT-CMB-HW", "WMT-CONF", "WMT-CONSYS-HW", "WMT-CORE",
+    "WMT-CTRL", "WMT-DETECT", "WMT-DEV", "WMT-DFT", "WMT-EXP", "WMT-FUNC",
+    "WMT-IC", "WMT-LIB", "WMT-MOD-INIT", "WMT-PLAT", "cmb_stub",
+    "mtk_wcn_cmb_sdio", "mtk_stp_btm", "btif_rxd", "mtk_wmtd",
+    "mtk_stp_psm", "mtk_wmtd_worker",
+]
+# fmt: on
+
+
+@dataclasses.dataclass
+class KmsgRecord:
+    # Syslog level, 0 (emerg) to 7 (debug).
+    level: int
+    facility: int
+    sequence: int
+    # CLOCK_MONOTONIC timestamp, in microseconds.
+    timestamp_us: int
+    message: str
+
+
+@dataclasses.dataclass
+class KmsgEvent:
+    # Name of the matched rule.
+    rule: str
+    record: KmsgRecord
+    # Named groups captured by the rule pattern.
+    groups: dict[str, str]
+
+
+@dataclasses.dataclass
+class Rule:
+    name: str
+    pattern: str
+    # Literal strings, one of which must be present in a message for the
+    # pattern to be tried at all, matched case-insensitively. Rules without
+    # literals are tried on every message.
+    literals: list[str] = dataclasses.field(default_factory=list)
+
+
+RULES = [
+    Rule(
+        "firmware_load_failed",
+        r"Direct firmware load for (?P<filename>.+?) failed",
+        ["Direct firmware load for"],
+    ),
+    Rule(
+        "wmt_driver",
+        r"\[?(?P<tag>" + "|".join(re.escape(t) for t in WMT_DRIVER_TAGS) + r")\]",
+        list(WMT_DRIVER_TAGS),
+    ),
+    # Logged by wmt_lib when the chip is reset, after which the driver asks
+    # for patches again.
+    Rule(
+        "chip_reset",
+        r"(?i)(?P<kind>whole chip reset|chip reset) (?P<phase>start|end|done|ok|fail)",
+        ["chip reset"],
+    ),
+    # Logged by the WMT driver when the connsys firmware asserts, before the
+    # coredump is collected and the chip is reset.
+    Rule(
+        "firmware_assert",
+        r"(?i)(?P<kind>(?:fw|firmware|connsys|stp) assert|coredump start)",
+        ["assert", "coredump"],
+    ),
+]
+
+
+def parse_record(data: bytes) -> Optional[KmsgRecord]:
+    """Parse a single /dev/kmsg record.
+
+    The format is `prefix,seq,timestamp,flags[,...];message`, optionally
+    followed by continuation lines with key=value pairs, which are ignored.
+    """
+    header, sep, rest = data.partition(b";")
+    if not sep:
+        return None
+    fields = header.split(b",")
+    if len(fields) < 3:
+        return None
+    try:
+        prefix = int(fields[0])
+        sequence = int(fields[1])
+        timestamp_us = int(fields[2])
+    except ValueError:
+        return None
+    message = rest.split(b"\n", 1)[0].decode(errors="replace")
+    return KmsgRecord(prefix & 7, prefix >> 3, sequence, timestamp_us, message)
+
+
+class RuleEngine:
+    """Matches kmsg records against many rules at once.
+
+    All rule literals are combined into a single alternation, so every
+    message is scanned once; only the patterns of rules whose literals were
+    found are evaluated afterwards.
+    """
+
+    def __init__(self, rules: Iterable[Rule]):
+        self.rules = list(rules)
+        self.patterns = {rule.name: re.compile(rule.pattern) for rule in self.rules}
+        self.always = [rule.name for rule in self.rules if not rule.literals]
+        self.by_literal: dict[str, list[str]] = {}
+        for rule in self.rules:
+            for literal in rule.literals:
+                self.by_literal.setdefault(literal.lower(), []).append(rule.name)
+        self.prefilter = None
+        if self.by_literal:
+            # Longest first, so overlapping literals prefer the longer match.
+            literals = sorted(self.by_literal, key=len, reverse=True)
+            self.prefilter = re.compile(
+                "|".join(re.escape(lit) for lit in literals), re.IGNORECASE
+            )
+
+    def match(self, record: KmsgRecord) -> list[KmsgEvent]:
+        candidates = list(self.always)
+        if self.prefilter is not None:
+            for literal in {lit.lower() for lit in self.prefilter.findall(record.message)}:
+                for name in self.by_literal[literal]:
+                    if name not in candidates:
+                        candidates.append(name)
+
+        events = []
+        for name in candidates:
+            match = self.patterns[name].search(record.message)
+            if match is not None:
+                events.append(KmsgEvent(name, record, match.groupdict()))
+        return events
 
-def _kmsg_handle_line(line: str):
-    rg = re.compile(r".*Direct firmware load for (.+?) failed.*")
-    match = rg.search(line)
-    if match is None:
-        return
-    filename = match.group(1)
+
+Subscriber = Callable[[KmsgEvent], None]
+
+
+class KmsgListener:
+    """Reads /dev/kmsg and dispatches matched events to subscribers."""
+
+    def __init__(self, rules: Iterable[Rule] = RULES, path: str = KMSG_PATH):
+        self.path = path
+        self.engine = RuleEngine(rules)
+        self.subscribers: list[tuple[Optional[set[str]], Subscriber]] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback: Subscriber, rules: Optional[Iterable[str]] = None):
+        """Call `callback` for events of the given rules (or of all rules)."""
+        with self._lock:
+            self.subscribers.append((None if rules is None else set(rules), callback))
+
+    def unsubscribe(self, callback: Subscriber):
+        with self._lock:
+            self.subscribers = [s for s in self.subscribers if s[1] is not callback]
+
+    def dispatch(self, record: KmsgRecord):
+        events = self.engine.match(record)
+        if not events:
+            return
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for event in events:
+            for rules, callback in subscribers:
+                if rules is not None and event.rule not in rules:
+                    continue
+                try:
+                    callback(event)
+                except Exception:
+                    logger.exception(f"kmsg subscriber failed on {event.rule} event")
+
+    def run(self, from_start: bool = False):
+        """Read records until the file ends or an error occurs.
+
+        Unless `from_start` is set, reading starts at the current end of the
+        ring buffer instead of replaying it.
+        """
+        fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            if not from_start:
+                os.lseek(fd, 0, os.SEEK_END)
+            while True:
+                try:
+                    # Every read returns exactly one record.
+                    data = os.read(fd, 8192)
+                except OSError as e:
+                    # Records were overwritten before we got to read them.
+                    if e.errno == errno.EPIPE:
+                        continue
+                    raise
+                if not data:
+                    return
+                record = parse_record(data)
+                if record is not None:
+                    self.dispatch(record)
+        finally:
+            os.close(fd)
+
+
+def _warn_firmware_load_failed(event: KmsgEvent):
+    filename = event.groups["filename"]
 
     logger.warning(
         f"WARNING: kmsg listener found an error indicating the kernel failed to load a firmware file: {filename}"
@@ -28,12 +225,22 @@ def _kmsg_handle_line(line: str):
     )
 
 
+_listener = KmsgListener()
+_listener.subscribe(_warn_firmware_load_failed, ["firmware_load_failed"])
+
+
+def get_listener() -> KmsgListener:
+    return _listener
+
+
+def subscribe(callback: Subscriber, rules: Optional[Iterable[str]] = None):
+    """Subscribe to events of the process-wide kmsg listener."""
+    _listener.subscribe(callback, rules)
+
+
 def _kmsg_thread():
     try:
-        with open(KMSG_PATH, "rt") as f:
-            for line in f:
-                _kmsg_handle_line(line)
-
+        _listener.run()
     except Exception:
         logger.exception("kmsg listener error")
     except KeyboardInterrupt:
@@ -42,5 +249,6 @@ def _kmsg_thread():
 
 def start_listener():
     """Listen for common warning lines on kmsg."""
-    t = threading.Thread(target=_kmsg_thread)
+    # Daemonic, so the listener never keeps the process alive on its own.
+    t = threading.Thread(target=_kmsg_thread, daemon=True)
     t.start()
@@ -1,16 +1,31 @@
 import struct
 import os
-import time
 import threading
+import sys
 import traceback
-from typing import Optional
+from typing import Callable, Optional
 import patch
+import patchindex
+import boottrace
+import bootplan
+import devnode
+import metrics
+import retry
 import logformat
 
 logger = logformat.get_logger()
 
 
-from ioctl import do_ioctl, ior, iow, iowr
+from ioctl import (
+    do_ioctl,
+    ioctl_name,
+    ioctl_struct,
+    ior,
+    iow,
+    iowr,
+    register_names,
+    request_buffer,
+)
 
 WMT_IOC_MAGIC = 0xA0
 WMT_IOCTL_SET_PATCH_NAME = iow(WMT_IOC_MAGIC, 4, "char*")
@@ -43,6 +58,7 @@ WMT_IOCTL_SET_CHECK_PATCH_STATUS = iow(WMT_IOC_MAGIC, 39, "int")
 WMT_IOCTL_SET_ACTIVE_PATCH_VERSION = ior(WMT_IOC_MAGIC, 40, "char*")
 WMT_IOCTL_GET_ACTIVE_PATCH_VERSION = ior(WMT_IOC_MAGIC, 41, "char*")
 WMT_IOCTL_GET_DIRECT_PATH_EMI_SIZE = ior(WMT_IOC_MAGIC, 42, "unsigned int")
+register_names(globals())
 
 WMT_CHIPINFO_GET_CHIPID = 0
 WMT_CHIPINFO_GET_HWVER = 1
@@ -62,6 +78,10 @@ class WMTCHIN:
 
 WMT_DEV = "/dev/stpwmt"
 WMT_WIFI = "/dev/wmtWifi"
+# Seconds to wait for WMT_DEV to appear.
+WMT_DEV_TIMEOUT = 10.0
+# Seconds between warnings while waiting for WMT_WIFI to appear.
+WMT_WIFI_TIMEOUT = 30.0
 WMT_COMAMND_SRH_PATCH = b"srh_patch"
 WMT_COMMAND_SRH_ROM_PATCH = b"srh_rom_patch"
 ROM_PREFIXES = {
@@ -86,18 +106,40 @@ ROM_PREFIXES = {
     "soc2_0": [0x6779, 0x6853, 0x6873],
 }
 CHIP_RANGES_ROMv1 = range(0x6570, 0x6593)
+# Prefixes of the files requested by srh_rom_patch, chips not listed here
+# use "soc1_0".
+ROM_PATCH_PREFIXES = {
+    "soc2_0": [0x6779, 0x6853, 0x6873],
+    "soc2_2": [0x6781, 0x6833],
+}
+# Config file name passed to WMT_IOCTL_SET_PATCH_NAME.
+WMT_CFG_NAME = "WMT_SOC.cfg"
+
+# Called with ("read", command) and ("write", response) for traffic on
+# WMT_DEV, and ("wifi", data) for writes to WMT_WIFI. See iotrace.py.
+_io_observer: Optional[Callable[[str, bytes], None]] = None
+
+
+def set_io_observer(observer: Optional[Callable[[str, bytes], None]]):
+    global _io_observer
+    _io_observer = observer
+
+
+# Called with the WMT_DEV fd at the end of setup, to configure optional
+# driver features. See coredump.py.
+_setup_hooks: list[Callable[[int], None]] = []
+
+
+def add_setup_hook(hook: Callable[[int], None]):
+    _setup_hooks.append(hook)
 
 
 def get_rom_patch_prefix(chip_id: int) -> str:
     """Determine the ROM patch prefix for srh_rom_patch commands."""
-    prefix = "soc1_0"
-    if chip_id == 0x6779 or chip_id == 0x6873 or chip_id == 0x6853:
-        prefix = "soc2_0"
-    elif chip_id == 0x6781:
-        prefix = "soc2_2"
-    elif chip_id == 0x6833:
-        prefix = "soc2_2"
-    return prefix
+    for prefix, ids in ROM_PATCH_PREFIXES.items():
+        if chip_id in ids:
+            return prefix
+    return "soc1_0"
 
 
 def get_patch_prefix(chip_id: int) -> str:
@@ -133,8 +175,26 @@ def get_patch_suffix(chip_id: int) -> Optional[str]:
     return suffix
 
 
-def create_set_rom_patch_request(patchinfo: bytes, patchfile: str) -> bytes:
-    """Creates the request buffer to use during SET_ROM_PATCH_INFO ioctl."""
+# Request buffer of SET_ROM_PATCH_INFO/SET_PATCH_INFO: patch type (ROM
+# patches) or download sequence, address and the zero-padded patch name.
+PATCH_REQUEST = struct.Struct("<LL256s")
+
+
+def _patch_address(patchinfo: bytes) -> int:
+    # lowest byte is set to 0
+    return 0x0 | patchinfo[1] << 8 | patchinfo[2] << 16 | patchinfo[3] << 24
+
+
+def _patch_name(patchfile: str) -> bytes:
+    patchnameBytes = patchfile.encode()
+    if len(patchnameBytes) > 255:
+        raise Exception(f"Patch name exceeds max size ({len(patchnameBytes) > 255})")
+    return patchnameBytes
+
+
+def rom_patch_request_fields(patchinfo: bytes, patchfile: str) -> tuple[int, int, bytes]:
+    """Checks patchinfo and gets the PATCH_REQUEST fields of a
+    SET_ROM_PATCH_INFO ioctl."""
     if len(patchinfo) != 8:
         raise Exception(
             f"Invalid patchinfo length, expected 8 bytes, got {len(patchinfo)}"
@@ -144,114 +204,121 @@ def create_set_rom_patch_request(patchinfo: bytes, patchfile: str) -> bytes:
     if patchinfo[7] >= 6:
         raise Exception(f"Patch info type invalid! ({patchinfo[7]} >= 6)")
 
-    ioctlbuf = bytes()
-    # 0..3: "type"
-    ioctlbuf += struct.pack("<L", patchinfo[7])
-    # 4..7: "addRess"
-    # lowest byte is set to 0
-    address = struct.pack(
-        "<L",
-        0x0 | patchinfo[1] << 8 | patchinfo[2] << 16 | patchinfo[3] << 24,
-    )
-    ioctlbuf += address
-    # 8..264: "patchName"
-    patchnameBytes = patchfile.encode()
-    if len(patchnameBytes) > 255:
-        raise Exception(f"Patch name exceeds max size ({len(patchnameBytes) > 255})")
-    patchnameBytes += b"\x00" * (256 - len(patchnameBytes))
-    ioctlbuf += patchnameBytes
-    return ioctlbuf
+    # 0..3: "type", 4..7: "addRess", 8..264: "patchName"
+    return patchinfo[7], _patch_address(patchinfo), _patch_name(patchfile)
 
 
-def create_set_patch_request(patchinfo: bytes, patchfile: str) -> bytes:
-    """Creates the request buffer to use during SET_ROM_PATCH ioctl."""
-    ioctlbuf = bytes()
-    # 0..3: "downloadSeq"
-    ioctlbuf += struct.pack("<L", patchinfo[0] & 0xF)
-    # 4..7: "addRess"
-    # lowest byte is set to 0
-    address = struct.pack(
-        "<L",
-        0x0 | patchinfo[1] << 8 | patchinfo[2] << 16 | patchinfo[3] << 24,
-    )
-    ioctlbuf += address
-    # 8..264: "patchName"
-    patchnameBytes = patchfile.encode()
-    if len(patchnameBytes) > 255:
-        raise Exception(f"Patch name exceeds max size ({len(patchnameBytes) > 255})")
-    patchnameBytes += b"\x00" * (256 - len(patchnameBytes))
-    ioctlbuf += patchnameBytes
-    return ioctlbuf
+def patch_request_fields(patchinfo: bytes, patchfile: str) -> tuple[int, int, bytes]:
+    """Gets the PATCH_REQUEST fields of a SET_PATCH_INFO ioctl."""
+    # 0..3: "downloadSeq", 4..7: "addRess", 8..264: "patchName"
+    return patchinfo[0] & 0xF, _patch_address(patchinfo), _patch_name(patchfile)
+
 
 
 class Launcher:
     def __init__(self) -> None:
         self.fd = -1
+        # Kept for the whole run, WiFi is enabled (and the plan committed)
+        # from another thread.
+        self.planner = bootplan.get_planner()
+        # Finishes once WiFi was enabled, or the launcher gave up on it.
+        self.wifi_thread: Optional[threading.Thread] = None
 
     def run(self) -> int:
+        with boottrace.span("launcher", "phase"), metrics.phase("launcher"):
+            return self._run()
+
+    def _run(self) -> int:
+        err = self.setup()
+        if err != 0:
+            return err
+
+        t = threading.Thread(target=self._launcher_pwr_on_conn_thread)
+        t.start()
+        t = threading.Thread(target=self._launcher_response_thread)
+        t.start()
+        self.wifi_thread = threading.Thread(target=self._launcher_wifi_enable_thread)
+        self.wifi_thread.start()
+
+        return 0
+
+    def setup(self) -> int:
+        """Open WMT_DEV and configure the driver, before the power-on sequence."""
+        if not devnode.wait_for_node(WMT_DEV, WMT_DEV_TIMEOUT):
+            logger.error(f"{WMT_DEV} did not appear within {WMT_DEV_TIMEOUT}s")
+            logger.error(f"Hint: {WMT_DEV} appears after performing the Loader step.")
+            return 1
         self.fd = os.open(WMT_DEV, os.O_CREAT | os.O_RDWR)
         if self.fd < 0:
             logger.error(f"Failed to open {WMT_DEV}")
             logger.error(f"Hint: {WMT_DEV} appears after performing the Loader step.")
             return 1
 
-        while True:
-            chipid = do_ioctl(self.fd, WMT_IOCTL_WMT_QUERY_CHIPID)
+        retry_message = "WMT_IOCTL_WMT_QUERY_CHIPID failed! Retrying.."
+        for attempt in retry.attempts("query_chipid", retry_message):
+            with boottrace.span("QUERY_CHIPID attempt", "retry", attempt=attempt):
+                chipid = do_ioctl(self.fd, WMT_IOCTL_WMT_QUERY_CHIPID)
             if chipid != -1:
                 break
-            logger.warning(f"WMT_IOCTL_WMT_QUERY_CHIPID failed! Retrying in 300ms..")
-            time.sleep(0.3)
-            continue
-        logger.info(f"Chip ID={hex(chipid)}")
-        hwver = do_ioctl(self.fd, WMT_IOCTL_GET_CHIP_INFO, WMTCHIN.MAPPINGHWVER)
-        logger.info(f"HW Version={hex(hwver)}")
-
-        weird_chip_id = (chipid - 0x6620) >> 1
-        check_id = weird_chip_id | (chipid << 0x1F)
-        logger.debug(f"check_id: {hex(check_id)}")
-        if check_id < 10 and ((1 << (chipid) & 0x1F) & 0x311) != 0:
-            stp_mode = 4
-            logger.error("FIXME: Unimplemented branch!")
+        else:
+            logger.error("WMT_IOCTL_WMT_QUERY_CHIPID failed, giving up")
             return 1
+        logger.info(f"Chip ID={hex(chipid)}")
+        g_wmt_cfg_name = WMT_CFG_NAME
+
+        plan = self.planner.planned(chip_id=chipid)
+        if plan is not None:
+            # Same chip as in the previous boot, reuse what was queried then.
+            hwver, config = plan.hwver, plan.stp_config
+            logger.info(f"HW Version={hex(hwver)} (from boot plan)")
         else:
-            stp_mode = 3
-        fm_mode = 2
+            hwver = do_ioctl(self.fd, WMT_IOCTL_GET_CHIP_INFO, WMTCHIN.MAPPINGHWVER)
+            logger.info(f"HW Version={hex(hwver)}")
+
+            weird_chip_id = (chipid - 0x6620) >> 1
+            check_id = weird_chip_id | (chipid << 0x1F)
+            logger.debug(f"check_id: {hex(check_id)}")
+            if check_id < 10 and ((1 << (chipid) & 0x1F) & 0x311) != 0:
+                stp_mode = 4
+                logger.error("FIXME: Unimplemented branch!")
+                return 1
+            else:
+                stp_mode = 3
+            fm_mode = 2
 
-        baudrate = 4000000
-        g_wmt_cfg_name = "WMT_SOC.cfg"
-        patch_path = "/lib/firmware"
+            baudrate = 4000000
+            patch_path = "/lib/firmware"
 
-        if patch_path is None:
-            logger.error("FIXME: Unimplemented branch! patch_path == null")
-            return 1
+            if patch_path is None:
+                logger.error("FIXME: Unimplemented branch! patch_path == null")
+                return 1
+
+            config = (baudrate << 8) | ((fm_mode & 0xF) << 4) | (stp_mode & 0xF)
+        self.planner.record(chip_id=chipid, hwver=hwver, stp_config=config)
 
-        config = (baudrate << 8) | ((fm_mode & 0xF) << 4) | (stp_mode & 0xF)
         do_ioctl(self.fd, WMT_IOCTL_SET_PATCH_NAME, g_wmt_cfg_name.encode())
         do_ioctl(self.fd, WMT_IOCTL_SET_STP_MODE, config)
         do_ioctl(self.fd, WMT_IOCTL_SET_LAUNCHER_KILL)
-
-        t = threading.Thread(target=self._launcher_pwr_on_conn_thread)
-        t.start()
-        t = threading.Thread(target=self._launcher_response_thread)
-        t.start()
-        t = threading.Thread(target=self._launcher_wifi_enable_thread)
-        t.start()
-
+        for hook in _setup_hooks:
+            hook(self.fd)
         return 0
 
-    def _launcher_pwr_on_conn_thread(self):
+    def _power_on_value(self) -> int:
         magic_flag = False
-        magic_value = 2 if magic_flag else 1
-        count = 0
-        while count < 0x14:
-            err = do_ioctl(self.fd, WMT_IOCTL_LPBK_POWER_CTRL, magic_value)
-            if err == 0:
-                logger.info("Power-on completed, closing..")
-                break
-            do_ioctl(self.fd, WMT_IOCTL_LPBK_POWER_CTRL, 0)
-            logger.warning(f"Power-on failed! Retrying in 1s...")
-            time.sleep(1.0)
-            count += 1
+        return 2 if magic_flag else 1
+
+    def _launcher_pwr_on_conn_thread(self):
+        magic_value = self._power_on_value()
+        for attempt in retry.attempts("lpbk_power_ctrl", "Power-on failed! Retrying..."):
+            with boottrace.span("LPBK_POWER_CTRL attempt", "retry", attempt=attempt):
+                err = do_ioctl(self.fd, WMT_IOCTL_LPBK_POWER_CTRL, magic_value)
+                if err == 0:
+                    logger.info("Power-on completed, closing..")
+                    break
+                do_ioctl(self.fd, WMT_IOCTL_LPBK_POWER_CTRL, 0)
+        else:
+            logger.error("Power-on failed, giving up")
+            logformat.dump_flight_recorder("power-on failed")
 
     def _launcher_response_thread(self):
         import select
@@ -262,63 +329,121 @@ class Launcher:
             if self.fd not in r:
                 continue
 
+            if not self._serve_command():
+                return
+
+    def _serve_command(self) -> bool:
+        """Read a single command from WMT_DEV and write back the response.
+
+        Returns False once WMT_DEV was closed by the driver.
+        """
+        try:
             data = os.read(self.fd, 256)
-            response = b"fail"
-            try:
-                self._handle_launcher_cmd(data)
-                response = b"ok"
-            except:
-                logger.exception("Command handling failed")
-            logger.debug(f"response={response}")
-            os.write(self.fd, response)
+        except OSError as e:
+            data = b""
+            logger.debug(f"Reading {WMT_DEV} failed: {e}")
+        if not data:
+            logger.warning(f"{WMT_DEV} was closed, no longer serving patch requests")
+            return False
+        if _io_observer is not None:
+            _io_observer("read", data)
+        response = b"fail"
+        try:
+            self._handle_launcher_cmd(data)
+            response = b"ok"
+            metrics.record_command(data)
+        except:
+            logger.exception("Command handling failed")
+            metrics.record_command(data, sys.exc_info()[1])
+        logger.debug(f"response={response}")
+        os.write(self.fd, response)
+        if _io_observer is not None:
+            _io_observer("write", response)
+        return True
 
     def _launcher_wifi_enable_thread(self):
-        while True:
-            if not os.path.exists(WMT_WIFI):
-                time.sleep(1.0)
-                continue
+        for _ in retry.attempts("wifi_enable", "Retrying the WiFi enable..."):
+            while not devnode.wait_for_node(WMT_WIFI, WMT_WIFI_TIMEOUT):
+                logger.warning(f"Still waiting for {WMT_WIFI} to appear..")
             try:
-                with open(WMT_WIFI, "wt") as f:
-                    f.write("1")
-
-                logger.info("WiFi enabled!")
+                self._enable_wifi()
                 return
             except:
-                logger.exception("Failed to enable WiFi, retrying in 1s...")
-                time.sleep(1.0)
+                logger.exception("Failed to enable WiFi")
+        else:
+            logger.error("Failed to enable WiFi, giving up")
+            logformat.dump_flight_recorder("WiFi enable failed")
+
+    def _enable_wifi(self):
+        with boottrace.span("wifi enable", "wifi"):
+            with open(WMT_WIFI, "wt") as f:
+                f.write("1")
+            if _io_observer is not None:
+                _io_observer("wifi", b"1")
+
+        logger.info("WiFi enabled!")
+        boottrace.instant("wifi enabled", "wifi")
+        metrics.record_wifi_enabled()
+        self.planner.commit()
+        self._report_prefetch()
+        boottrace.dump()
+        metrics.write()
+
+    def _report_prefetch(self):
+        # prefetch imports this module for the patch prefixes.
+        import prefetch
+
+        prefetcher = prefetch.get_prefetcher()
+        if prefetcher is None:
+            return
+        requested = [WMT_CFG_NAME] + [
+            r.file.filename
+            for c in self.planner.recording.commands.values()
+            for r in c.requests
+        ]
+        prefetcher.report(requested)
 
     def _handle_launcher_cmd(self, cmd: bytes):
         logger.debug(f"Handling command={cmd}")
-        if cmd == WMT_COMMAND_SRH_ROM_PATCH:
-            self._handle_srh_rom_patch()
-        elif cmd == WMT_COMAMND_SRH_PATCH:
-            self._handle_srh_patch()
-        else:
-            raise Exception(f"Unknown launcher command={cmd}")
+        with boottrace.span(cmd.decode(errors="replace"), "command"):
+            if cmd == WMT_COMMAND_SRH_ROM_PATCH:
+                self._handle_srh_rom_patch()
+            elif cmd == WMT_COMAMND_SRH_PATCH:
+                self._handle_srh_patch()
+            else:
+                raise Exception(f"Unknown launcher command={cmd}")
 
     def _handle_srh_rom_patch(self):
-        chip_id = do_ioctl(self.fd, WMT_IOCTL_GET_CHIP_INFO, WMT_CHIPINFO_GET_CHIPID)
-        fwver = do_ioctl(self.fd, WMT_IOCTL_GET_CHIP_INFO, WMT_CHIPINFO_GET_FWVER)
+        chip_id, fwver = self._chip_info()
         logger.debug(f"srh_rom_patch: chip_id={hex(chip_id)} fw_ver={hex(fwver)}")
 
+        index = patchindex.get_index()
+        planned = self._planned_command("srh_rom_patch", index.directory, chip_id, fwver)
+        if planned is not None:
+            self._replay_command("srh_rom_patch", index.directory, planned)
+            return
+
         prefix = get_rom_patch_prefix(chip_id)
         suffix = get_patch_suffix(chip_id)
         patchglob = f"{prefix}_ram_*_{suffix}*"
         logger.info(f"srh_rom_patch: Looking for patch using glob: {patchglob}")
 
-        patches = patch.patchglob(patchglob)
+        requests = []
+        patches = index.glob(patchglob)
         for p in patches:
             if "ram_bt" in p.filename:
-                btver = patch.find_bluetooth_fw_ver(p.contents)
-                logger.debug(f"srh_rom_patch: BT firmware version: {btver}")
+                if p.bt_version is None:
+                    raise Exception(p.bt_error)
+                logger.debug(f"srh_rom_patch: BT firmware version: {p.bt_version}")
             else:
-                logger.debug(
-                    f"srh_rom_patch: Patch build: {patch.get_patch_build_id(p.contents)}"
-                )
-
-            logger.debug(f"srh_rom_patch: Read patch file length: {len(p.contents)}")
-            patchinfo = patch.get_patch_info(p.contents)
-            patchver = patch.get_patch_fwver(p.contents)
+                if p.build_id is None:
+                    raise Exception(p.build_id_error)
+                logger.debug(f"srh_rom_patch: Patch build: {p.build_id}")
+
+            logger.debug(f"srh_rom_patch: Read patch file length: {p.size}")
+            p.check()
+            patchinfo = p.patchinfo
+            patchver = p.fwver
             logger.debug(f"srh_rom_patch: patchinfo={patchinfo}")
             logger.debug(f"srh_rom_patch: patchver={patchver}")
             if patchver != fwver:
@@ -326,29 +451,50 @@ class Launcher:
                     f"Patch version mismatch... expected {patchver} got {fwver}"
                 )
 
-            req = create_set_rom_patch_request(patchinfo, p.filename)
-            err = do_ioctl(self.fd, WMT_IOCTL_SET_ROM_PATCH_INFO, req)
+            err, req = self._send_patch_request(
+                WMT_IOCTL_SET_ROM_PATCH_INFO, rom_patch_request_fields(patchinfo, p.filename)
+            )
             if err != 0:
                 raise Exception(
                     f"srh_rom_patch: WMT_IOCTL_SET_ROM_PATCH_INFO failed (err={err})"
                 )
+            requests.append(
+                bootplan.PlannedRequest(
+                    WMT_IOCTL_SET_ROM_PATCH_INFO,
+                    req,
+                    bootplan.planned_file(index.directory, p.filename),
+                )
+            )
+
+        self._command_done(
+            "srh_rom_patch",
+            index.directory,
+            bootplan.CommandPlan(chip_id, fwver, None, requests),
+        )
 
     def _handle_srh_patch(self):
-        chip_id = do_ioctl(self.fd, WMT_IOCTL_GET_CHIP_INFO, WMT_CHIPINFO_GET_CHIPID)
-        fwver = do_ioctl(self.fd, WMT_IOCTL_GET_CHIP_INFO, WMT_CHIPINFO_GET_FWVER)
+        chip_id, fwver = self._chip_info()
         logger.debug(f"srh_patch: chip_id={hex(chip_id)} fw_ver={hex(fwver)}")
 
+        index = patchindex.get_index()
+        planned = self._planned_command("srh_patch", index.directory, chip_id, fwver)
+        if planned is not None:
+            self._replay_command("srh_patch", index.directory, planned)
+            return
+
         prefix = f"{get_patch_prefix(chip_id)}_patch"
         suffix = get_patch_suffix(chip_id)
 
         patchglob = f"{prefix}*{suffix}*"
         logger.info(f"srh_patch: Looking for patch using glob: {patchglob}")
 
-        patch_count_set = False
-        patches = patch.patchglob(patchglob)
+        patch_num = None
+        requests = []
+        patches = index.glob(patchglob)
         for p in patches:
-            patchinfo = patch.get_patch_info(p.contents)[:4]
-            patchver = patch.get_patch_fwver(p.contents)
+            p.check()
+            patchinfo = p.patchinfo[:4]
+            patchver = p.fwver
             logger.debug(f"srh_patch: patchinfo={patchinfo}")
             logger.debug(f"srh_patch: patchver={patchver}")
             if patchver != fwver:
@@ -357,18 +503,76 @@ class Launcher:
                 )
             # The first globbed patch determines the amount of patches to come.
             # Presumably all of them would have a matching number here.
-            if not patch_count_set:
-                err = do_ioctl(self.fd, WMT_IOCTL_SET_PATCH_NUM, patchinfo[0] >> 4)
+            if patch_num is None:
+                patch_num = patchinfo[0] >> 4
+                err = do_ioctl(self.fd, WMT_IOCTL_SET_PATCH_NUM, patch_num)
                 if err != 0:
                     raise Exception(f"Failed to set patch count (err={err})")
-                patch_count_set = True
 
-            req = create_set_patch_request(patchinfo, p.filename)
-            err = do_ioctl(self.fd, WMT_IOCTL_SET_PATCH_INFO, req)
+            err, req = self._send_patch_request(
+                WMT_IOCTL_SET_PATCH_INFO, patch_request_fields(patchinfo, p.filename)
+            )
             if err != 0:
                 raise Exception(
                     f"srh_patch: WMT_IOCTL_SET_PATCH_INFO failed (err={err})"
                 )
+            requests.append(
+                bootplan.PlannedRequest(
+                    WMT_IOCTL_SET_PATCH_INFO,
+                    req,
+                    bootplan.planned_file(index.directory, p.filename),
+                )
+            )
+
+        self._command_done(
+            "srh_patch",
+            index.directory,
+            bootplan.CommandPlan(chip_id, fwver, patch_num, requests),
+        )
+
+    def _send_patch_request(self, ioctl: int, fields: tuple) -> tuple[int, bytes]:
+        """Pack a PATCH_REQUEST straight into the fd's reusable request
+        buffer and issue it. Returns the result, and a copy of the request
+        for the boot plan."""
+        err = ioctl_struct(self.fd, ioctl, PATCH_REQUEST, *fields)
+        return err, bytes(request_buffer(self.fd, PATCH_REQUEST.size))
+
+    def _replay_command(self, name: str, directory: str, planned: bootplan.CommandPlan):
+        """Send previously recorded requests for a command, skipping the patch
+        lookup and header checks."""
+        logger.info(f"{name}: Sending {len(planned.requests)} previously used patches")
+        if planned.patch_num is not None:
+            err = do_ioctl(self.fd, WMT_IOCTL_SET_PATCH_NUM, planned.patch_num)
+            if err != 0:
+                self.planner.invalidate(f"{name}: WMT_IOCTL_SET_PATCH_NUM failed")
+                raise Exception(f"Failed to set patch count (err={err})")
+        for r in planned.requests:
+            err = do_ioctl(self.fd, r.ioctl, r.request)
+            if err != 0:
+                # The driver is told the command failed, the next power-on
+                # attempt goes through full discovery.
+                self.planner.invalidate(f"{name}: request for {r.file.filename} failed")
+                raise Exception(
+                    f"{name}: {ioctl_name(r.ioctl)} failed for {r.file.filename} (err={err})"
+                )
+        self._command_done(name, directory, planned)
+
+    def _chip_info(self) -> tuple[int, int]:
+        """Query the chip ID and FW version the patches are chosen for."""
+        chip_id = do_ioctl(self.fd, WMT_IOCTL_GET_CHIP_INFO, WMT_CHIPINFO_GET_CHIPID)
+        fwver = do_ioctl(self.fd, WMT_IOCTL_GET_CHIP_INFO, WMT_CHIPINFO_GET_FWVER)
+        return chip_id, fwver
+
+    def _planned_command(
+        self, name: str, directory: str, chip_id: int, fwver: int
+    ) -> Optional[bootplan.CommandPlan]:
+        """Get previously sent requests for a command, to send them again
+        without looking up the patches."""
+        return self.planner.planned_command(name, directory, chip_id, fwver)
+
+    def _command_done(self, name: str, directory: str, planned: bootplan.CommandPlan):
+        """Called with the requests sent for a command, once it succeeded."""
+        self.planner.record_command(name, directory, planned)
 
 
 def do_launcher() -> int:
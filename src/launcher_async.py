@@ -0,0 +1,203 @@
+import asyncio
+import os
+import signal
+import threading
+from typing import Optional
+import boottrace
+import devnode
+import logformat
+import metrics
+import retry
+from ioctl import do_ioctl
+import launcher
+from launcher import Launcher, WMT_IOCTL_LPBK_POWER_CTRL
+
+logger = logformat.get_logger()
+
+# Seconds a single power-on attempt may take, the driver downloads all patches
+# while the LPBK_POWER_CTRL ioctl is in flight.
+POWER_ON_ATTEMPT_TIMEOUT = 30.0
+# Seconds to wait for WMT_WIFI to appear.
+WIFI_NODE_TIMEOUT = 60.0
+
+
+class AsyncLauncher(Launcher):
+    """Launcher running on a single asyncio event loop.
+
+    Commands on WMT_DEV are served from a loop reader callback, and the
+    power-on and WiFi enable sequences are coroutines. Extra threads only run
+    the blocking LPBK_POWER_CTRL ioctl, which can't return before the driver
+    got its patches through WMT_DEV, and the WiFi enable, which writes files.
+
+    The launcher keeps serving commands after WiFi was enabled, as the driver
+    re-requests patches after chip resets, until `request_stop` is called.
+    When running on the main thread, SIGINT/SIGTERM request a stop as well.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stop: Optional[asyncio.Event] = None
+
+    def run(self) -> int:
+        with boottrace.span("launcher", "phase"), metrics.phase("launcher"):
+            err = self.setup()
+            if err != 0:
+                return err
+        try:
+            return asyncio.run(self._main())
+        finally:
+            if self.fd >= 0:
+                os.close(self.fd)
+                self.fd = -1
+
+    def request_stop(self):
+        """Ask the launcher to shut down. Safe to call from any thread."""
+        if self.loop is not None and self.stop is not None:
+            self.loop.call_soon_threadsafe(self.stop.set)
+
+    async def _main(self) -> int:
+        loop = asyncio.get_running_loop()
+        self.loop = loop
+        self.stop = asyncio.Event()
+        # Signal handlers can only be installed from the main thread, when
+        # running as a boot step it's up to the caller to use request_stop.
+        signals = []
+        if threading.current_thread() is threading.main_thread():
+            signals = [signal.SIGINT, signal.SIGTERM]
+        for sig in signals:
+            loop.add_signal_handler(sig, self.stop.set)
+
+        logger.info("Waiting for patch requests..")
+        loop.add_reader(self.fd, self._on_readable)
+        tasks = [
+            asyncio.create_task(self._power_on(), name="power-on"),
+            asyncio.create_task(self._wifi_enable(), name="wifi-enable"),
+        ]
+        try:
+            await self.stop.wait()
+            logger.info("Launcher shutting down..")
+        finally:
+            loop.remove_reader(self.fd)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for sig in signals:
+                loop.remove_signal_handler(sig)
+            self.loop = None
+        return 0
+
+    def _on_readable(self):
+        if not self._serve_command():
+            self.stop.set()
+
+    async def _ioctl(self, ioctl: int, arg: int, timeout: Optional[float] = None) -> int:
+        """Run a blocking ioctl on a daemon thread, so an ioctl stuck in the
+        driver after a timeout doesn't keep the process from exiting."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def done(result: Optional[int], error: Optional[BaseException]):
+            if future.done():
+                # Timed out or cancelled in the meantime.
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        def call():
+            result, error = None, None
+            try:
+                result = do_ioctl(self.fd, ioctl, arg)
+            except Exception as e:
+                error = e
+            try:
+                loop.call_soon_threadsafe(done, result, error)
+            except RuntimeError:
+                # The loop was closed while the ioctl was stuck.
+                pass
+
+        threading.Thread(target=call, name="launcher-ioctl", daemon=True).start()
+        return await asyncio.wait_for(future, timeout)
+
+    async def _power_on(self):
+        magic_value = self._power_on_value()
+        async for attempt in retry.attempts_async(
+            "lpbk_power_ctrl", "Power-on failed! Retrying..."
+        ):
+            with boottrace.span("LPBK_POWER_CTRL attempt", "retry", attempt=attempt):
+                try:
+                    err = await self._ioctl(
+                        WMT_IOCTL_LPBK_POWER_CTRL, magic_value, POWER_ON_ATTEMPT_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    # The ioctl is still stuck in the worker thread, there is
+                    # no way to retry from here.
+                    logger.error(f"Power-on timed out after {POWER_ON_ATTEMPT_TIMEOUT}s")
+                    return
+                if err == 0:
+                    logger.info("Power-on completed, closing..")
+                    return
+                await self._ioctl(WMT_IOCTL_LPBK_POWER_CTRL, 0)
+        logger.error("Power-on failed, giving up")
+        logformat.dump_flight_recorder("power-on failed")
+
+    async def _wait_for_node(self, path: str, timeout: float) -> bool:
+        loop = asyncio.get_running_loop()
+        with devnode.DeviceNodeWatcher(path) as watcher:
+            if watcher.exists():
+                return True
+            if watcher.fileno() < 0:
+                # No inotify, fall back to the blocking wait.
+                return await loop.run_in_executor(None, watcher.wait, timeout)
+
+            appeared = loop.create_future()
+
+            def on_event():
+                if watcher.poll() and not appeared.done():
+                    appeared.set_result(True)
+
+            loop.add_reader(watcher.fileno(), on_event)
+            try:
+                with boottrace.span(f"wait {path}", "devnode"):
+                    await asyncio.wait_for(appeared, timeout)
+                return True
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                loop.remove_reader(watcher.fileno())
+
+    async def _wifi_enable(self):
+        async for _ in retry.attempts_async("wifi_enable", "Retrying the WiFi enable..."):
+            while not await self._wait_for_node(launcher.WMT_WIFI, WIFI_NODE_TIMEOUT):
+                logger.warning(f"Still waiting for {launcher.WMT_WIFI} to appear..")
+            try:
+                # Blocks on the WMT_WIFI write and the boot plan, trace and
+                # metrics writes, keep serving commands meanwhile.
+                await asyncio.get_running_loop().run_in_executor(None, self._enable_wifi)
+                return
+            except Exception:
+                logger.exception("Failed to enable WiFi")
+        logger.error("Failed to enable WiFi, giving up")
+        logformat.dump_flight_recorder("WiFi enable failed")
+
+
+_launchers: list[AsyncLauncher] = []
+
+
+def request_stop():
+    """Ask all running launchers to shut down. Safe to call from any thread,
+    including signal handlers.
+    """
+    for launcher_ in list(_launchers):
+        launcher_.request_stop()
+
+
+def do_launcher() -> int:
+    launcher_ = AsyncLauncher()
+    _launchers.append(launcher_)
+    try:
+        return launcher_.run()
+    finally:
+        _launchers.remove(launcher_)
@@ -0,0 +1,328 @@
+import argparse
+import dataclasses
+import json
+import os
+import select
+import socket
+import socketserver
+import sys
+import threading
+import time
+from typing import Optional
+import bootplan
+import devnode
+import ioctl
+import kmsg
+import launcher
+import patchindex
+import logformat
+from launcher import Launcher
+
+logger = logformat.get_logger()
+
+CONTROL_SOCKET_PATH = "/run/wmt-pyloader/launcher.sock"
+# Firmware directory events after which cached patch requests may be stale.
+FIRMWARE_EVENTS = (
+    devnode.IN_CLOSE_WRITE
+    | devnode.IN_MOVED_FROM
+    | devnode.IN_MOVED_TO
+    | devnode.IN_CREATE
+    | devnode.IN_DELETE
+    | devnode.IN_ATTRIB
+)
+
+
+@dataclasses.dataclass
+class CommandStats:
+    count: int = 0
+    # Commands answered from the in-memory cache.
+    hits: int = 0
+    failures: int = 0
+    last_ns: int = 0
+    total_ns: int = 0
+    max_ns: int = 0
+
+    def to_json(self) -> dict:
+        return {
+            "count": self.count,
+            "hits": self.hits,
+            "failures": self.failures,
+            "last_us": self.last_ns / 1000,
+            "mean_us": self.total_ns / self.count / 1000 if self.count else 0.0,
+            "max_us": self.max_ns / 1000,
+        }
+
+
+class PatchCache:
+    """The requests sent for each command, kept in memory for as long as the
+    chip and the firmware directory don't change."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands: dict[str, bootplan.CommandPlan] = {}
+        self.invalidations = 0
+        self.last_invalidation: Optional[str] = None
+
+    def get(self, name: str) -> Optional[bootplan.CommandPlan]:
+        with self.lock:
+            return self.commands.get(name)
+
+    def put(self, name: str, planned: bootplan.CommandPlan):
+        with self.lock:
+            self.commands[name] = planned
+
+    def invalidate(self, reason: str):
+        with self.lock:
+            if not self.commands:
+                return
+            self.commands = {}
+            self.invalidations += 1
+            self.last_invalidation = reason
+        logger.info(f"Patch cache invalidated: {reason}")
+
+
+class DaemonLauncher(Launcher):
+    """Launcher staying resident after WiFi was enabled.
+
+    The driver re-sends srh_rom_patch/srh_patch after chip resets. The
+    requests sent for each command are cached in memory, so repeated
+    commands are answered without patch lookups. Chip info is still queried
+    for every command, a cached command is only replayed for the chip ID and
+    FW version it was sent for. The cache is also dropped on chip resets
+    seen on kmsg, on changes in the firmware directory and whenever a
+    command fails.
+
+    Status and cache stats are served as JSON on a unix socket, see `main`.
+    """
+
+    def __init__(self, control_socket: Optional[str] = CONTROL_SOCKET_PATH) -> None:
+        super().__init__()
+        self.cache = PatchCache()
+        # Updated by the response thread, read by control socket threads.
+        self.stats_lock = threading.Lock()
+        self.command_stats: dict[str, CommandStats] = {}
+        # Chip ID and FW version last reported by the driver.
+        self.chip_info: Optional[tuple[int, int]] = None
+        self.control_socket = control_socket
+        self.server: Optional[socketserver.UnixStreamServer] = None
+        self.watch_fd = -1
+        self.started = time.monotonic()
+        self.wifi_enables = 0
+
+    def _run(self) -> int:
+        err = super()._run()
+        if err != 0:
+            return err
+
+        directory = patchindex.get_index().directory
+        try:
+            self.watch_fd = devnode.inotify_watch(directory, FIRMWARE_EVENTS)
+            t = threading.Thread(target=self._firmware_watch_thread, daemon=True)
+            t.start()
+        except OSError as e:
+            # Without change notifications, cached requests could point at
+            # replaced files.
+            logger.warning(f"Not caching patch requests, can't watch {directory}: {e}")
+        kmsg.subscribe(self._on_chip_reset, ["chip_reset"])
+        if self.control_socket is not None:
+            self._start_control_server()
+        return 0
+
+    def _firmware_watch_thread(self):
+        fd = self.watch_fd
+        while True:
+            try:
+                select.select([fd], [], [])
+                devnode.drain(fd)
+            except (OSError, ValueError):
+                # Closed by `close`.
+                return
+            self.cache.invalidate("firmware directory changed")
+
+    def _on_chip_reset(self, event: kmsg.KmsgEvent):
+        self.cache.invalidate(f"chip reset ({event.record.message.strip()})")
+
+    def _chip_info(self) -> tuple[int, int]:
+        # Not cached, a chip reset may change the FW version before kmsg
+        # reports it, if the kmsg listener runs at all.
+        self.chip_info = super()._chip_info()
+        return self.chip_info
+
+    def _planned_command(
+        self, name: str, directory: str, chip_id: int, fwver: int
+    ) -> Optional[bootplan.CommandPlan]:
+        cached = self.cache.get(name)
+        if cached is not None:
+            if (cached.chip_id, cached.fwver) == (chip_id, fwver):
+                with self.stats_lock:
+                    self.command_stats[name].hits += 1
+                return cached
+            self.cache.invalidate(
+                f"{name}: chip info changed to {hex(chip_id)}/{hex(fwver)}"
+            )
+        return super()._planned_command(name, directory, chip_id, fwver)
+
+    def _command_done(self, name: str, directory: str, planned: bootplan.CommandPlan):
+        super()._command_done(name, directory, planned)
+        if self.watch_fd >= 0:
+            self.cache.put(name, planned)
+
+    def _handle_launcher_cmd(self, cmd: bytes):
+        name = cmd.decode(errors="replace")
+        with self.stats_lock:
+            stats = self.command_stats.setdefault(name, CommandStats())
+        start_ns = time.monotonic_ns()
+        try:
+            super()._handle_launcher_cmd(cmd)
+        except:
+            with self.stats_lock:
+                stats.failures += 1
+            self.cache.invalidate(f"{name} failed")
+            raise
+        finally:
+            elapsed_ns = time.monotonic_ns() - start_ns
+            with self.stats_lock:
+                stats.count += 1
+                stats.last_ns = elapsed_ns
+                stats.total_ns += elapsed_ns
+                stats.max_ns = max(stats.max_ns, elapsed_ns)
+
+    def _enable_wifi(self):
+        super()._enable_wifi()
+        self.wifi_enables += 1
+
+    def status(self) -> dict:
+        chip_info = self.chip_info
+        with self.cache.lock:
+            cached = sorted(self.cache.commands)
+        return {
+            "pid": os.getpid(),
+            "uptime_s": time.monotonic() - self.started,
+            "wmt_dev": launcher.WMT_DEV,
+            "serving": self.fd >= 0,
+            "wifi_enables": self.wifi_enables,
+            "chip_id": None if chip_info is None else hex(chip_info[0]),
+            "fwver": None if chip_info is None else hex(chip_info[1]),
+            "cached_commands": cached,
+            "firmware_watch": self.watch_fd >= 0,
+        }
+
+    def stats(self) -> dict:
+        with self.cache.lock:
+            invalidations = self.cache.invalidations
+            last_invalidation = self.cache.last_invalidation
+        with self.stats_lock:
+            commands = {name: stats.to_json() for name, stats in self.command_stats.items()}
+        return {
+            "invalidations": invalidations,
+            "last_invalidation": last_invalidation,
+            "commands": commands,
+            "ioctls": {
+                s.name: {
+                    "count": s.count,
+                    "errors": s.errors,
+                    "mean_us": s.total_ns / s.count / 1000,
+                    "max_us": s.max_ns / 1000,
+                    "histogram_us": dict(
+                        zip([*map(str, ioctl.LATENCY_BUCKETS_US), "overflow"], s.histogram)
+                    ),
+                }
+                for s in ioctl.get_stats().values()
+            },
+        }
+
+    def control(self, request: str) -> dict:
+        """Handle a single control socket request."""
+        if request == "status":
+            return self.status()
+        if request == "stats":
+            return self.stats()
+        if request == "invalidate":
+            self.cache.invalidate("requested on control socket")
+            return {"ok": True}
+        return {"error": f"unknown request {request!r}"}
+
+    def _start_control_server(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = self.rfile.readline().decode(errors="replace").strip()
+                try:
+                    response = daemon.control(request)
+                except Exception as e:
+                    logger.exception("Control request failed")
+                    response = {"error": str(e)}
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+
+        path = self.control_socket
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Left behind by a previous run.
+            if os.path.exists(path):
+                os.remove(path)
+            self.server = socketserver.ThreadingUnixStreamServer(path, Handler)
+            os.chmod(path, 0o600)
+        except OSError as e:
+            logger.warning(f"Failed to create control socket {path}: {e}")
+            return
+        self.server.daemon_threads = True
+        t = threading.Thread(target=self.server.serve_forever, daemon=True)
+        t.start()
+        logger.info(f"Control socket listening on {path}")
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            try:
+                os.remove(self.control_socket)
+            except OSError:
+                pass
+            self.server = None
+        kmsg.get_listener().unsubscribe(self._on_chip_reset)
+        if self.watch_fd >= 0:
+            os.close(self.watch_fd)
+            self.watch_fd = -1
+
+
+def request(path: str, request: str, timeout: float = 5.0) -> dict:
+    """Send a request to a running daemon's control socket."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall(request.encode() + b"\n")
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data)
+
+
+def do_launcher() -> int:
+    launcher_ = DaemonLauncher(CONTROL_SOCKET_PATH)
+    return launcher_.run()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="launcher_daemon", description="Query a resident launcher daemon"
+    )
+    parser.add_argument("request", choices=["status", "stats", "invalidate"])
+    parser.add_argument("--socket", default=CONTROL_SOCKET_PATH)
+    args = parser.parse_args()
+    logformat.configure_logger()
+
+    try:
+        response = request(args.socket, args.request)
+    except OSError as e:
+        print(f"Failed to reach the launcher daemon on {args.socket}: {e}")
+        return 1
+    print(json.dumps(response, indent=2))
+    return 1 if "error" in response else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
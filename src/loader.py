@@ -1,12 +1,20 @@
-from ioctl import do_ioctl, ior, iow
+from ioctl import do_ioctl, ior, iow, register_names
 import os
 import struct
+import boottrace
+import bootplan
+import devnode
+import metrics
+import patchindex
+import prefetch
 import logformat
 
 logger = logformat.get_logger()
 
 
 DETECT_NODE = "/dev/wmtdetect"
+# Seconds to wait for DETECT_NODE to appear after loading wmt_drv.
+DETECT_NODE_TIMEOUT = 10.0
 PROC_WMT_DBG = "/proc/driver/wmt_dbg"
 PROC_WMT_AEE = "/proc/driver/wmt_aee"
 CHIPID = "-1"
@@ -27,11 +35,20 @@ COMBO_IOCTL_EXT_CHIP_PWR_OFF = ior(WMT_DETECT_IOC_MAGIC, 7, "int")
 COMBO_IOCTL_DO_SDIO_AUDOK = ior(WMT_DETECT_IOC_MAGIC, 8, "int")
 COMBO_IOCTL_GET_ADIE_CHIP_ID = ior(WMT_DETECT_IOC_MAGIC, 9, "int")
 COMBO_IOCTL_CONNSYS_SOC_HW_INIT = ior(WMT_DETECT_IOC_MAGIC, 10, "int")
+register_names(globals())
 
 
 def do_loader() -> int:
+    with boottrace.span("loader", "phase"), metrics.phase("loader"):
+        return _do_loader()
+
+
+def _do_loader() -> int:
     global persist_vendor_connsys_chipid
 
+    if not devnode.wait_for_node(DETECT_NODE, DETECT_NODE_TIMEOUT):
+        logger.error(f"{DETECT_NODE} did not appear within {DETECT_NODE_TIMEOUT}s")
+        return 1
     try:
         fd = open(DETECT_NODE, "wb")
     except:
@@ -73,6 +90,12 @@ def do_loader() -> int:
         # Read chip ID
         chipid = do_ioctl(fd, chip_id_ioctl, 0) & 0xFFFFFFFF
         logger.info(f"Detected chip ID: {hex(chipid)}")
+        # All of the loader ioctl's have side effects in the driver, so none
+        # of them can be skipped. The plan is only checked against the chip.
+        bootplan.get_planner().planned(soc_chip_id=chipid)
+        # Warm the firmware the driver will load while the loader and the
+        # module loads are still running.
+        prefetch.start(chipid, patchindex.get_index().directory)
 
         if is_inited:
             break
@@ -124,6 +147,9 @@ def do_loader() -> int:
     fd.close()
 
     logger.info(f"ADIE chip ID: {hex(adie_chipid)}")
+    planner = bootplan.get_planner()
+    planner.planned(adie_chip_id=adie_chipid)
+    planner.record(soc_chip_id=chipid, chip_type=chip_type, adie_chip_id=adie_chipid)
 
     return 0
 
@@ -1,6 +1,15 @@
+import collections
 import logging
+import os
+import queue
 import sys
+import threading
 import time
+from typing import Optional
+
+# Records kept in memory by the flight recorder.
+FLIGHT_RECORDER_SIZE = 10000
+FLIGHT_RECORDER_PATH = "/var/log/wmt-pyloader/flight-recorder.log"
 
 
 class LogFormatter(logging.Formatter):
@@ -10,15 +19,33 @@ class LogFormatter(logging.Formatter):
     }
     RESET = "\033[0m"
 
+    def __init__(self, color: bool = True):
+        super().__init__()
+        self.color = color
+        # strftime is slow, records logged within the same second share it.
+        self._timestamp_second = -1
+        self._timestamp = ""
+
+    def formatTimestamp(self, created: float) -> str:
+        second = int(created)
+        if second != self._timestamp_second:
+            self._timestamp = time.strftime("%y-%m-%d %H:%M:%S", time.localtime(second))
+            self._timestamp_second = second
+        return self._timestamp
+
     def formatPrefix(self, record: logging.LogRecord) -> str:
+        timestamp = self.formatTimestamp(record.created)
+        if not self.color:
+            return f"[{timestamp}.{int(record.msecs):03d}][{record.levelname}][{record.module}]"
         pfx = self.COLOR_MAP.get(record.levelno, "")
-        timestamp = time.strftime("%y-%m-%d %H:%M:%S", time.localtime(record.created))
         module = record.module
         level = record.levelname
 
         return f"[{timestamp}][{pfx}{level}{self.RESET}][{module}]"
 
     def formatLine(self, record: logging.LogRecord, line: str) -> str:
+        if not self.color:
+            return f"{self.formatPrefix(record)} {line}"
         return f"{self.formatPrefix(record)} {line}{self.RESET}"
 
     def format(self, record: logging.LogRecord):
@@ -30,16 +57,165 @@ class LogFormatter(logging.Formatter):
         return "\n".join(lines)
 
 
-def configure_logger():
+def configure_logger(level: int = logging.DEBUG):
+    """Log to stderr with LogFormatter. Called by entry points, importing a
+    module doesn't touch the logging configuration."""
     handler = logging.StreamHandler(sys.stderr)
     handler.setFormatter(LogFormatter())
     root = logging.getLogger()
-    root.setLevel(logging.DEBUG)
+    root.setLevel(level)
     root.handlers = [handler]
 
 
-def get_logger():
-    return logging.getLogger(__file__)
+class RingBufferHandler(logging.Handler):
+    """Keeps the last `capacity` records in memory, unformatted.
+
+    Messages are only formatted when the buffer is dumped, so logging a
+    record costs little more than creating it.
+    """
+
+    def __init__(self, capacity: int = FLIGHT_RECORDER_SIZE):
+        super().__init__()
+        self.records: collections.deque[logging.LogRecord] = collections.deque(maxlen=capacity)
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # deque.append is atomic, skip the handler lock.
+        self.records.append(record)
+        return True
+
+    def emit(self, record: logging.LogRecord):
+        self.records.append(record)
+
+    def dump(self, path: str) -> int:
+        """Write all buffered records to `path`, returns the record count."""
+        formatter = LogFormatter(color=False)
+        records = list(self.records)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wt") as f:
+            for record in records:
+                f.write(formatter.format(record))
+                f.write("\n")
+        return len(records)
+
+
+class BackgroundHandler(logging.Handler):
+    """Passes records to `target` on a background thread, so formatting and
+    writing to a slow console don't block the logging thread."""
+
+    def __init__(self, target: logging.Handler):
+        super().__init__()
+        self.target = target
+        self.queue: queue.SimpleQueue[Optional[logging.LogRecord]] = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name="log-console", daemon=True)
+        self.thread.start()
+
+    def emit(self, record: logging.LogRecord):
+        # Records aren't modified after being logged, so they're passed on
+        # unformatted.
+        self.queue.put(record)
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            self.target.handle(record)
+
+    def stop(self):
+        """Write out pending records and stop the background thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+class FlightRecorder:
+    def __init__(self, path: str, capacity: int, console_level: int):
+        self.path = path
+        self.ring = RingBufferHandler(capacity)
+        stderr = logging.StreamHandler(sys.stderr)
+        stderr.setFormatter(LogFormatter())
+        self.console = BackgroundHandler(stderr)
+        self.console.setLevel(console_level)
+        # Set by `request_dump`, the dump itself is written by the
+        # flight-recorder thread.
+        self.dump_requested = threading.Event()
+        self.dump_reason = ""
+        self.dump_thread = threading.Thread(
+            target=self._serve_dump_requests, name="flight-recorder", daemon=True
+        )
+        self.dump_thread.start()
+
+    def request_dump(self, reason: str):
+        """Dump from the background thread. Safe to call from signal
+        handlers, which can't take the logging locks."""
+        self.dump_reason = reason
+        self.dump_requested.set()
 
+    def _serve_dump_requests(self):
+        while True:
+            self.dump_requested.wait()
+            self.dump_requested.clear()
+            self.dump(self.dump_reason)
 
-configure_logger()
+    def dump(self, reason: str) -> Optional[str]:
+        """Write the ring buffer to the dump file. Returns the path written,
+        or None on failure."""
+        try:
+            count = self.ring.dump(self.path)
+        except OSError as e:
+            get_logger().error(f"Failed to write flight recorder to {self.path}: {e}")
+            return None
+        get_logger().warning(f"Flight recorder: wrote {count} records to {self.path} ({reason})")
+        return self.path
+
+
+_recorder: Optional[FlightRecorder] = None
+
+
+def configure_flight_recorder(
+    path: str = FLIGHT_RECORDER_PATH,
+    capacity: int = FLIGHT_RECORDER_SIZE,
+    console_level: int = logging.WARNING,
+) -> FlightRecorder:
+    """Log everything into an in-memory ring buffer, and only records at
+    `console_level` and above to stderr, from a background thread.
+
+    The ring buffer is written to `path` by `dump_flight_recorder`.
+    """
+    global _recorder
+    if _recorder is not None:
+        _recorder.console.stop()
+    recorder = FlightRecorder(path, capacity, console_level)
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+    root.handlers = [recorder.ring, recorder.console]
+    _recorder = recorder
+    return recorder
+
+
+def get_flight_recorder() -> Optional[FlightRecorder]:
+    return _recorder
+
+
+def dump_flight_recorder(reason: str = "requested") -> Optional[str]:
+    """Dump the flight recorder, if it's enabled."""
+    if _recorder is None:
+        return None
+    return _recorder.dump(reason)
+
+
+def request_flight_recorder_dump(reason: str = "requested"):
+    """Dump the flight recorder from a background thread, if it's enabled.
+    Safe to call from signal handlers."""
+    if _recorder is not None:
+        _recorder.request_dump(reason)
+
+
+def stop_flight_recorder():
+    """Write out pending console records and stop the background thread."""
+    if _recorder is not None:
+        _recorder.console.stop()
+
+
+def get_logger():
+    return logging.getLogger(__file__)
@@ -0,0 +1,281 @@
+import contextlib
+import dataclasses
+import json
+import os
+import threading
+import time
+from typing import Optional
+import ioctl
+import kmsg
+import retry
+import logformat
+
+logger = logformat.get_logger()
+
+TEXTFILE_PATH = "/var/lib/node_exporter/textfile_collector/wmt_pyloader.prom"
+PREFIX = "wmt_pyloader"
+# Commands and failure reasons are exported as label values, keep them
+# short. The driver only sends a few different commands, anything else it
+# sends still shows up in the failure reason.
+MAX_COMMAND_LENGTH = 32
+MAX_REASON_LENGTH = 80
+
+
+@dataclasses.dataclass
+class Sample:
+    # Appended to the metric name, e.g. "_bucket".
+    suffix: str
+    labels: dict[str, str]
+    value: float
+
+
+@dataclasses.dataclass
+class Metric:
+    name: str
+    # "counter", "gauge" or "histogram".
+    type: str
+    help: str
+    samples: list[Sample] = dataclasses.field(default_factory=list)
+
+    def add(self, value: float, suffix: str = "", **labels):
+        self.samples.append(Sample(suffix, labels, value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def to_text(metrics: list[Metric]) -> str:
+    """Format metrics in the Prometheus text exposition format."""
+    lines = []
+    for m in metrics:
+        name = f"{PREFIX}_{m.name}"
+        lines.append(f"# HELP {name} {m.help}")
+        lines.append(f"# TYPE {name} {m.type}")
+        for s in m.samples:
+            labels = ",".join(f'{k}="{_escape(str(v))}"' for k, v in s.labels.items())
+            labels = f"{{{labels}}}" if labels else ""
+            lines.append(f"{name}{s.suffix}{labels} {_format_value(s.value)}")
+    return "\n".join(lines) + "\n"
+
+
+def to_json(metrics: list[Metric]) -> dict:
+    return {
+        f"{PREFIX}_{m.name}": {
+            "type": m.type,
+            "help": m.help,
+            "samples": [
+                {"name": f"{PREFIX}_{m.name}{s.suffix}", "labels": s.labels, "value": s.value}
+                for s in m.samples
+            ],
+        }
+        for m in metrics
+    }
+
+
+def write_atomic(path: str, data: str):
+    """Write a file so readers only ever see the old or the new contents."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # node_exporter only reads *.prom files, so the temporary file is skipped.
+    tmppath = f"{path}.{os.getpid()}.tmp"
+    with open(tmppath, "wt") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmppath, path)
+
+
+class MetricsCollector:
+    """Boot and runtime health metrics, written as a node_exporter textfile.
+
+    Retries and ioctl latencies are collected from retry.get_stats and
+    ioctl.get_stats when writing. Boot phases, launcher commands, kmsg
+    firmware load failures and the WiFi enable are recorded as they happen.
+    """
+
+    def __init__(self, path: Optional[str], json_path: Optional[str] = None):
+        self.path = path
+        self.json_path = json_path
+        self.lock = threading.Lock()
+        # Metrics are enabled right at startup, time-to-WiFi counts from here.
+        self.started = time.monotonic()
+        # (kind, name) -> seconds of the last run of each boot phase or step
+        self.phases: dict[tuple[str, str], float] = {}
+        # (command, result, reason) -> count
+        self.commands: dict[tuple[str, str, str], int] = {}
+        # Firmware file name -> count
+        self.firmware_load_failures: dict[str, int] = {}
+        self.wifi_enables = 0
+        # Seconds from startup and from kernel boot to the first WiFi enable.
+        self.time_to_wifi: Optional[float] = None
+        self.boot_to_wifi: Optional[float] = None
+
+    def record_phase(self, kind: str, name: str, seconds: float):
+        with self.lock:
+            self.phases[(kind, name)] = seconds
+
+    def record_command(self, command: str, error: Optional[BaseException] = None):
+        reason = ""
+        if error is not None:
+            reason = (str(error) or type(error).__name__).splitlines()[0][:MAX_REASON_LENGTH]
+        key = (command, "ok" if error is None else "fail", reason)
+        with self.lock:
+            self.commands[key] = self.commands.get(key, 0) + 1
+
+    def record_wifi_enabled(self):
+        with self.lock:
+            self.wifi_enables += 1
+            if self.time_to_wifi is None:
+                self.time_to_wifi = time.monotonic() - self.started
+                self.boot_to_wifi = time.clock_gettime(time.CLOCK_BOOTTIME)
+
+    def _on_firmware_load_failed(self, event: kmsg.KmsgEvent):
+        filename = event.groups["filename"]
+        with self.lock:
+            self.firmware_load_failures[filename] = self.firmware_load_failures.get(filename, 0) + 1
+
+    def collect(self) -> list[Metric]:
+        metrics = []
+
+        with self.lock:
+            durations = dict(self.phases)
+        phases = Metric("boot_phase_seconds", "gauge", "Duration of boot phases and steps.")
+        for (kind, name), seconds in sorted(durations.items()):
+            phases.add(seconds, kind=kind, phase=name)
+        metrics.append(phases)
+
+        attempts = Metric("retry_attempts_total", "counter", "Attempts made by retry loops.")
+        exhausted = Metric(
+            "retry_exhausted_total", "counter", "Retry loops that gave up after all attempts."
+        )
+        retry_seconds = Metric(
+            "retry_seconds_total", "counter", "Seconds spent in retry loops."
+        )
+        totals: dict[str, list] = {}
+        for s in retry.get_stats():
+            total = totals.setdefault(s.name, [0, 0, 0.0])
+            total[0] += s.attempts
+            total[1] += s.exhausted
+            total[2] += s.time_in_retry
+        for name, (count, gave_up, seconds) in sorted(totals.items()):
+            attempts.add(count, loop=name)
+            exhausted.add(gave_up, loop=name)
+            retry_seconds.add(seconds, loop=name)
+        metrics += [attempts, exhausted, retry_seconds]
+
+        latency = Metric("ioctl_duration_seconds", "histogram", "ioctl call latency.")
+        errors = Metric("ioctl_errors_total", "counter", "ioctl calls that failed.")
+        for s in sorted(ioctl.get_stats().values(), key=lambda s: s.name):
+            cumulative = 0
+            for bound_us, count in zip(ioctl.LATENCY_BUCKETS_US, s.histogram):
+                cumulative += count
+                latency.add(cumulative, "_bucket", ioctl=s.name, le=_format_value(bound_us / 1e6))
+            latency.add(s.count, "_bucket", ioctl=s.name, le="+Inf")
+            latency.add(s.total_ns / 1e9, "_sum", ioctl=s.name)
+            latency.add(s.count, "_count", ioctl=s.name)
+            errors.add(s.errors, ioctl=s.name)
+        metrics += [latency, errors]
+
+        with self.lock:
+            commands = dict(self.commands)
+            firmware_load_failures = dict(self.firmware_load_failures)
+            wifi_enables = self.wifi_enables
+            time_to_wifi = self.time_to_wifi
+            boot_to_wifi = self.boot_to_wifi
+
+        command_metric = Metric(
+            "launcher_commands_total", "counter", "Driver commands handled by the launcher."
+        )
+        for (command, result, reason), count in sorted(commands.items()):
+            command_metric.add(count, command=command, result=result, reason=reason)
+        metrics.append(command_metric)
+
+        firmware = Metric(
+            "firmware_load_failures_total",
+            "counter",
+            "Failed kernel firmware loads seen on kmsg.",
+        )
+        for filename, count in sorted(firmware_load_failures.items()):
+            firmware.add(count, filename=filename)
+        metrics.append(firmware)
+
+        wifi = Metric("wifi_enables_total", "counter", "Times WiFi was enabled.")
+        wifi.add(wifi_enables)
+        metrics.append(wifi)
+        if time_to_wifi is not None:
+            ttw = Metric(
+                "time_to_wifi_seconds",
+                "gauge",
+                "Seconds until WiFi was first enabled, from wmt-pyloader startup and from kernel boot.",
+            )
+            ttw.add(time_to_wifi, since="start")
+            ttw.add(boot_to_wifi, since="boot")
+            metrics.append(ttw)
+
+        up = Metric("last_write_timestamp_seconds", "gauge", "Time these metrics were written.")
+        up.add(time.time())
+        metrics.append(up)
+        return metrics
+
+    def write(self):
+        metrics = self.collect()
+        try:
+            if self.path is not None:
+                write_atomic(self.path, to_text(metrics))
+            if self.json_path is not None:
+                write_atomic(self.json_path, json.dumps(to_json(metrics), indent=1) + "\n")
+        except OSError as e:
+            logger.warning(f"Failed to write metrics: {e}")
+
+
+_collector: Optional[MetricsCollector] = None
+
+
+def enable(path: Optional[str] = TEXTFILE_PATH, json_path: Optional[str] = None):
+    """Start collecting metrics, written to `path` and/or `json_path` by
+    `write`."""
+    global _collector
+    _collector = MetricsCollector(path, json_path)
+    kmsg.subscribe(_collector._on_firmware_load_failed, ["firmware_load_failed"])
+
+
+@contextlib.contextmanager
+def _timed(collector: MetricsCollector, kind: str, name: str):
+    start_ns = time.monotonic_ns()
+    try:
+        yield
+    finally:
+        collector.record_phase(kind, name, (time.monotonic_ns() - start_ns) / 1e9)
+
+
+def phase(name: str, kind: str = "phase"):
+    """Time a boot phase or scheduler step. A no-op unless enabled."""
+    if _collector is None:
+        return contextlib.nullcontext()
+    return _timed(_collector, kind, name)
+
+
+def record_command(command: bytes, error: Optional[BaseException] = None):
+    if _collector is not None:
+        _collector.record_command(command[:MAX_COMMAND_LENGTH].decode(errors="replace"), error)
+
+
+def record_wifi_enabled():
+    if _collector is not None:
+        _collector.record_wifi_enabled()
+
+
+def write():
+    """Write out the metrics collected so far, if enabled."""
+    if _collector is not None:
+        _collector.write()
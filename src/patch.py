@@ -1,22 +1,62 @@
 import os
 import sys
-import dataclasses
 import glob
-import dataclasses
-import os
+import mmap
 
 PATCH_LOOKUP_DIRECTORY = "/lib/firmware/"
+# Size of the patch header holding the build ID, fwver and patch info.
+PATCH_HEADER_SIZE = 0x20
 
 
-@dataclasses.dataclass
 class Patch:
-    # Patch file contents.
-    contents: bytes
-    # Full path to the patch file.
-    path: str
-    # Patch file name, used for ioctl's. This should be enough for
-    # request_firmware to find the patch on its own.
-    filename: str
+    """A patch file with lazily mapped contents.
+
+    The kernel loads patches on its own through request_firmware, so the file
+    contents are only mapped read-only on first access instead of being read
+    into memory. Header fields should be read with `header`, which only reads
+    the requested range.
+    """
+
+    def __init__(self, path: str, filename: str):
+        # Full path to the patch file.
+        self.path = path
+        # Patch file name, used for ioctl's. This should be enough for
+        # request_firmware to find the patch on its own.
+        self.filename = filename
+        self._map: mmap.mmap | None = None
+
+    def __repr__(self) -> str:
+        return f"Patch(path={self.path!r}, filename={self.filename!r})"
+
+    @property
+    def size(self) -> int:
+        return os.stat(self.path).st_size
+
+    @property
+    def contents(self) -> bytes | mmap.mmap:
+        """Patch file contents, mapped read-only on first access."""
+        if self._map is None:
+            with open(self.path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    # Empty files can't be mapped.
+                    return b""
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def header(self, length: int = PATCH_HEADER_SIZE) -> bytes:
+        """Read the first `length` bytes of the patch file."""
+        if self._map is not None:
+            return self._map[:length]
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            return os.pread(fd, length, 0)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
 
 
 def patchglob(pattern: str) -> list[Patch]:
@@ -32,44 +72,33 @@ def patchglob(pattern: str) -> list[Patch]:
     patches = []
     for filename in files:
         abspath = os.path.join(PATCH_LOOKUP_DIRECTORY, filename)
-        with open(abspath, "rb") as f:
-            filebytes = f.read()
-        patches.append(Patch(filebytes, abspath, filename))
+        patches.append(Patch(abspath, filename))
 
     return patches
 
 
-def find_bluetooth_fw_ver(patchbytes: bytes):
+def find_bluetooth_fw_ver(patchbytes: bytes | mmap.mmap):
     """Attempts to find the Bluetooth firmware version string inside a given
     patch file.
+
+    This works on both bytes and mmap objects, and only copies the final
+    version string out of the buffer.
     """
 
-    try:
-        babeface_offset = patchbytes.index(b"BABEFACE")
-    except:
-        babeface_offset = None
-    if babeface_offset is None:
+    babeface_offset = patchbytes.find(b"BABEFACE")
+    if babeface_offset == -1:
         raise Exception("Could not find build info start magic")
 
-    try:
-        deadbabe_offset = patchbytes.index(b"DEADBEEF", babeface_offset)
-    except:
-        deadbabe_offset = None
-    if deadbabe_offset is None:
+    deadbabe_offset = patchbytes.find(b"DEADBEEF", babeface_offset)
+    if deadbabe_offset == -1:
         raise Exception("Could not find build info end magic")
 
     startpos = 0
     endpos = 0
-    try:
-        t_neptune_offset = patchbytes.index(b"t-neptune", babeface_offset)
-    except:
-        t_neptune_offset = None
-    try:
-        debug_offset = patchbytes[babeface_offset:].index(b"= debug")
-    except:
-        debug_offset = None
-    if t_neptune_offset is None:
-        if debug_offset is None:
+    t_neptune_offset = patchbytes.find(b"t-neptune", babeface_offset)
+    debug_offset = patchbytes.find(b"= debug", babeface_offset)
+    if t_neptune_offset == -1:
+        if debug_offset == -1:
             raise Exception("Invalid firmware version")
         startpos = 0
         endpos = 0xE
@@ -77,15 +106,11 @@ def find_bluetooth_fw_ver(patchbytes: bytes):
         startpos = t_neptune_offset
         endpos = deadbabe_offset
 
-    foundbytes = patchbytes[startpos:endpos]
-    try:
-        hex10offset = foundbytes.index(b"\x0A")
-    except:
-        hex10offset = None
-    if hex10offset is None:
+    hex10offset = patchbytes.find(b"\x0A", startpos, endpos)
+    if hex10offset == -1:
         raise Exception("Could not find firmware string 0xA terminator")
 
-    return foundbytes[:hex10offset].decode()
+    return patchbytes[startpos:hex10offset].decode()
 
 
 def get_patch_info(patchbytes: bytes) -> bytes:
@@ -124,12 +149,13 @@ def get_patch_build_id(patchbytes: bytes) -> str:
 
 if __name__ == "__main__":
     path = sys.argv[1]
-    with open(path, "rb") as f:
-        patchbytes = f.read()
+    p = Patch(path, os.path.basename(path))
+    header = p.header()
 
     print(f"Patch file: {path}")
-    print(f"Patch fwver: {hex(get_patch_fwver(patchbytes))}")
-    print(f"Patch info: {get_patch_info(patchbytes)}")
-    print(f"Patch build ID: {get_patch_build_id(patchbytes)}")
+    print(f"Patch fwver: {hex(get_patch_fwver(header))}")
+    print(f"Patch info: {get_patch_info(header)}")
+    print(f"Patch build ID: {get_patch_build_id(header)}")
     if "ram_bt" in path:
-        print(f"BT firmware version: {find_bluetooth_fw_ver(patchbytes)}")
+        print(f"BT firmware version: {find_bluetooth_fw_ver(p.contents)}")
+    p.close()
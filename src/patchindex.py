@@ -0,0 +1,339 @@
+import argparse
+import dataclasses
+import fnmatch
+import json
+import mmap
+import os
+import sys
+import threading
+from typing import Callable, Optional
+import patch
+import logformat
+
+logger = logformat.get_logger()
+
+PATCH_INDEX_PATH = "/var/cache/wmt-pyloader/patchindex.json"
+PATCH_INDEX_VERSION = 2
+
+
+@dataclasses.dataclass
+class PatchIndexEntry:
+    # Patch file name, relative to the lookup directory.
+    filename: str
+    # Full path to the patch file.
+    path: str
+    # File metadata the cached header fields are valid for.
+    inode: int
+    size: int
+    mtime_ns: int
+    # Parsed header fields, None if the header failed validation.
+    build_id: Optional[str]
+    fwver: Optional[int]
+    patchinfo: Optional[bytes]
+    # Only parsed for ram_bt patches, as it requires scanning the whole file.
+    bt_version: Optional[str]
+    # Header validation error (patch info and fwver), if any.
+    error: Optional[str] = None
+    # Build ID decoding error, if any. Only needed for logging, so it's not
+    # part of `error`.
+    build_id_error: Optional[str] = None
+    # Bluetooth version lookup error, if any.
+    bt_error: Optional[str] = None
+
+    def matches(self, st: os.stat_result) -> bool:
+        """Check whether the entry is still valid for the given file metadata."""
+        return (
+            self.inode == st.st_ino
+            and self.size == st.st_size
+            and self.mtime_ns == st.st_mtime_ns
+        )
+
+    def check(self):
+        """Raise the header validation error recorded for this file, if any."""
+        if self.error is not None:
+            raise Exception(self.error)
+
+    def to_json(self) -> dict:
+        d = dataclasses.asdict(self)
+        if self.patchinfo is not None:
+            d["patchinfo"] = self.patchinfo.hex()
+        return d
+
+    @staticmethod
+    def from_json(d: dict) -> "PatchIndexEntry":
+        d = dict(d)
+        if d["patchinfo"] is not None:
+            d["patchinfo"] = bytes.fromhex(d["patchinfo"])
+        return PatchIndexEntry(**d)
+
+
+def parse_entry(filename: str, path: str, st: os.stat_result) -> PatchIndexEntry:
+    """Read the header fields of a single patch file.
+
+    Only the header range is read, except for ram_bt patches where the BT
+    firmware version has to be searched for in the mapped file.
+    """
+    p = patch.Patch(path, filename)
+    entry = PatchIndexEntry(
+        filename=filename,
+        path=path,
+        inode=st.st_ino,
+        size=st.st_size,
+        mtime_ns=st.st_mtime_ns,
+        build_id=None,
+        fwver=None,
+        patchinfo=None,
+        bt_version=None,
+    )
+    try:
+        parse_fields(entry, p.header(), lambda: p.contents)
+    finally:
+        p.close()
+    return entry
+
+
+def parse_fields(
+    entry: PatchIndexEntry, header: bytes, contents: Callable[[], bytes | mmap.mmap]
+):
+    """Fill in the header fields of `entry`. `contents` is only called for
+    ram_bt patches."""
+    try:
+        entry.build_id = patch.get_patch_build_id(header)
+    except Exception as e:
+        entry.build_id_error = f"{entry.filename}: {e}"
+    try:
+        entry.patchinfo = patch.get_patch_info(header)
+        entry.fwver = patch.get_patch_fwver(header)
+    except Exception as e:
+        entry.error = f"{entry.filename}: {e}"
+    if "ram_bt" in entry.filename:
+        try:
+            entry.bt_version = patch.find_bluetooth_fw_ver(contents())
+        except Exception as e:
+            entry.bt_error = f"{entry.filename}: {e}"
+
+
+class PatchIndex:
+    """Persistent index of parsed patch headers.
+
+    Entries are keyed by file name and are reparsed only when the inode, size
+    or mtime of the underlying file changes. The directory listing itself is
+    cached as well and reused as long as the directory mtime is unchanged.
+    """
+
+    def __init__(
+        self,
+        directory: str = patch.PATCH_LOOKUP_DIRECTORY,
+        path: str = PATCH_INDEX_PATH,
+    ):
+        self.directory = directory
+        self.path = path
+        self.entries: dict[str, PatchIndexEntry] = {}
+        self.listing: Optional[list[str]] = None
+        self.listing_mtime_ns = -1
+        self.dirty = False
+        # Boot steps and the launcher may use the index from different threads.
+        self.lock = threading.RLock()
+
+    def load(self):
+        """Load the index from disk. A missing or invalid index is discarded."""
+        try:
+            with open(self.path, "rt") as f:
+                data = json.load(f)
+            if data["version"] != PATCH_INDEX_VERSION:
+                raise Exception(f"unsupported index version {data['version']}")
+            if data["directory"] != self.directory:
+                raise Exception(f"index was built for {data['directory']}")
+            self.entries = {
+                e["filename"]: PatchIndexEntry.from_json(e) for e in data["entries"]
+            }
+            self.listing = data["listing"]
+            self.listing_mtime_ns = data["listing_mtime_ns"]
+        except FileNotFoundError:
+            logger.debug(f"No patch index at {self.path}")
+        except Exception as e:
+            logger.warning(f"Discarding patch index {self.path}: {e}")
+            self.entries = {}
+            self.listing = None
+            self.listing_mtime_ns = -1
+        self.dirty = False
+
+    def save(self):
+        """Atomically write the index to disk, if it changed."""
+        if not self.dirty:
+            return
+        data = {
+            "version": PATCH_INDEX_VERSION,
+            "directory": self.directory,
+            "listing": self.listing,
+            "listing_mtime_ns": self.listing_mtime_ns,
+            "entries": [e.to_json() for e in self.entries.values()],
+        }
+        tmppath = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmppath, "wt") as f:
+                json.dump(data, f)
+            os.replace(tmppath, self.path)
+            self.dirty = False
+        except OSError as e:
+            logger.warning(f"Failed to write patch index {self.path}: {e}")
+
+    def _list(self) -> list[str]:
+        mtime_ns = os.stat(self.directory).st_mtime_ns
+        if self.listing is None or self.listing_mtime_ns != mtime_ns:
+            self.listing = os.listdir(self.directory)
+            self.listing_mtime_ns = mtime_ns
+            # Drop entries for files that no longer exist.
+            names = set(self.listing)
+            for filename in list(self.entries):
+                if filename not in names:
+                    del self.entries[filename]
+            self.dirty = True
+        return self.listing
+
+    def lookup(self, filename: str) -> PatchIndexEntry:
+        """Get the index entry for a file, reparsing it only if it changed."""
+        path = os.path.join(self.directory, filename)
+        st = os.stat(path)
+        entry = self.entries.get(filename)
+        if entry is not None and entry.matches(st):
+            return entry
+        logger.debug(f"Patch index: parsing {path}")
+        entry = parse_entry(filename, path, st)
+        self.entries[filename] = entry
+        self.dirty = True
+        return entry
+
+    def glob(self, pattern: str) -> list[PatchIndexEntry]:
+        """Find patches with the specified glob-style pattern.
+
+        This behaves like patch.patchglob, but returns index entries and will
+        throw an exception if no patch was found.
+        """
+        with self.lock:
+            # glob skips hidden files unless the pattern asks for them.
+            files = [
+                f
+                for f in fnmatch.filter(self._list(), pattern)
+                if not f.startswith(".") or pattern.startswith(".")
+            ]
+            files = [
+                f for f in files if os.path.isfile(os.path.join(self.directory, f))
+            ]
+            if len(files) == 0:
+                raise Exception(f"Failed to find patch with glob {pattern}")
+
+            entries = [self.lookup(f) for f in files]
+            self.save()
+            return entries
+
+    def refresh(self) -> list[PatchIndexEntry]:
+        """Bring every file in the directory up to date in the index."""
+        with self.lock:
+            entries = [
+                self.lookup(f)
+                for f in self._list()
+                if os.path.isfile(os.path.join(self.directory, f))
+            ]
+            self.save()
+            return entries
+
+    def rebuild(self):
+        """Drop all cached state and reparse every file in the directory."""
+        self.entries = {}
+        self.listing = None
+        self.listing_mtime_ns = -1
+        self.refresh()
+
+    def verify(self) -> list[str]:
+        """Compare the index against the directory contents.
+
+        Returns a list of human-readable problems, empty if the index is
+        up to date.
+        """
+        problems = []
+        # The same listing refresh() indexes, dotfiles included. Not _list,
+        # which would drop the entries of removed files before they're seen.
+        names = set(
+            f
+            for f in os.listdir(self.directory)
+            if os.path.isfile(os.path.join(self.directory, f))
+        )
+        for filename in sorted(names - set(self.entries)):
+            problems.append(f"{filename}: not indexed")
+        for filename, entry in sorted(self.entries.items()):
+            if filename not in names:
+                problems.append(f"{filename}: indexed, but no longer exists")
+                continue
+            st = os.stat(entry.path)
+            if not entry.matches(st):
+                problems.append(f"{filename}: metadata changed since indexing")
+                continue
+            fresh = parse_entry(filename, entry.path, st)
+            if fresh != entry:
+                problems.append(f"{filename}: cached header fields are stale")
+        return problems
+
+
+_index: Optional[PatchIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> PatchIndex:
+    """Get the process-wide patch index, loading it from disk on first use."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = PatchIndex()
+            _index.load()
+        return _index
+
+
+def set_index(index: PatchIndex):
+    """Replace the process-wide patch index, e.g. to use another directory."""
+    global _index
+    with _index_lock:
+        _index = index
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="patchindex", description="Manage the firmware patch header index"
+    )
+    parser.add_argument("command", choices=["rebuild", "verify", "show"])
+    parser.add_argument("--directory", default=patch.PATCH_LOOKUP_DIRECTORY)
+    parser.add_argument("--index", default=PATCH_INDEX_PATH)
+    args = parser.parse_args()
+    logformat.configure_logger()
+
+    index = PatchIndex(args.directory, args.index)
+    if args.command == "rebuild":
+        index.rebuild()
+        print(f"Indexed {len(index.entries)} files into {index.path}")
+        return 0
+
+    index.load()
+    if args.command == "verify":
+        problems = index.verify()
+        for problem in problems:
+            print(problem)
+        if problems:
+            print(f"Index {index.path} is out of date, run `rebuild`")
+            return 1
+        print(f"Index {index.path} is up to date ({len(index.entries)} files)")
+        return 0
+
+    for filename, entry in sorted(index.entries.items()):
+        fwver = hex(entry.fwver) if entry.fwver is not None else "-"
+        patchinfo = entry.patchinfo.hex() if entry.patchinfo is not None else "-"
+        print(f"{filename}: build={entry.build_id} fwver={fwver} patchinfo={patchinfo}")
+        if entry.bt_version is not None:
+            print(f"    BT firmware version: {entry.bt_version}")
+        if entry.error is not None:
+            print(f"    error: {entry.error}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
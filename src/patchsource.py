@@ -0,0 +1,497 @@
+import abc
+import argparse
+import fnmatch
+import os
+import posixpath
+import struct
+import sys
+import tarfile
+import zipfile
+from typing import Optional
+import fwverify
+import patch
+import patchindex
+import logformat
+
+logger = logformat.get_logger()
+
+
+def _normalize(name: str) -> str:
+    """Member path relative to the source root, with "/" separators."""
+    name = posixpath.normpath(name.replace(os.sep, "/")).lstrip("/")
+    return "" if name == "." else name
+
+
+class PatchSource(abc.ABC):
+    """Read-only set of firmware files, e.g. a directory or an archive.
+
+    Members are named by their path relative to the root of the source,
+    with "/" separators. Sources are only used for inspection and audits,
+    the launcher always works on PATCH_LOOKUP_DIRECTORY.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._files: Optional[dict[str, int]] = None
+
+    def files(self) -> dict[str, int]:
+        """All regular files, mapped to their size."""
+        if self._files is None:
+            self._files = self._list()
+        return self._files
+
+    @abc.abstractmethod
+    def _list(self) -> dict[str, int]:
+        pass
+
+    @abc.abstractmethod
+    def read(self, name: str, offset: int = 0, length: int = -1) -> bytes:
+        """Read a range of a member, or everything from `offset` on."""
+
+    def read_many(self, ranges: dict[str, Optional[int]]) -> dict[str, bytes]:
+        """Read the first N bytes (or all, for None) of several members."""
+        return {name: self.read(name, 0, -1 if n is None else n) for name, n in ranges.items()}
+
+    def label(self, name: str) -> str:
+        """Human-readable location of a member."""
+        return f"{self.path}:{name}"
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class DirectorySource(PatchSource):
+    def __init__(self, path: str, recursive: bool = True):
+        super().__init__(path)
+        self.recursive = recursive
+
+    def _list(self) -> dict[str, int]:
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            if not self.recursive:
+                dirnames.clear()
+            for f in filenames:
+                path = os.path.join(dirpath, f)
+                if os.path.isfile(path):
+                    files[_normalize(os.path.relpath(path, self.path))] = os.stat(path).st_size
+        return files
+
+    def read(self, name: str, offset: int = 0, length: int = -1) -> bytes:
+        with open(os.path.join(self.path, name), "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def label(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+
+class ZipSource(PatchSource):
+    """Zip archive. Only the requested prefix of deflated members is
+    decompressed."""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.zf = zipfile.ZipFile(path)
+        self.members: dict[str, zipfile.ZipInfo] = {}
+
+    def _list(self) -> dict[str, int]:
+        self.members = {_normalize(i.filename): i for i in self.zf.infolist() if not i.is_dir()}
+        return {name: i.file_size for name, i in self.members.items()}
+
+    def read(self, name: str, offset: int = 0, length: int = -1) -> bytes:
+        self.files()
+        with self.zf.open(self.members[name]) as f:
+            if offset:
+                f.seek(offset)
+            return f.read(length)
+
+    def close(self):
+        self.zf.close()
+
+
+class TarSource(PatchSource):
+    """Tar archive, optionally compressed.
+
+    Uncompressed archives are read with random access, only touching the
+    requested ranges. Compressed archives can't be seeked in, so batched
+    reads stream through the archive once and keep just the requested
+    prefixes of matching members.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        with open(path, "rb") as f:
+            magic = f.read(6)
+        self.compressed = magic.startswith((b"\x1f\x8b", b"BZh", b"\xfd7zXZ\x00"))
+        self.tf: Optional[tarfile.TarFile] = None
+        self.members: dict[str, tarfile.TarInfo] = {}
+        if not self.compressed:
+            self.tf = tarfile.open(path, "r:")
+
+    def _list(self) -> dict[str, int]:
+        if self.tf is not None:
+            self.members = {_normalize(m.name): m for m in self.tf.getmembers() if m.isfile()}
+            return {name: m.size for name, m in self.members.items()}
+        with tarfile.open(self.path, "r|*") as tf:
+            return {_normalize(m.name): m.size for m in tf if m.isfile()}
+
+    def read(self, name: str, offset: int = 0, length: int = -1) -> bytes:
+        if self.tf is None:
+            data = self.read_many({name: None if length < 0 else offset + length})[name]
+            return data[offset:]
+        self.files()
+        f = self.tf.extractfile(self.members[name])
+        f.seek(offset)
+        return f.read(length)
+
+    def read_many(self, ranges: dict[str, Optional[int]]) -> dict[str, bytes]:
+        if self.tf is not None:
+            return super().read_many(ranges)
+        result = {}
+        with tarfile.open(self.path, "r|*") as tf:
+            for m in tf:
+                name = _normalize(m.name)
+                if m.isfile() and name in ranges:
+                    n = ranges[name]
+                    result[name] = tf.extractfile(m).read(-1 if n is None else n)
+                    if len(result) == len(ranges):
+                        break
+        missing = set(ranges) - set(result)
+        if missing:
+            raise Exception(f"{self.path}: no such members: {', '.join(sorted(missing))}")
+        return result
+
+    def close(self):
+        if self.tf is not None:
+            self.tf.close()
+
+
+EXT4_MAGIC = 0xEF53
+EXT4_ROOT_INODE = 2
+EXT4_FEATURE_INCOMPAT_64BIT = 0x80
+EXT4_EXTENTS_FL = 0x80000
+EXT4_INLINE_DATA_FL = 0x10000000
+EXT4_EXTENT_MAGIC = 0xF30A
+# Uninitialized extents have lengths above this, and read as zeros.
+EXT4_EXT_INIT_MAX_LEN = 0x8000
+S_IFMT = 0xF000
+S_IFREG = 0x8000
+S_IFDIR = 0x4000
+
+# magic, entries, max, depth, generation
+EXTENT_HEADER = struct.Struct("<HHHHI")
+# logical block, leaf block low, leaf block high, unused
+EXTENT_INDEX = struct.Struct("<IIHH")
+# logical block, length, start block high, start block low
+EXTENT_LEAF = struct.Struct("<IHHI")
+# inode, record length, name length, file type
+DIR_ENTRY = struct.Struct("<IHBB")
+
+
+class Ext4Image:
+    """Minimal read-only ext4 (and ext2/3) reader for raw filesystem images.
+
+    Supports extent-mapped and block-mapped files and inline data, which
+    covers vendor partition images. Journals are ignored, so the image must
+    be cleanly unmounted. Only the blocks backing the requested range are
+    read.
+    """
+
+    def __init__(self, path: str):
+        self.f = open(path, "rb")
+        sb = self._pread(1024, 1024)
+        (magic,) = struct.unpack_from("<H", sb, 56)
+        if magic != EXT4_MAGIC:
+            raise Exception(f"{path} is not an ext2/3/4 image")
+        (self.first_data_block, log_block_size) = struct.unpack_from("<II", sb, 20)
+        self.block_size = 1024 << log_block_size
+        (self.inodes_per_group,) = struct.unpack_from("<I", sb, 40)
+        (rev_level,) = struct.unpack_from("<I", sb, 76)
+        (inode_size,) = struct.unpack_from("<H", sb, 88)
+        self.inode_size = inode_size if rev_level >= 1 else 128
+        (incompat,) = struct.unpack_from("<I", sb, 96)
+        (desc_size,) = struct.unpack_from("<H", sb, 254)
+        self.is_64bit = bool(incompat & EXT4_FEATURE_INCOMPAT_64BIT)
+        self.desc_size = desc_size if self.is_64bit and desc_size else 32
+
+    def close(self):
+        self.f.close()
+
+    def _pread(self, offset: int, length: int) -> bytes:
+        return os.pread(self.f.fileno(), length, offset)
+
+    def _block(self, block: int) -> bytes:
+        return self._pread(block * self.block_size, self.block_size)
+
+    def inode(self, number: int) -> bytes:
+        group, index = divmod(number - 1, self.inodes_per_group)
+        desc_offset = (self.first_data_block + 1) * self.block_size + group * self.desc_size
+        desc = self._pread(desc_offset, self.desc_size)
+        (table,) = struct.unpack_from("<I", desc, 8)
+        if self.desc_size >= 64:
+            table |= struct.unpack_from("<I", desc, 0x28)[0] << 32
+        return self._pread(table * self.block_size + index * self.inode_size, self.inode_size)
+
+    @staticmethod
+    def mode(inode: bytes) -> int:
+        return struct.unpack_from("<H", inode, 0)[0]
+
+    @staticmethod
+    def size(inode: bytes) -> int:
+        lo, hi = struct.unpack_from("<I", inode, 4)[0], struct.unpack_from("<I", inode, 0x6C)[0]
+        return hi << 32 | lo
+
+    def _extents(self, node: bytes) -> list[tuple[int, int, int, bool]]:
+        """(logical block, physical block, length, initialized) of an extent
+        tree node."""
+        magic, entries, _, depth, _ = EXTENT_HEADER.unpack_from(node, 0)
+        if magic != EXT4_EXTENT_MAGIC:
+            raise Exception("Invalid extent header")
+        extents = []
+        for i in range(entries):
+            offset = EXTENT_HEADER.size + i * EXTENT_LEAF.size
+            if depth > 0:
+                _, lo, hi, _ = EXTENT_INDEX.unpack_from(node, offset)
+                extents.extend(self._extents(self._block(hi << 32 | lo)))
+            else:
+                logical, length, hi, lo = EXTENT_LEAF.unpack_from(node, offset)
+                initialized = length <= EXT4_EXT_INIT_MAX_LEN
+                if not initialized:
+                    length -= EXT4_EXT_INIT_MAX_LEN
+                extents.append((logical, hi << 32 | lo, length, initialized))
+        return extents
+
+    def _mapped_blocks(self, pointers: list[int], level: int) -> list[int]:
+        if level == 0:
+            return pointers
+        blocks = []
+        per_block = self.block_size // 4
+        for p in pointers:
+            if p == 0:
+                # Sparse, every block below is a hole.
+                blocks.extend([0] * per_block**level)
+                continue
+            children = list(struct.unpack(f"<{per_block}I", self._block(p)))
+            blocks.extend(self._mapped_blocks(children, level - 1))
+        return blocks
+
+    def _block_map(self, inode: bytes, count: int) -> list[tuple[int, int, int, bool]]:
+        pointers = struct.unpack_from("<15I", inode, 0x28)
+        blocks = list(pointers[:12])
+        for level, p in enumerate(pointers[12:], start=1):
+            if len(blocks) >= count:
+                break
+            blocks.extend(self._mapped_blocks([p], level))
+        return [(i, b, 1, True) for i, b in enumerate(blocks[:count]) if b != 0]
+
+    def read(self, inode: bytes, offset: int = 0, length: int = -1) -> bytes:
+        size = self.size(inode)
+        end = size if length < 0 else min(size, offset + length)
+        if offset >= end:
+            return b""
+        (flags,) = struct.unpack_from("<I", inode, 0x20)
+        if flags & EXT4_INLINE_DATA_FL:
+            if size > 60:
+                raise Exception("Inline data in extended attributes is not supported")
+            return inode[0x28 : 0x28 + 60][offset:end]
+
+        bs = self.block_size
+        first, last = offset // bs, (end - 1) // bs
+        if flags & EXT4_EXTENTS_FL:
+            extents = self._extents(inode[0x28 : 0x28 + 60])
+        else:
+            extents = self._block_map(inode, last + 1)
+        data = bytearray((last - first + 1) * bs)
+        for logical, physical, count, initialized in extents:
+            lo, hi = max(logical, first), min(logical + count - 1, last)
+            if lo > hi or not initialized:
+                continue
+            chunk = self._pread((physical + lo - logical) * bs, (hi - lo + 1) * bs)
+            start = (lo - first) * bs
+            data[start : start + len(chunk)] = chunk
+        start = offset - first * bs
+        return bytes(data[start : start + end - offset])
+
+    def listdir(self, inode: bytes) -> list[tuple[str, int]]:
+        """(name, inode number) of the entries of a directory."""
+        data = self.read(inode)
+        entries = []
+        pos = 0
+        (flags,) = struct.unpack_from("<I", inode, 0x20)
+        if flags & EXT4_INLINE_DATA_FL:
+            # Inline directories start with the parent inode number.
+            pos = 4
+        while pos + DIR_ENTRY.size <= len(data):
+            number, rec_len, name_len, _ = DIR_ENTRY.unpack_from(data, pos)
+            if rec_len < DIR_ENTRY.size:
+                break
+            name = data[pos + DIR_ENTRY.size : pos + DIR_ENTRY.size + name_len]
+            if number != 0 and name not in (b".", b".."):
+                entries.append((name.decode(errors="replace"), number))
+            pos += rec_len
+        return entries
+
+
+class Ext4Source(PatchSource):
+    """Raw ext4 image, e.g. vendor.img, read without mounting it."""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.image = Ext4Image(path)
+        self.inodes: dict[str, int] = {}
+
+    def _list(self) -> dict[str, int]:
+        files = {}
+        pending = [("", EXT4_ROOT_INODE)]
+        seen = set()
+        while pending:
+            directory, number = pending.pop()
+            if number in seen:
+                continue
+            seen.add(number)
+            for name, child in self.image.listdir(self.image.inode(number)):
+                path = f"{directory}/{name}" if directory else name
+                inode = self.image.inode(child)
+                kind = Ext4Image.mode(inode) & S_IFMT
+                if kind == S_IFDIR:
+                    if path != "lost+found":
+                        pending.append((path, child))
+                elif kind == S_IFREG:
+                    files[path] = Ext4Image.size(inode)
+                    self.inodes[path] = child
+        return files
+
+    def read(self, name: str, offset: int = 0, length: int = -1) -> bytes:
+        self.files()
+        return self.image.read(self.image.inode(self.inodes[name]), offset, length)
+
+    def close(self):
+        self.image.close()
+
+
+def open_source(path: str, recursive: bool = True) -> PatchSource:
+    """Open a directory, zip or tar archive, or ext2/3/4 image. Without
+    `recursive`, only the top level of directories is listed."""
+    if os.path.isdir(path):
+        return DirectorySource(path, recursive)
+    # Checked first, as an image starting with a zero block passes for an
+    # empty tar archive.
+    with open(path, "rb") as f:
+        f.seek(1024 + 56)
+        if f.read(2) == struct.pack("<H", EXT4_MAGIC):
+            return Ext4Source(path)
+    if zipfile.is_zipfile(path):
+        return ZipSource(path)
+    if tarfile.is_tarfile(path):
+        return TarSource(path)
+    raise Exception(f"{path} is not a directory, archive or ext4 image")
+
+
+def split_spec(spec: str) -> tuple[str, str]:
+    """Split SOURCE[:DIR] into the source path and a directory inside it."""
+    if not os.path.exists(spec) and ":" in spec:
+        path, _, directory = spec.rpartition(":")
+        return path, _normalize(directory)
+    return spec, ""
+
+
+def find_trees(files: dict[str, int]) -> list[str]:
+    """Directories of a source holding firmware files."""
+    return sorted(
+        {
+            posixpath.dirname(name)
+            for name in files
+            if fwverify.is_candidate(posixpath.basename(name))
+        }
+    )
+
+
+def listing(files: dict[str, int], directory: str) -> list[str]:
+    """Names of the files directly in `directory`."""
+    return [
+        posixpath.basename(name) for name in files if posixpath.dirname(name) == directory
+    ]
+
+
+def is_patch(filename: str) -> bool:
+    return "_ram_" in filename or "_patch" in filename
+
+
+def parse_entries(
+    source: PatchSource, names: list[str]
+) -> dict[str, patchindex.PatchIndexEntry]:
+    """Parse the patch headers of several members, reading only the header
+    range, except for ram_bt patches where the BT version is looked for in
+    the whole file."""
+    ranges = {
+        name: None if "ram_bt" in posixpath.basename(name) else patch.PATCH_HEADER_SIZE
+        for name in names
+    }
+    data = source.read_many(ranges)
+    files = source.files()
+    entries = {}
+    for name in names:
+        entry = patchindex.PatchIndexEntry(
+            filename=posixpath.basename(name),
+            path=source.label(name),
+            inode=0,
+            size=files[name],
+            mtime_ns=0,
+            build_id=None,
+            fwver=None,
+            patchinfo=None,
+            bt_version=None,
+        )
+        contents = data[name]
+        patchindex.parse_fields(entry, contents[: patch.PATCH_HEADER_SIZE], lambda: contents)
+        entries[name] = entry
+    return entries
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="patchsource",
+        description="Inspect patches inside directories, archives and images",
+    )
+    parser.add_argument("command", choices=["ls", "show"])
+    parser.add_argument("source", metavar="SOURCE[:DIR]")
+    parser.add_argument(
+        "patterns", nargs="*", default=["*"], help="glob patterns of patches to show"
+    )
+    args = parser.parse_args()
+    logformat.configure_logger()
+
+    path, directory = split_spec(args.source)
+    with open_source(path) as source:
+        files = source.files()
+        if args.command == "ls":
+            for name in find_trees(files):
+                if name.startswith(directory):
+                    print(f"{name or '.'}: {len(listing(files, name))} files")
+            return 0
+
+        names = [
+            posixpath.join(directory, f)
+            for f in sorted(listing(files, directory))
+            if any(fnmatch.fnmatch(f, p) for p in args.patterns)
+            and is_patch(f)
+        ]
+        for name, e in parse_entries(source, names).items():
+            fwver = hex(e.fwver) if e.fwver is not None else "-"
+            patchinfo = e.patchinfo.hex() if e.patchinfo is not None else "-"
+            print(f"{e.path}: build={e.build_id} fwver={fwver} patchinfo={patchinfo}")
+            if e.bt_version is not None:
+                print(f"    BT firmware version: {e.bt_version}")
+            if e.error is not None:
+                print(f"    error: {e.error}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
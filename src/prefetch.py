@@ -0,0 +1,216 @@
+import dataclasses
+import fnmatch
+import os
+import threading
+import time
+from typing import Optional
+import boottrace
+import launcher
+import logformat
+
+logger = logformat.get_logger()
+
+# Prefetching can be turned off with --no-prefetch.
+ENABLED = True
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+@dataclasses.dataclass
+class PrefetchedFile:
+    filename: str
+    size: int
+    # Pages in the page cache before prefetching and when reporting, None
+    # if unknown.
+    resident_before: Optional[int] = None
+    resident_after: Optional[int] = None
+    error: Optional[str] = None
+
+    @property
+    def pages(self) -> int:
+        return (self.size + PAGE_SIZE - 1) // PAGE_SIZE
+
+
+def predict(directory: str, chip_id: int) -> list[str]:
+    """Files the driver will request_firmware for `chip_id`: the WMT config,
+    the patches the launcher will find with the srh_rom_patch and srh_patch
+    globs, and the WiFi RAM code."""
+    rom_prefix = launcher.get_rom_patch_prefix(chip_id)
+    suffix = launcher.get_patch_suffix(chip_id)
+    patterns = [
+        launcher.WMT_CFG_NAME,
+        f"{rom_prefix}_ram_*_{suffix}*",
+        f"WIFI_RAM_CODE_{rom_prefix}_{suffix}*",
+    ]
+    try:
+        patterns.append(f"{launcher.get_patch_prefix(chip_id)}_patch*{suffix}*")
+    except Exception as e:
+        logger.debug(f"Not prefetching patches: {e}")
+    listing = os.listdir(directory)
+    return sorted({f for p in patterns for f in fnmatch.filter(listing, p) if not f.startswith(".")})
+
+
+def resident_pages(fd: int, size: int) -> Optional[int]:
+    """Count the pages of a file in the page cache, using mincore."""
+    if size == 0:
+        return 0
+    # Only needed for measuring, and not on the boot critical path.
+    import ctypes
+    import mmap
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_size_t,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_long,
+    ]
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+    libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+
+    addr = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+    if addr in (None, ctypes.c_void_p(-1).value):
+        return None
+    try:
+        vec = ctypes.create_string_buffer((size + PAGE_SIZE - 1) // PAGE_SIZE)
+        if libc.mincore(addr, size, vec) != 0:
+            return None
+        return sum(b & 1 for b in vec.raw)
+    finally:
+        libc.munmap(addr, size)
+
+
+class Prefetcher:
+    """Warms the firmware files the driver is about to load into the page
+    cache, so request_firmware doesn't wait on cold storage.
+
+    Started by the loader as soon as the chip ID is known. The launcher sits
+    idle until the driver asks for patches, which is when request_firmware
+    runs, so the prefetch only has to beat power-on.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.files: dict[str, PrefetchedFile] = {}
+        self.done = threading.Event()
+        self.elapsed_ns = 0
+
+    def start(self, chip_id: int):
+        t = threading.Thread(target=self._run, args=(chip_id,), daemon=True)
+        t.start()
+
+    def _run(self, chip_id: int):
+        start_ns = time.monotonic_ns()
+        try:
+            with boottrace.span("prefetch firmware", "prefetch"):
+                for filename in predict(self.directory, chip_id):
+                    self.files[filename] = self._prefetch(filename)
+        except Exception as e:
+            logger.warning(f"Firmware prefetch failed: {e}")
+        finally:
+            self.elapsed_ns = time.monotonic_ns() - start_ns
+            self.done.set()
+
+    def _prefetch(self, filename: str) -> PrefetchedFile:
+        path = os.path.join(self.directory, filename)
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        except OSError as e:
+            return PrefetchedFile(filename, 0, error=str(e))
+        try:
+            f = PrefetchedFile(filename, os.fstat(fd).st_size)
+            try:
+                f.resident_before = resident_pages(fd, f.size)
+            except Exception as e:
+                logger.debug(f"Can't measure page cache residency of {filename}: {e}")
+            # WILLNEED starts asynchronous readahead of the whole file.
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            return f
+        except OSError as e:
+            return PrefetchedFile(filename, 0, error=str(e))
+        finally:
+            os.close(fd)
+
+    def _measure_after(self, f: PrefetchedFile):
+        try:
+            fd = os.open(os.path.join(self.directory, f.filename), os.O_RDONLY | os.O_CLOEXEC)
+        except OSError:
+            return
+        try:
+            f.resident_after = resident_pages(fd, f.size)
+        except Exception as e:
+            logger.debug(f"Can't measure page cache residency of {f.filename}: {e}")
+        finally:
+            os.close(fd)
+
+    def report(self, requested: list[str]) -> dict:
+        """Log how well the prediction matched the files actually requested,
+        and how much of them was already cached."""
+        if not self.done.is_set():
+            logger.info("Firmware prefetch still running when WiFi was enabled")
+            return {}
+        for f in self.files.values():
+            if not f.error:
+                self._measure_after(f)
+        predicted = set(self.files)
+        requested_set = set(requested)
+        hits = sorted(predicted & requested_set)
+        misses = sorted(requested_set - predicted)
+        cached = [f for f in self.files.values() if f.resident_before == f.pages and not f.error]
+        pages = sum(f.pages for f in self.files.values() if not f.error)
+        # Measured, so pages WILLNEED didn't get to (or that were evicted
+        # again) don't count. Includes pages the driver read itself.
+        warmed = sum(
+            max(f.resident_after - f.resident_before, 0)
+            for f in self.files.values()
+            if not f.error and f.resident_before is not None and f.resident_after is not None
+        )
+        logger.info(
+            f"Firmware prefetch: {len(hits)}/{len(requested_set)} requested files predicted, "
+            f"{len(cached)}/{len(self.files)} were already cached, "
+            f"{warmed}/{pages} pages cached since the prefetch started, "
+            f"prefetch took {self.elapsed_ns / 1e6:.1f}ms"
+        )
+        for filename in misses:
+            logger.info(f"Firmware prefetch: {filename} was requested, but not predicted")
+        for f in self.files.values():
+            if f.error is not None:
+                logger.warning(f"Firmware prefetch: {f.filename}: {f.error}")
+        return {
+            "predicted": sorted(predicted),
+            "hits": hits,
+            "misses": misses,
+            "already_cached": sorted(f.filename for f in cached),
+            "pages": pages,
+            "pages_warmed": warmed,
+            "elapsed_ms": self.elapsed_ns / 1e6,
+        }
+
+
+_prefetcher: Optional[Prefetcher] = None
+_prefetcher_lock = threading.Lock()
+
+
+def start(chip_id: int, directory: str):
+    """Start prefetching the firmware for `chip_id`, once per process."""
+    global _prefetcher
+    if not ENABLED:
+        return
+    with _prefetcher_lock:
+        if _prefetcher is not None:
+            return
+        _prefetcher = Prefetcher(directory)
+    _prefetcher.start(chip_id)
+
+
+def get_prefetcher() -> Optional[Prefetcher]:
+    return _prefetcher
+
+
+def reset():
+    """Forget the prefetcher of this process, e.g. between simulated boots."""
+    global _prefetcher
+    with _prefetcher_lock:
+        _prefetcher = None
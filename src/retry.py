@@ -0,0 +1,214 @@
+import dataclasses
+import json
+import random
+import threading
+import time
+from typing import AsyncIterator, Iterator, Optional
+import logformat
+
+logger = logformat.get_logger()
+
+
+@dataclasses.dataclass
+class RetryPolicy:
+    # Maximum number of attempts, None for unlimited.
+    max_attempts: Optional[int] = None
+    # Seconds after the first attempt after which no more attempts are made,
+    # None for unlimited.
+    deadline: Optional[float] = None
+    # Number of retries done with fast_delay, before backing off.
+    fast_attempts: int = 0
+    fast_delay: float = 0.01
+    # Delay before the first backed off retry, multiplied by `multiplier` on
+    # every following retry up to `max_delay`.
+    initial_delay: float = 0.3
+    multiplier: float = 1.0
+    max_delay: float = 1.0
+    # Each delay is randomized by up to +/- this fraction of itself.
+    jitter: float = 0.0
+
+    def delay(self, retry: int) -> float:
+        """Get the delay before the given retry (0 being the first retry)."""
+        if retry < self.fast_attempts:
+            delay = self.fast_delay
+        else:
+            exponent = retry - self.fast_attempts
+            delay = min(self.initial_delay * self.multiplier**exponent, self.max_delay)
+        if self.jitter:
+            delay *= 1.0 + random.uniform(-self.jitter, self.jitter)
+        return max(delay, 0.0)
+
+
+@dataclasses.dataclass
+class RetryStats:
+    name: str
+    attempts: int = 0
+    # Seconds between the first attempt starting and the last one finishing.
+    time_in_retry: float = 0.0
+    # Whether all attempts were used up without the caller stopping early.
+    exhausted: bool = False
+
+
+POLICIES: dict[str, RetryPolicy] = {
+    # Polled until the driver is ready, this usually takes a couple of attempts.
+    "query_chipid": RetryPolicy(
+        fast_attempts=5,
+        fast_delay=0.02,
+        initial_delay=0.05,
+        multiplier=2.0,
+        max_delay=0.3,
+        jitter=0.1,
+    ),
+    # Each attempt powers the chip off again, so don't hammer it.
+    "lpbk_power_ctrl": RetryPolicy(
+        max_attempts=0x14,
+        initial_delay=0.1,
+        multiplier=2.0,
+        max_delay=1.0,
+        jitter=0.1,
+    ),
+    # Retrying the WiFi enable write after a failure.
+    "wifi_enable": RetryPolicy(initial_delay=1.0),
+}
+
+_stats: list[RetryStats] = []
+_stats_lock = threading.Lock()
+
+
+def get_policy(name: str) -> RetryPolicy:
+    if name not in POLICIES:
+        raise Exception(f"Unknown retry policy {name}")
+    return POLICIES[name]
+
+
+def configure(name: str, **kwargs):
+    """Override fields of a retry policy."""
+    policy = get_policy(name)
+    fields = {f.name: f for f in dataclasses.fields(RetryPolicy)}
+    for key, value in kwargs.items():
+        if key not in fields:
+            raise Exception(f"Unknown retry policy field {key}")
+        if value is None:
+            # Only the limits can be removed, the delays need a value.
+            if key not in ("max_attempts", "deadline"):
+                raise Exception(f"Retry policy field {key} can't be none")
+        elif key in ("max_attempts", "fast_attempts"):
+            value = int(value)
+        else:
+            value = float(value)
+        setattr(policy, key, value)
+
+
+def configure_from_arg(arg: str):
+    """Apply a `NAME:key=value[,key=value...]` policy override.
+
+    A value of `none` removes the limit for max_attempts and deadline.
+    """
+    name, _, settings = arg.partition(":")
+    kwargs = {}
+    for setting in settings.split(","):
+        key, sep, value = setting.partition("=")
+        if not sep:
+            raise Exception(f"Invalid retry policy setting {setting!r}")
+        kwargs[key.strip()] = None if value.strip() == "none" else value.strip()
+    configure(name, **kwargs)
+
+
+def configure_from_file(path: str):
+    """Apply policy overrides from a JSON file of {name: {key: value}}."""
+    with open(path, "rt") as f:
+        config = json.load(f)
+    for name, kwargs in config.items():
+        configure(name, **kwargs)
+
+
+class _RetryLoop:
+    """Bookkeeping shared by the sync and async attempt iterators."""
+
+    def __init__(self, name: str, retry_message: Optional[str] = None):
+        self.name = name
+        self.retry_message = retry_message
+        self.policy = get_policy(name)
+        self.stats = RetryStats(name)
+        self.start = time.monotonic()
+        self.attempt = 0
+
+    def next_delay(self) -> Optional[float]:
+        """Advance to the next attempt, returns None when out of attempts."""
+        self.attempt += 1
+        policy = self.policy
+        if policy.max_attempts is not None and self.attempt >= policy.max_attempts:
+            self.stats.exhausted = True
+            return None
+        delay = policy.delay(self.attempt - 1)
+        if (
+            policy.deadline is not None
+            and time.monotonic() + delay - self.start > policy.deadline
+        ):
+            self.stats.exhausted = True
+            return None
+        if self.retry_message is not None:
+            # Attributed to the caller of the attempts loop.
+            logger.warning(self.retry_message, stacklevel=3)
+        logger.debug(
+            f"{self.name}: retrying in {delay * 1000:.0f}ms (attempt {self.attempt + 1})"
+        )
+        return delay
+
+    def finish(self):
+        stats = self.stats
+        stats.attempts = self.attempt + (0 if stats.exhausted else 1)
+        stats.time_in_retry = time.monotonic() - self.start
+        with _stats_lock:
+            _stats.append(stats)
+        if stats.attempts > 1:
+            logger.debug(
+                f"{self.name}: {stats.attempts} attempts, {stats.time_in_retry:.3f}s in retry"
+            )
+
+
+def attempts(name: str, retry_message: Optional[str] = None) -> Iterator[int]:
+    """Iterate over attempt numbers according to the named retry policy.
+
+    The iterator sleeps between attempts and ends once the attempt limit or
+    deadline is hit. The caller breaks out of the loop on success:
+
+        for attempt in retry.attempts("query_chipid", "Query failed! Retrying.."):
+            if try_something():
+                break
+
+    `retry_message` is logged as a warning only when another attempt
+    follows, not after the last one.
+    """
+    loop = _RetryLoop(name, retry_message)
+    try:
+        while True:
+            yield loop.attempt
+            delay = loop.next_delay()
+            if delay is None:
+                return
+            time.sleep(delay)
+    finally:
+        loop.finish()
+
+
+async def attempts_async(name: str, retry_message: Optional[str] = None) -> AsyncIterator[int]:
+    """Like `attempts`, but sleeps with asyncio.sleep."""
+    import asyncio
+
+    loop = _RetryLoop(name, retry_message)
+    try:
+        while True:
+            yield loop.attempt
+            delay = loop.next_delay()
+            if delay is None:
+                return
+            await asyncio.sleep(delay)
+    finally:
+        loop.finish()
+
+
+def get_stats() -> list[RetryStats]:
+    """Get the statistics of all finished retry loops."""
+    with _stats_lock:
+        return list(_stats)
@@ -0,0 +1,113 @@
+import concurrent.futures
+import dataclasses
+from typing import Callable
+import boottrace
+import logformat
+import metrics
+
+logger = logformat.get_logger()
+
+
+@dataclasses.dataclass
+class Step:
+    # Unique step name, used to refer to it in dependencies.
+    name: str
+    # Function performing the step.
+    func: Callable[[], object]
+    # Names of the steps that must finish before this one starts.
+    deps: list[str] = dataclasses.field(default_factory=list)
+    # Failures of optional steps are logged, but don't abort the boot. A step
+    # fails by raising, or by returning a non-zero int error code.
+    optional: bool = False
+
+
+class Scheduler:
+    """Runs boot steps on a thread pool, respecting their dependencies.
+
+    Every step starts as soon as all of its dependencies finished, so
+    independent steps overlap with each other. If a required step fails, no
+    further steps are started and the failure is re-raised from `run`.
+    """
+
+    def __init__(self, steps: list[Step], max_workers: int = 4):
+        self.steps = {}
+        for step in steps:
+            if step.name in self.steps:
+                raise Exception(f"Duplicate boot step {step.name}")
+            self.steps[step.name] = step
+        self.max_workers = max_workers
+        self._validate()
+
+    def _validate(self):
+        for step in self.steps.values():
+            for dep in step.deps:
+                if dep not in self.steps:
+                    raise Exception(f"Boot step {step.name} depends on unknown step {dep}")
+
+        # Depth-first search for dependency cycles.
+        visiting = set()
+        done = set()
+
+        def visit(name: str, chain: list[str]):
+            if name in done:
+                return
+            if name in visiting:
+                raise Exception(f"Boot step dependency cycle: {' -> '.join(chain + [name])}")
+            visiting.add(name)
+            for dep in self.steps[name].deps:
+                visit(dep, chain + [name])
+            visiting.remove(name)
+            done.add(name)
+
+        for name in self.steps:
+            visit(name, [])
+
+    def _run_step(self, step: Step):
+        logger.debug(f"Starting boot step {step.name}")
+        with boottrace.span(step.name, "step"), metrics.phase(step.name, "step"):
+            result = step.func()
+        # Steps like loader.do_loader report errors as return codes.
+        if isinstance(result, int) and not isinstance(result, bool) and result != 0:
+            raise Exception(f"Boot step {step.name} returned {result}")
+        return result
+
+    def run(self) -> dict[str, object]:
+        """Run all steps, returning the results of the finished ones."""
+        results: dict[str, object] = {}
+        finished: set[str] = set()
+        pending = dict(self.steps)
+        running: dict[concurrent.futures.Future, Step] = {}
+        failure = None
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="boot-step"
+        ) as pool:
+            while pending or running:
+                if failure is None:
+                    for name, step in list(pending.items()):
+                        if all(dep in finished for dep in step.deps):
+                            del pending[name]
+                            running[pool.submit(self._run_step, step)] = step
+                if not running:
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    step = running.pop(future)
+                    try:
+                        results[step.name] = future.result()
+                    except Exception as e:
+                        if not step.optional:
+                            logger.error(f"Boot step {step.name} failed")
+                            failure = failure or e
+                            continue
+                        logger.warning(f"Optional boot step {step.name} failed: {e}")
+                    finished.add(step.name)
+
+        if failure is not None:
+            raise failure
+        if pending:
+            raise Exception(f"Boot steps never ran: {', '.join(pending)}")
+        return results
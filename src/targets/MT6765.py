@@ -1,26 +1,113 @@
-from subprocess import check_call
+import os
+import boottrace
+import bootplan
+import kmod
+import kmsg
 import loader
 import launcher
+import patch
+import patchindex
+import metrics
+import logformat
+from scheduler import Scheduler, Step
+
+logger = logformat.get_logger()
+
+
+def modprobe(module: str):
+    with boottrace.span(f"modprobe {module}", "modprobe"):
+        kmod.load_module(module)
 
 
 class MT6765:
     """Generic MT6765 target for Helio family SoC's."""
 
     COMPATIBLE_STRINGS = ["mediatek,MT6765"]
+    WMT_CFG_NAME = "WMT_SOC.cfg"
+
+    def __init__(self, use_asyncio: bool = False, daemon: bool = False):
+        # Run the launcher on an asyncio event loop instead of threads.
+        self.use_asyncio = use_asyncio
+        # Keep the launcher resident with an in-memory patch cache.
+        self.daemon = daemon
+
+    def steps(self) -> list[Step]:
+        return [
+            Step("kmsg_listener", kmsg.start_listener, optional=True),
+            # First, wmt_drv must be loaded for wmtDetect to appear.
+            Step("load_wmt_drv", lambda: modprobe("wmt_drv")),
+            # Patch headers are only needed by the launcher, so the index can
+            # be brought up to date while the modules load.
+            Step("patch_index", self._refresh_patch_index, optional=True),
+            # Hashing runs alongside the module loads as well, verified
+            # files are only stat'ed on later boots.
+            Step("verify_firmware", self._verify_firmware, optional=True),
+            Step(
+                "validate_firmware",
+                self._validate_firmware,
+                deps=["patch_index"],
+                optional=True,
+            ),
+            # Loader step.
+            Step("loader", loader.do_loader, deps=["load_wmt_drv"]),
+            # Further modules MUST be loaded after loader finishes! This is a strict
+            # requirement! As an example, the gen4m module relies on symbols
+            # exported in other modules in its module_init function, so blindly
+            # loading all of them at once leads to unexplainable failures.
+            Step("load_wmt_chrdev_wifi", lambda: modprobe("wmt_chrdev_wifi"), deps=["loader"]),
+            Step(
+                "load_wlan_drv_gen4m",
+                lambda: modprobe("wlan_drv_gen4m"),
+                deps=["load_wmt_chrdev_wifi"],
+            ),
+            # Launcher step - this will block.
+            Step(
+                "launcher",
+                self._launcher(),
+                deps=["load_wlan_drv_gen4m", "patch_index"],
+            ),
+        ]
+
+    def _launcher(self):
+        # Only import the launcher flavor that's used, asyncio alone takes
+        # longer to import than the rest of the boot path.
+        if self.use_asyncio:
+            import launcher_async
+
+            return launcher_async.do_launcher
+        if self.daemon:
+            import launcher_daemon
+
+            return launcher_daemon.do_launcher
+        return launcher.do_launcher
+
+    def _refresh_patch_index(self):
+        plan = bootplan.get_planner().get_plan()
+        if plan is not None and plan.files_valid():
+            # The launcher will replay the boot plan without looking at the
+            # index, unless the driver disagrees with it.
+            logger.debug("Firmware unchanged since the boot plan was recorded")
+            return
+        patchindex.get_index().refresh()
+
+    def _verify_firmware(self):
+        import fwverify
+
+        fwverify.verify_firmware()
 
-    def __init__(self):
-        pass
+    def _validate_firmware(self):
+        """Warn early about firmware files the driver will fail to load."""
+        cfg = os.path.join(patch.PATCH_LOOKUP_DIRECTORY, self.WMT_CFG_NAME)
+        if not os.path.isfile(cfg):
+            logger.warning(f"{cfg} is missing, the driver will fail to start")
+        index = patchindex.get_index()
+        # The launcher may be adding entries from its own thread meanwhile.
+        with index.lock:
+            entries = list(index.entries.values())
+        for entry in entries:
+            if "patch" in entry.filename and entry.error is not None:
+                logger.warning(f"Invalid patch file: {entry.error}")
 
     def boot(self):
-        # First, wmt_drv must be loaded for wmtDetect to appear.
-        check_call(["modprobe", "wmt_drv"])
-        # Loader step.
-        loader.do_loader()
-        # Further modules MUST be loaded after loader finishes! This is a strict
-        # requirement! As an example, the gen4m module relies on symbols
-        # exported in other modules in its module_init function, so blindly
-        # loading all of them at once leads to unexplainable failures.
-        check_call(["modprobe", "wmt_chrdev_wifi"])
-        check_call(["modprobe", "wlan_drv_gen4m"])
-        # Launcher step - this will block.
-        launcher.do_launcher()
+        with boottrace.span("boot", "phase"), metrics.phase("boot"):
+            Scheduler(self.steps()).run()
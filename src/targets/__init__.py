@@ -0,0 +1,75 @@
+import importlib
+from typing import Optional
+import logformat
+
+logger = logformat.get_logger()
+
+DEVICE_TREE_COMPATIBLE = "/proc/device-tree/compatible"
+
+# Compatible strings of every target, keyed by target name (the module and
+# class name in this package). Kept here so detection doesn't have to import
+# every target, tools/target_manifest.py checks it against each target's
+# COMPATIBLE_STRINGS.
+TARGETS = {
+    "MT6765": ["mediatek,MT6765"],
+}
+# Used when the device tree doesn't match any target.
+DEFAULT_TARGET = "MT6765"
+
+_compatible: Optional[list[str]] = None
+
+
+def read_compatible(path: str = DEVICE_TREE_COMPATIBLE) -> list[str]:
+    """Get the device tree compatible strings, most specific first. Read
+    only once per process."""
+    global _compatible
+    if _compatible is None:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            _compatible = [s.decode(errors="replace") for s in data.split(b"\0") if s]
+        except OSError as e:
+            logger.debug(f"Can't read {path}: {e}")
+            _compatible = []
+    return _compatible
+
+
+def detect(compatible: Optional[list[str]] = None) -> Optional[str]:
+    """Find the target for the most specific matching compatible string."""
+    if compatible is None:
+        compatible = read_compatible()
+    # Compatible strings are matched case-insensitively, vendors aren't
+    # consistent about the case of SoC names.
+    by_string = {
+        s.lower(): name for name, strings in TARGETS.items() for s in strings
+    }
+    for s in compatible:
+        name = by_string.get(s.lower())
+        if name is not None:
+            return name
+    return None
+
+
+def load(name: str) -> type:
+    """Import a single target module and get its target class."""
+    if name not in TARGETS:
+        raise Exception(f"Unknown target {name}, known targets: {', '.join(TARGETS)}")
+    module = importlib.import_module(f"{__name__}.{name}")
+    return getattr(module, name)
+
+
+def get_target_class(name: Optional[str] = None) -> type:
+    """Get the target class to boot, detected from the device tree unless
+    `name` is given."""
+    if name is None:
+        name = detect()
+        if name is None:
+            compatible = ", ".join(read_compatible()) or "none"
+            logger.warning(
+                f"No target matches device tree compatible strings ({compatible}), "
+                f"falling back to {DEFAULT_TARGET}"
+            )
+            name = DEFAULT_TARGET
+        else:
+            logger.info(f"Detected target {name}")
+    return load(name)
@@ -0,0 +1,161 @@
+import dataclasses
+from typing import Optional
+import boottrace
+import kmsg
+import logformat
+
+logger = logformat.get_logger()
+
+# Pseudo thread ID of the kernel log track in the boot trace.
+KERNEL_TID = 0
+# Span categories considered boot phases in the breakdown.
+PHASE_CATEGORIES = ["phase", "step", "modprobe", "command", "wifi"]
+# ioctl's after which the driver does work on its own (downloading patches)
+# until it sends the next command.
+PATCH_INFO_IOCTLS = ["WMT_IOCTL_SET_PATCH_INFO", "WMT_IOCTL_SET_ROM_PATCH_INFO"]
+
+
+@dataclasses.dataclass
+class PhaseLatency:
+    name: str
+    category: str
+    start_ns: int
+    end_ns: int
+    # WMT driver log lines emitted while the phase was running, by tag.
+    kernel_tags: dict[str, int]
+
+
+@dataclasses.dataclass
+class KernelGap:
+    # The command after which the driver took over.
+    after: str
+    # From the last patch info ioctl to the next command (or WiFi enable).
+    start_ns: int
+    end_ns: int
+    until: str
+    kernel_tags: dict[str, int]
+    # Last driver log line before the next command arrived.
+    last_message: Optional[str]
+
+
+def _on_kmsg(event: kmsg.KmsgEvent):
+    # /dev/kmsg timestamps come from the kernel's local clock, which matches
+    # CLOCK_MONOTONIC used by the boot trace closely enough on a fresh boot.
+    ts_ns = event.record.timestamp_us * 1000
+    name = event.groups.get("tag") or event.rule
+    boottrace.get_tracer().record_on(
+        name,
+        "kmsg",
+        ts_ns,
+        ts_ns,
+        KERNEL_TID,
+        "kernel (kmsg)",
+        {"rule": event.rule, "message": event.record.message},
+    )
+
+
+def _count_tags(kernel: list[boottrace.Span], start_ns: int, end_ns: int) -> dict[str, int]:
+    tags: dict[str, int] = {}
+    for span in kernel:
+        if start_ns <= span.start_ns <= end_ns:
+            tags[span.name] = tags.get(span.name, 0) + 1
+    return tags
+
+
+def breakdown(spans: list[boottrace.Span]) -> tuple[list[PhaseLatency], list[KernelGap]]:
+    """Correlate the kernel log with userspace boot phases."""
+    kernel = sorted((s for s in spans if s.category == "kmsg"), key=lambda s: s.start_ns)
+    phases = sorted(
+        (s for s in spans if s.category in PHASE_CATEGORIES and s.end_ns > s.start_ns),
+        key=lambda s: s.start_ns,
+    )
+
+    latencies = [
+        PhaseLatency(
+            p.name,
+            p.category,
+            p.start_ns,
+            p.end_ns,
+            _count_tags(kernel, p.start_ns, p.end_ns),
+        )
+        for p in phases
+    ]
+
+    commands = [p for p in phases if p.category == "command"]
+    ioctls = [s for s in spans if s.category == "ioctl" and s.name in PATCH_INFO_IOCTLS]
+    wifi = [s for s in spans if s.category == "wifi"]
+    gaps = []
+    for i, command in enumerate(commands):
+        patch_ioctls = [
+            s
+            for s in ioctls
+            if command.start_ns <= s.start_ns and s.end_ns <= command.end_ns
+        ]
+        if not patch_ioctls:
+            continue
+        start_ns = max(s.end_ns for s in patch_ioctls)
+        if i + 1 < len(commands):
+            end_ns, until = commands[i + 1].start_ns, commands[i + 1].name
+        elif wifi:
+            end_ns, until = min(s.start_ns for s in wifi), "wifi enable"
+        else:
+            continue
+        in_gap = [s for s in kernel if start_ns <= s.start_ns <= end_ns]
+        gaps.append(
+            KernelGap(
+                command.name,
+                start_ns,
+                end_ns,
+                until,
+                _count_tags(kernel, start_ns, end_ns),
+                in_gap[-1].args["message"] if in_gap else None,
+            )
+        )
+    return latencies, gaps
+
+
+def _format_tags(tags: dict[str, int]) -> str:
+    top = sorted(tags.items(), key=lambda t: t[1], reverse=True)[:4]
+    return ", ".join(f"{tag}x{count}" for tag, count in top)
+
+
+def format_report(start_ns: int, latencies: list[PhaseLatency], gaps: list[KernelGap]) -> str:
+    lines = [
+        f"{'category':<10} {'phase':<32} {'start @ms':>10} {'dur ms':>10}  kernel log",
+    ]
+    for p in latencies:
+        lines.append(
+            f"{p.category:<10} {p.name:<32} {(p.start_ns - start_ns) / 1e6:>10.1f} "
+            f"{(p.end_ns - p.start_ns) / 1e6:>10.1f}  {_format_tags(p.kernel_tags)}"
+        )
+    if gaps:
+        lines.append("")
+        lines.append("Time spent in the driver between commands:")
+        for g in gaps:
+            lines.append(
+                f"  after {g.after} until {g.until}: {(g.end_ns - g.start_ns) / 1e6:.1f}ms"
+                f"  {_format_tags(g.kernel_tags)}"
+            )
+            if g.last_message is not None:
+                lines.append(f"    last kernel message: {g.last_message}")
+    return "\n".join(lines)
+
+
+def report() -> str:
+    tracer = boottrace.get_tracer()
+    latencies, gaps = breakdown(tracer.snapshot())
+    return format_report(tracer.start_ns, latencies, gaps)
+
+
+def _print_report():
+    print(report(), flush=True)
+
+
+def enable():
+    """Record WMT driver log lines into the boot trace, and print the
+    correlated per-phase breakdown whenever the trace is dumped.
+
+    Tracing must be enabled with boottrace.enable.
+    """
+    kmsg.subscribe(_on_kmsg, ["wmt_driver", "firmware_load_failed"])
+    boottrace.get_tracer().dump_hooks.append(_print_report)
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 import argparse
+import atexit
+import boottrace
+import bootplan
+import logging
 import logformat
-import kmsg
-
-from targets.MT6765 import MT6765
+import retry
+import signal
+import targets
 
 logger = logformat.get_logger()
 
@@ -12,17 +16,231 @@ def main() -> int:
     parser = argparse.ArgumentParser(
         prog="wmt_pyloader", description="Mediatek WiFi Loader"
     )
-    # TODO: For now arguments are unused as there's one target.
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="write a Chrome trace-event JSON of the boot timeline to FILE (viewable in Perfetto)",
+    )
+    parser.add_argument(
+        "--trace-summary",
+        action="store_true",
+        help="print a summary table of the boot timeline once WiFi is enabled",
+    )
+    parser.add_argument(
+        "--timeline",
+        action="store_true",
+        help="correlate WMT driver kmsg lines with the boot timeline and print a per-phase latency breakdown once WiFi is enabled",
+    )
+    parser.add_argument(
+        "--retry",
+        metavar="NAME:KEY=VALUE,...",
+        action="append",
+        default=[],
+        help=f"override a retry policy ({', '.join(retry.POLICIES)}), e.g. query_chipid:initial_delay=0.1,max_attempts=50",
+    )
+    parser.add_argument(
+        "--retry-config",
+        metavar="FILE",
+        help="JSON file with retry policy overrides, as {name: {key: value}}",
+    )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="run the launcher on an asyncio event loop instead of threads",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep the launcher resident, caching patch requests the driver repeats after chip resets",
+    )
+    parser.add_argument(
+        "--control-socket",
+        metavar="PATH",
+        help="unix socket serving the daemon's status and cache stats",
+    )
+    parser.add_argument(
+        "--boot-plan",
+        metavar="FILE",
+        default=bootplan.BOOT_PLAN_PATH,
+        help="cache of the chip facts and patch requests of the last successful boot",
+    )
+    parser.add_argument(
+        "--no-boot-plan",
+        action="store_true",
+        help="always run full discovery, and don't record a boot plan",
+    )
+    parser.add_argument(
+        "--flight-recorder",
+        metavar="FILE",
+        nargs="?",
+        const=logformat.FLIGHT_RECORDER_PATH,
+        help=f"keep all log records in memory and write them to FILE (default {logformat.FLIGHT_RECORDER_PATH}) when the boot fails or on SIGUSR1",
+    )
+    parser.add_argument(
+        "--flight-recorder-size",
+        metavar="RECORDS",
+        type=int,
+        default=logformat.FLIGHT_RECORDER_SIZE,
+        help="number of log records kept by the flight recorder",
+    )
+    parser.add_argument(
+        "--target",
+        choices=sorted(targets.TARGETS),
+        help=f"boot target (default: detected from {targets.DEVICE_TREE_COMPATIBLE})",
+    )
+    parser.add_argument(
+        "--firmware-manifest",
+        metavar="FILE",
+        help="verify firmware files against a manifest made with fwverify.py (default /etc/wmt-pyloader/firmware-manifest.json, if it exists)",
+    )
+    parser.add_argument(
+        "--no-prefetch",
+        action="store_true",
+        help="don't warm the firmware files into the page cache ahead of the driver",
+    )
+    parser.add_argument(
+        "--record-io",
+        metavar="FILE",
+        help="record all ioctls and /dev/stpwmt, /dev/wmtWifi traffic to FILE, for replay with bench/replay.py",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="FILE",
+        nargs="?",
+        const="/var/lib/node_exporter/textfile_collector/wmt_pyloader.prom",
+        help="write boot and runtime health metrics for the node_exporter textfile collector to FILE (default /var/lib/node_exporter/textfile_collector/wmt_pyloader.prom)",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        metavar="FILE",
+        help="also write the metrics as JSON to FILE",
+    )
+    parser.add_argument(
+        "--coredump",
+        metavar="DIR",
+        nargs="?",
+        const="/var/lib/wmt-pyloader/coredumps",
+        help="enable firmware coredumps, and save them to DIR (default /var/lib/wmt-pyloader/coredumps) when the firmware asserts",
+    )
+    parser.add_argument(
+        "--coredump-node",
+        metavar="PATH",
+        help="device node the driver streams coredumps through (default /dev/wmt_coredump)",
+    )
+    parser.add_argument(
+        "--coredump-compression",
+        choices=["zlib", "lzma"],
+        help="compress coredumps as .gz (zlib, the default) or .xz (lzma)",
+    )
+    parser.add_argument(
+        "--coredump-dynamic-dump",
+        metavar="HEX",
+        type=bytes.fromhex,
+        help="register ranges to include in coredumps, as the hex-encoded WMT_IOCTL_DYNAMIC_DUMP_CTRL buffer",
+    )
+    parser.add_argument(
+        "--console-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        help="lowest level logged to the console (default: DEBUG, or WARNING with --flight-recorder)",
+    )
     args = parser.parse_args()
-    _ = args
+    if args.flight_recorder:
+        logformat.configure_flight_recorder(
+            args.flight_recorder,
+            args.flight_recorder_size,
+            getattr(logging, args.console_level or "WARNING"),
+        )
+        signal.signal(
+            signal.SIGUSR1, lambda *_: logformat.request_flight_recorder_dump("SIGUSR1")
+        )
+        atexit.register(logformat.stop_flight_recorder)
+    else:
+        logformat.configure_logger(getattr(logging, args.console_level or "DEBUG"))
+    if args.daemon and args.asyncio:
+        parser.error("--daemon is not supported with --asyncio")
+
+    bootplan.set_planner(bootplan.BootPlanner(args.boot_plan, not args.no_boot_plan))
+
+    if args.retry_config:
+        try:
+            retry.configure_from_file(args.retry_config)
+        except Exception as e:
+            parser.error(f"--retry-config {args.retry_config}: {e}")
+    for override in args.retry:
+        try:
+            retry.configure_from_arg(override)
+        except Exception as e:
+            parser.error(f"--retry {override}: {e}")
+
+    if args.trace or args.trace_summary or args.timeline:
+        boottrace.enable(args.trace, args.trace_summary)
+        if args.timeline:
+            import timeline
+
+            timeline.enable()
+        # The trace is written out when WiFi gets enabled, but make sure
+        # there's something to look at when the boot fails halfway.
+        atexit.register(boottrace.dump)
+
+    if args.metrics or args.metrics_json:
+        import metrics
+
+        metrics.enable(args.metrics, args.metrics_json)
+        # Written whenever WiFi gets enabled, and once more on exit so a
+        # failed boot shows up too.
+        atexit.register(metrics.write)
+
+    if args.coredump:
+        import coredump
+
+        if args.coredump_node:
+            coredump.DUMP_NODE = args.coredump_node
+        if args.coredump_compression:
+            coredump.COMPRESSION = args.coredump_compression
+        coredump.DYNAMIC_DUMP_CONFIG = args.coredump_dynamic_dump
+        coredump.enable(args.coredump, coredump.DUMP_NODE)
+
+    if args.firmware_manifest:
+        import fwverify
+
+        fwverify.MANIFEST_PATH = args.firmware_manifest
 
-    kmsg.start_listener()
+    if args.no_prefetch:
+        import prefetch
+
+        prefetch.ENABLED = False
+
+    if args.record_io:
+        import iotrace
+
+        iotrace.start_recording(args.record_io)
+        atexit.register(iotrace.stop_recording)
+
+    if args.asyncio:
+        import launcher_async
+
+        # The launcher runs as a boot step off the main thread, forward
+        # termination requests so it can shut down cleanly.
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: launcher_async.request_stop())
+
+    if args.daemon and args.control_socket:
+        import launcher_daemon
+
+        launcher_daemon.CONTROL_SOCKET_PATH = args.control_socket
+
+    try:
+        target_class = targets.get_target_class(args.target)
+    except Exception as e:
+        logger.error(f"Failed to load boot target: {e}")
+        return 1
 
-    target = MT6765()
+    target = target_class(use_asyncio=args.asyncio, daemon=args.daemon)
     try:
         target.boot()
     except Exception as e:
         logger.exception("Failed to boot network")
+        logformat.dump_flight_recorder("boot failed")
         return 1
 
     return 0
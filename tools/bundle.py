@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Build a single-file, precompiled wmt-pyloader bundle.
+
+Every module under src/ is compiled to bytecode and stored uncompressed in
+a zip archive runnable by the interpreter, so nothing is parsed, compiled or
+decompressed at boot. The bytecode is specific to the Python version the
+bundle is built with, build it with the interpreter used on the device.
+
+    python3 tools/bundle.py -o wmt-pyloader.pyz
+    ./wmt-pyloader.pyz --trace-summary
+"""
+import argparse
+import os
+import py_compile
+import stat
+import sys
+import tempfile
+import zipfile
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+# wmt-pyloader.py can't be imported under its own name.
+ENTRY_POINT = ("wmt-pyloader.py", "wmt_pyloader.py")
+MAIN = b"import sys\nimport wmt_pyloader\n\nsys.exit(wmt_pyloader.main())\n"
+
+
+def sources(src: str) -> list[tuple[str, str]]:
+    """(path, name in the bundle) of every module under `src`."""
+    result = []
+    for root, dirs, files in os.walk(src):
+        dirs[:] = [d for d in dirs if d != "__pycache__"]
+        for filename in sorted(files):
+            if not filename.endswith(".py"):
+                continue
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, src).replace(os.sep, "/")
+            if name == ENTRY_POINT[0]:
+                name = ENTRY_POINT[1]
+            result.append((path, name))
+    return result
+
+
+def build(output: str, src: str = SRC, optimize: int = 0, interpreter: str = "/usr/bin/env python3"):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(output, "wb") as f:
+            f.write(f"#!{interpreter}\n".encode())
+            # zipimport only picks up bytecode stored next to where the
+            # source would be, i.e. `name.pyc` instead of __pycache__/.
+            with zipfile.ZipFile(f, "w", zipfile.ZIP_STORED) as z:
+                for path, name in sources(src):
+                    cfile = os.path.join(tmpdir, "module.pyc")
+                    py_compile.compile(
+                        path,
+                        cfile=cfile,
+                        dfile=name,
+                        doraise=True,
+                        optimize=optimize,
+                        invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+                    )
+                    z.write(cfile, name + "c")
+                z.writestr("__main__.py", MAIN)
+    mode = os.stat(output).st_mode
+    os.chmod(output, mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-o", "--output", default="wmt-pyloader.pyz")
+    parser.add_argument(
+        "-O",
+        dest="optimize",
+        action="count",
+        default=0,
+        help="compile like python -O (or -OO, which also drops docstrings)",
+    )
+    parser.add_argument("--interpreter", default="/usr/bin/env python3")
+    args = parser.parse_args()
+
+    build(args.output, optimize=args.optimize, interpreter=args.interpreter)
+    print(f"Wrote {args.output} for Python {sys.version_info.major}.{sys.version_info.minor}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Check the target manifest in src/targets/__init__.py.
+
+Imports every module under src/targets/ and compares its target class'
+COMPATIBLE_STRINGS with targets.TARGETS, which is what the boot path uses
+to detect the target without importing all of them. Prints the manifest to
+paste into targets/__init__.py when they disagree.
+
+    python3 tools/target_manifest.py
+"""
+import importlib
+import os
+import pprint
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+import targets  # noqa: E402
+
+
+def collect() -> dict[str, list[str]]:
+    manifest = {}
+    for filename in sorted(os.listdir(os.path.join(SRC, "targets"))):
+        name, ext = os.path.splitext(filename)
+        if ext != ".py" or name == "__init__":
+            continue
+        module = importlib.import_module(f"targets.{name}")
+        cls = getattr(module, name, None)
+        if cls is None:
+            raise SystemExit(f"targets/{filename} has no {name} class")
+        manifest[name] = list(cls.COMPATIBLE_STRINGS)
+    return manifest
+
+
+def main() -> int:
+    manifest = collect()
+    if manifest == targets.TARGETS:
+        print(f"Target manifest is up to date ({len(manifest)} targets)")
+        return 0
+    print("Target manifest is out of date, use:")
+    print(f"TARGETS = {pprint.pformat(manifest, indent=4)}")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())